@@ -0,0 +1,204 @@
+"""Микро-бенчмарки игрового движка и ИИ бота.
+
+Запуск:
+    python bench.py                         # результаты в bench_results/<время>.json
+    python bench.py -o base.json            # результаты в указанный файл
+    python bench.py --compare base.json     # сравнить с предыдущим прогоном
+    python bench.py -k move                 # только бенчмарки, в имени которых есть "move"
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, REPO_DIR)
+import main  # noqa: E402
+
+SEED = 12345
+
+
+def _game_with_moves(moves):
+    """Создает игру с ботом и проигрывает заданные ходы"""
+    game = main.TicTacToeGame(1, -1, is_vs_bot=True, is_rated=False)
+    for row, col in moves:
+        game.make_move(row, col, game.current_player)
+    return game
+
+
+# Типичные позиции: пустое поле, середина партии, почти заполненное поле
+POSITIONS = {
+    "empty": [],
+    "midgame": [(1, 1), (0, 0), (2, 2)],
+    "late": [(1, 1), (0, 0), (2, 2), (0, 2), (0, 1), (2, 1), (1, 0)],
+}
+
+
+def bench_make_move():
+    game = main.TicTacToeGame(1, 2)
+
+    def run():
+        game.board = [[' '] * 3 for _ in range(3)]
+        game.current_player = 1
+        game.moves = 0
+        game.winner = None
+        game.make_move(1, 1, 1)
+
+    return run
+
+
+def bench_check_winner():
+    game = _game_with_moves(POSITIONS["late"])
+    return game.check_winner
+
+
+def bench_get_board_display():
+    game = _game_with_moves(POSITIONS["midgame"])
+    return game.get_board_display
+
+
+def bench_get_keyboard():
+    game = _game_with_moves(POSITIONS["midgame"])
+    return game.get_keyboard
+
+
+def _bot_move_bench(func, position):
+    def factory():
+        game = _game_with_moves(POSITIONS[position])
+        return lambda: func(game)
+    return factory
+
+
+def bench_check_winner_7x7():
+    game = main.TicTacToeGame(1, -1, is_vs_bot=True, is_rated=False, size=7, win_length=5)
+    for row, col in [(3, 3), (3, 4), (2, 2), (2, 4), (4, 4), (1, 4)]:
+        game.make_move(row, col, game.current_player)
+    return lambda: game.check_winner(1, 4)
+
+
+def bench_calculate_rating_change():
+    return lambda: main.calculate_rating_change(1250, 640)
+
+
+def bench_get_user_rank():
+    ratings = [0, 150, 450, 800, 1200, 1700, 2500]
+    return lambda: [main.get_user_rank(r) for r in ratings]
+
+
+BENCHMARKS = {
+    "game.make_move": bench_make_move,
+    "game.check_winner": bench_check_winner,
+    "game.get_board_display": bench_get_board_display,
+    "game.get_keyboard": bench_get_keyboard,
+    "game.check_winner[7x7 last move]": bench_check_winner_7x7,
+    "rating.calculate_rating_change": bench_calculate_rating_change,
+    "rating.get_user_rank[x7]": bench_get_user_rank,
+}
+for _position in POSITIONS:
+    BENCHMARKS[f"bot.find_random_move[{_position}]"] = _bot_move_bench(main.find_random_move, _position)
+    BENCHMARKS[f"bot.find_good_move[{_position}]"] = _bot_move_bench(main.find_good_move, _position)
+    BENCHMARKS[f"bot.find_best_move[{_position}]"] = _bot_move_bench(main.find_best_move, _position)
+    BENCHMARKS[f"bot.find_search_move[{_position}]"] = _bot_move_bench(main.find_search_move, _position)
+
+
+def measure(func, repeat: int, min_time: float) -> dict:
+    """Замеряет время одного вызова func (в микросекундах)"""
+    # Подбираем количество вызовов в серии так, чтобы серия длилась не меньше min_time
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) / number * 1e6)
+
+    return {
+        "number": number,
+        "repeat": repeat,
+        "min_us": min(samples),
+        "median_us": statistics.median(samples),
+        "mean_us": statistics.mean(samples),
+        "stdev_us": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(old: dict, new: dict):
+    """Печатает таблицу изменений медианного времени относительно старого прогона"""
+    print(f"\n{'benchmark':45} {'old, us':>10} {'new, us':>10} {'ratio':>8}")
+    for name, result in new["results"].items():
+        old_result = old["results"].get(name)
+        if not old_result:
+            print(f"{name:45} {'-':>10} {result['median_us']:10.3f} {'new':>8}")
+            continue
+        ratio = result["median_us"] / old_result["median_us"] if old_result["median_us"] else 0
+        print(f"{name:45} {old_result['median_us']:10.3f} {result['median_us']:10.3f} {ratio:8.2f}x")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Бенчмарки горячих путей бота")
+    parser.add_argument("-o", "--output", help="файл для сохранения результатов (JSON)")
+    parser.add_argument("-k", "--filter", default="", help="запускать только бенчмарки с этой подстрокой")
+    parser.add_argument("--repeat", type=int, default=7, help="количество серий замеров")
+    parser.add_argument("--min-time", type=float, default=0.05, help="минимальная длительность серии, сек")
+    parser.add_argument("--compare", help="JSON предыдущего прогона для сравнения")
+    args = parser.parse_args()
+
+    results = {}
+    for name, factory in BENCHMARKS.items():
+        if args.filter not in name:
+            continue
+        random.seed(SEED)
+        results[name] = measure(factory(), args.repeat, args.min_time)
+        print(f"{name:45} {results[name]['median_us']:10.3f} us")
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "created_at": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": SEED,
+        },
+        "results": results,
+    }
+
+    output = args.output
+    if not output:
+        os.makedirs(os.path.join(REPO_DIR, "bench_results"), exist_ok=True)
+        output = os.path.join(REPO_DIR, "bench_results", f"{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nРезультаты сохранены в {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,12 +1,31 @@
 import asyncio
+import gzip
+import hashlib
+import inspect
+import io
+import json
+import multiprocessing
 import random
+import re
+import signal
 import sqlite3
+import struct
+import time
+IMPORT_STARTED = time.perf_counter()  # Для замера времени холодного старта
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
 import os
+import sys
 
-from aiogram import Bot, Dispatcher, F, Router
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, InputFile, FSInputFile
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, InputFile, FSInputFile, Update, User, BufferedInputFile, \
+    InputMediaPhoto, InputMediaVideo
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -18,8 +37,19 @@ BOT_TOKEN = os.environ.get("TOKEN")
 
 ADMIN_ID = 5301117772
 
-# Инициализация бота и диспетчера
-bot = Bot(token=str(BOT_TOKEN))
+# Настройки webhook (если WEBHOOK_URL не задан - бот работает через long polling)
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # Внешний адрес, например https://example.com
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBAPP_HOST = os.environ.get("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.environ.get("WEBAPP_PORT", "8080"))
+WEBHOOK_MAX_IN_FLIGHT = int(os.environ.get("WEBHOOK_MAX_IN_FLIGHT", "100"))  # Одновременно обрабатываемых апдейтов
+
+# Количество процессов-шардов с игровыми сессиями (1 - всё в одном процессе)
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", "1"))
+
+# Инициализация бота и диспетчера (сам бот создается в startup(), чтобы импорт модуля был без побочных эффектов)
+bot: Optional[Bot] = None
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 router = Router()
@@ -29,6 +59,15 @@ dp.include_router(router)
 REF_REQUIRED_GAMES = 3
 REF_REQUIRED_RANK = "Любитель"
 REF_FOR_ROULETTE = 10
+# Призы рулетки: (тип, название, вес в процентах). Для типа "status" название выбирается из STATUSES
+ROULETTE_PRIZES = [
+    ("nft", "NFT подарок", 0.1),
+    ("gift", "Обычный подарок", 10),
+    ("gift", "Мишка", 5),
+    ("gift", "Сердечко", 5),
+    ("nothing", "Ничего", 30),
+    ("status", "Статус", 49.9),
+]
 STATUSES = [
     "Путь", "Рост", "Цель", "Форсаж", "Бросок", "Вершина", "Легенда", "Тактик",
     "Гений", "Стихия", "Ход", "Калькулятор", "Блиц", "Вызов", "Вихрь", "Феникс",
@@ -40,9 +79,17 @@ DEFAULT_STATUS = "без статуса"
 # Таймаут хода в игре (в секундах)
 MOVE_TIMEOUT = 60  # 1 минута
 
+# Матчмейкинг
+MATCHMAKING_WAIT = 5  # Сколько секунд ищем соперника перед игрой с ботом
+MATCHMAKING_RATING_RANGE = 300  # Допустимая разница рейтинга соперников
+
+
+DB_PATH = 'tictactoe.db'
+DB_BUSY_TIMEOUT = 30  # Сколько секунд ждем, пока другой процесс (шард, rerate) отпустит блокировку базы
+
 
 def get_db_connection():
-    return sqlite3.connect('tictactoe.db')
+    return sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT)
 
 
 # Инициализация SQLite базы данных
@@ -62,7 +109,9 @@ def init_db():
             draws INTEGER DEFAULT 0,
             registered_at TEXT,
             last_game_at TEXT,
-            is_blocked BOOLEAN DEFAULT FALSE
+            is_blocked BOOLEAN DEFAULT FALSE,
+            active_status TEXT,
+            username_key TEXT
         )
     ''')
 
@@ -77,7 +126,9 @@ def init_db():
             board_state TEXT,
             current_player INTEGER,
             created_at TEXT,
-            last_move_time TEXT
+            last_move_time TEXT,
+            finished_at TEXT,
+            winner INTEGER
         )
     ''')
 
@@ -124,6 +175,52 @@ def init_db():
             PRIMARY KEY (referrer_id, referred_id)
         )
     ''')
+    # Незавершенные рефералы игрока (обновляются после каждой игры)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_referrals_pending
+        ON referrals (referred_id) WHERE is_completed = FALSE
+    ''')
+
+    # Счетчики рефералов пользователя. Поддерживаются триггерами при любом изменении referrals
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS referral_counts (
+            user_id INTEGER PRIMARY KEY,
+            completed INTEGER DEFAULT 0,
+            pending INTEGER DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_referrals_insert AFTER INSERT ON referrals
+        BEGIN
+            INSERT INTO referral_counts (user_id, completed, pending)
+            VALUES (NEW.referrer_id, NEW.is_completed != 0, NEW.is_completed = 0)
+            ON CONFLICT (user_id) DO UPDATE
+            SET completed = completed + excluded.completed, pending = pending + excluded.pending;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_referrals_update AFTER UPDATE OF is_completed ON referrals
+        WHEN OLD.is_completed != NEW.is_completed
+        BEGIN
+            UPDATE referral_counts
+            SET completed = completed + (NEW.is_completed != 0) - (OLD.is_completed != 0),
+                pending = pending + (NEW.is_completed = 0) - (OLD.is_completed = 0)
+            WHERE user_id = NEW.referrer_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_referrals_delete AFTER DELETE ON referrals
+        BEGIN
+            UPDATE referral_counts
+            SET completed = completed - (OLD.is_completed != 0), pending = pending - (OLD.is_completed = 0)
+            WHERE user_id = OLD.referrer_id;
+        END
+    ''')
+    # Пересчитываем счетчики по существующим рефералам (при каждом обновлении схемы)
+    cursor.execute('''
+        INSERT OR REPLACE INTO referral_counts (user_id, completed, pending)
+        SELECT referrer_id, SUM(is_completed != 0), SUM(is_completed = 0) FROM referrals GROUP BY referrer_id
+    ''')
 
     # Таблица инвентаря
     cursor.execute('''
@@ -137,6 +234,14 @@ def init_db():
         )
     ''')
 
+    # Потраченные прокрутки рулетки (заработанные считаются по завершенным рефералам)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS roulette_spins (
+            user_id INTEGER PRIMARY KEY,
+            consumed INTEGER DEFAULT 0
+        )
+    ''')
+
     # Таблица статусов
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS user_statuses (
@@ -148,6 +253,35 @@ def init_db():
         )
     ''')
 
+    # Журнал ходов: упакованные пачки ходов, первичный ключ - игра и номер первого хода в пачке
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS game_moves (
+            game_id TEXT,
+            first_ply INTEGER,
+            records BLOB,
+            PRIMARY KEY (game_id, first_ply)
+        )
+    ''')
+
+    # file_id уже загруженных в Telegram картинок по хешу их содержимого
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS image_cache (
+            content_hash TEXT PRIMARY KEY,
+            file_id TEXT,
+            created_at TEXT
+        )
+    ''')
+
+    # Активные игры, сохраненные при остановке бота (восстанавливаются при следующем запуске)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS active_games (
+            game_id TEXT PRIMARY KEY,
+            state TEXT,
+            time_left REAL,
+            saved_at TEXT
+        )
+    ''')
+
     conn.commit()
     conn.close()
 
@@ -169,6 +303,26 @@ def upgrade_db():
                 cursor.execute('ALTER TABLE users ADD COLUMN last_game_at TEXT')
             if 'is_blocked' not in columns:
                 cursor.execute('ALTER TABLE users ADD COLUMN is_blocked BOOLEAN DEFAULT FALSE')
+            if 'active_status' not in columns:
+                # Активный статус хранится прямо у пользователя, переносим его из user_statuses
+                cursor.execute('ALTER TABLE users ADD COLUMN active_status TEXT')
+                cursor.execute('''
+                    UPDATE users SET active_status = (
+                        SELECT status_name FROM user_statuses
+                        WHERE user_statuses.user_id = users.user_id AND is_active = TRUE
+                    )
+                ''')
+            if 'username_key' not in columns:
+                cursor.execute('ALTER TABLE users ADD COLUMN username_key TEXT')
+            # COLLATE NOCASE и lower() в SQLite знают только латиницу, поэтому ключ считаем в Python
+            cursor.execute('SELECT user_id, username FROM users WHERE username_key IS NULL AND username IS NOT NULL')
+            cursor.executemany('UPDATE users SET username_key = ? WHERE user_id = ?',
+                               [(username_key(username), user_id) for user_id, username in cursor.fetchall()])
+            # Позиция в рейтинге и топ игроков
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_ranking ON users (is_blocked, rating)')
+            # Поиск по username без учета регистра (блокировка из админ-панели)
+            cursor.execute('DROP INDEX IF EXISTS idx_users_username')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_username_key ON users (username_key)')
 
         # Проверяем существование таблицы game_sessions и добавляем last_move_time
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='game_sessions'")
@@ -177,6 +331,11 @@ def upgrade_db():
             columns = [column[1] for column in cursor.fetchall()]
             if 'last_move_time' not in columns:
                 cursor.execute('ALTER TABLE game_sessions ADD COLUMN last_move_time TEXT')
+            if 'finished_at' not in columns:
+                cursor.execute('ALTER TABLE game_sessions ADD COLUMN finished_at TEXT')
+            if 'winner' not in columns:
+                cursor.execute('ALTER TABLE game_sessions ADD COLUMN winner INTEGER')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_game_sessions_finished_at ON game_sessions (finished_at)')
 
         # Создаем таблицу broadcasts если не существует
         cursor.execute('''
@@ -223,6 +382,18 @@ def upgrade_db():
             )
         ''')
 
+        # Создаем таблицу game_moves если не существует
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS game_moves (
+                game_id TEXT,
+                first_ply INTEGER,
+                records BLOB,
+                PRIMARY KEY (game_id, first_ply)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_game_sessions_player1 ON game_sessions (player1, last_move_time)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_game_sessions_player2 ON game_sessions (player2, last_move_time)')
+
     except Exception as e:
         print(f"Ошибка при обновлении базы данных: {e}")
 
@@ -230,11 +401,38 @@ def upgrade_db():
     conn.close()
 
 
-# Инициализируем и обновляем базу данных
-init_db()
-upgrade_db()
+# Версия схемы базы данных. Увеличивайте при каждом изменении init_db/upgrade_db
+SCHEMA_VERSION = 10
+
+
+def setup_database() -> bool:
+    """Создает и обновляет схему, только если сохраненная версия отличается. Возвращает True, если схема обновлялась"""
+    conn = get_db_connection()
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    conn.close()
+    if version == SCHEMA_VERSION:
+        return False
+
+    init_db()
+    upgrade_db()
+
+    conn = get_db_connection()
+    # Режим incremental включается только полным VACUUM: делаем его один раз здесь, до приема апдейтов,
+    # а обслуживание потом освобождает страницы порциями
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+    conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    conn.commit()
+    conn.close()
+    return True
 
 # Настройки рейтинга
+# Модель рейтинга: "classic" - фиксированное изменение по рангу, "elo" - учитывает силу соперника
+RATING_MODEL = os.environ.get("RATING_MODEL", "classic")
+ELO_K = int(os.environ.get("ELO_K", "32"))
+NEW_USER_RATING = 100  # Рейтинг при регистрации и стартовый рейтинг пакетного пересчета
+RATING_PERIOD_HOURS = 24  # Длина периода при пакетном пересчете рейтинга
 RATING_CHANGE_BASE = 25
 RANKS = {
     1: {"name": "Новичок", "min_rating": 0, "win_multiplier": 1.5, "lose_multiplier": 0.5, "bot_difficulty": 1},
@@ -277,13 +475,37 @@ class AdminStates(StatesGroup):
     waiting_stats_period = State()
 
 
+# Компактное представление клеток поля для внешнего хранилища
+CELL_CODES = {' ': '.', '❌': 'x', '⭕': 'o'}
+
+# Варианты поля: ключ -> (размер, символов подряд для победы).
+# Telegram допускает не больше 8 кнопок в ряду и 100 кнопок в клавиатуре (+1 кнопка "Сдаться")
+BOARD_VARIANTS = {
+    "3": (3, 3),
+    "5": (5, 4),
+    "7": (7, 5),
+}
+assert all(size <= 8 and size * size + 1 <= 100 for size, _ in BOARD_VARIANTS.values())
+
+# Время на обдумывание хода ботом с поиском (секунды)
+BOT_SEARCH_TIME = 1.0
+# Поиск выполняется в отдельных процессах, чтобы не блокировать обработку остальных апдейтов
+# (0 - без пула процессов: поиск идет в потоке, медленнее из-за GIL, но цикл событий не блокируется)
+BOT_SEARCH_WORKERS = int(os.environ.get("BOT_SEARCH_WORKERS", "2"))
+BOT_SEARCH_DEADLINE = BOT_SEARCH_TIME + 0.5  # С учетом ожидания в очереди пула
+BOT_SEARCH_POOL_START_TIMEOUT = 60  # Сколько ждем запуска процессов пула (spawn импортирует main.py заново)
+
+
 class TicTacToeGame:
-    def __init__(self, player1: int, player2: int, is_vs_bot: bool = False, is_rated: bool = True):
+    def __init__(self, player1: int, player2: int, is_vs_bot: bool = False, is_rated: bool = True,
+                 size: int = 3, win_length: int = 3):
         self.player1 = player1
         self.player2 = player2
         self.is_vs_bot = is_vs_bot
         self.is_rated = is_rated
-        self.board = [[' ' for _ in range(3)] for _ in range(3)]
+        self.size = size  # Размер поля size x size
+        self.win_length = win_length  # Сколько символов подряд нужно для победы
+        self.board = [[' ' for _ in range(size)] for _ in range(size)]
         self.current_player = player1
         self.symbols = {player1: '❌', player2: '⭕'}
         self.winner = None
@@ -294,39 +516,45 @@ class TicTacToeGame:
         self.timeout_task = None  # Задача для таймаута
 
     def make_move(self, row: int, col: int, player_id: int) -> bool:
-        if self.board[row][col] != ' ' or player_id != self.current_player:
+        if not (0 <= row < self.size and 0 <= col < self.size):
+            return False
+        if self.winner or self.board[row][col] != ' ' or player_id != self.current_player:
             return False
 
         self.board[row][col] = self.symbols[player_id]
         self.moves += 1
         self.current_player = self.player2 if self.current_player == self.player1 else self.player1
         self.last_move_time = datetime.now()  # Обновляем время последнего хода
-        self.check_winner()
+        self.check_winner(row, col)
         return True
 
-    def check_winner(self):
-        # Проверка строк
-        for row in self.board:
-            if row[0] == row[1] == row[2] != ' ':
-                self.winner = self.player1 if row[0] == self.symbols[self.player1] else self.player2
-                return
-
-        # Проверка столбцов
-        for col in range(3):
-            if self.board[0][col] == self.board[1][col] == self.board[2][col] != ' ':
-                self.winner = self.player1 if self.board[0][col] == self.symbols[self.player1] else self.player2
-                return
+    def _line_length(self, row: int, col: int, dr: int, dc: int) -> int:
+        """Длина линии одинаковых символов через клетку (row, col) в направлении (dr, dc)"""
+        symbol = self.board[row][col]
+        length = 1
+        for sign in (1, -1):
+            r, c = row + dr * sign, col + dc * sign
+            while 0 <= r < self.size and 0 <= c < self.size and self.board[r][c] == symbol:
+                length += 1
+                r += dr * sign
+                c += dc * sign
+        return length
+
+    def check_winner(self, row: int = None, col: int = None):
+        """Проверяет победу. Если известен последний ход - смотрим только линии через него"""
+        if row is None:
+            cells = [(r, c) for r in range(self.size) for c in range(self.size) if self.board[r][c] != ' ']
+        else:
+            cells = [(row, col)]
 
-        # Проверка диагоналей
-        if self.board[0][0] == self.board[1][1] == self.board[2][2] != ' ':
-            self.winner = self.player1 if self.board[0][0] == self.symbols[self.player1] else self.player2
-            return
-        if self.board[0][2] == self.board[1][1] == self.board[2][0] != ' ':
-            self.winner = self.player1 if self.board[0][2] == self.symbols[self.player1] else self.player2
-            return
+        for r, c in cells:
+            for dr, dc in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                if self._line_length(r, c, dr, dc) >= self.win_length:
+                    self.winner = self.player1 if self.board[r][c] == self.symbols[self.player1] else self.player2
+                    return
 
         # Ничья
-        if self.moves == 9:
+        if self.moves == self.size * self.size:
             self.winner = 'draw'
 
     def get_board_display(self) -> str:
@@ -341,13 +569,14 @@ class TicTacToeGame:
             board_str += row_str + "\n"
         return board_str
 
-    def get_keyboard(self) -> InlineKeyboardMarkup:
+    def get_keyboard(self, game_id: str = "") -> InlineKeyboardMarkup:
         keyboard = []
-        for i in range(3):
+        for i in range(self.size):
             row = []
-            for j in range(3):
+            for j in range(self.size):
                 if self.board[i][j] == ' ':
-                    row.append(InlineKeyboardButton(text="⬜️", callback_data=f"move_{i}_{j}"))
+                    # id игры в кнопке избавляет от поиска игры пользователя при ходе
+                    row.append(InlineKeyboardButton(text="⬜️", callback_data=f"m:{i}:{j}:{game_id}"))
                 else:
                     row.append(InlineKeyboardButton(text=self.board[i][j], callback_data="empty"))
             keyboard.append(row)
@@ -363,16 +592,58 @@ class TicTacToeGame:
 
         board_state = '|'.join([''.join(row) for row in self.board])
 
+        # UPSERT, а не REPLACE: created_at, finished_at и winner уже сохраненной игры не сбрасываются
         cursor.execute('''
-            INSERT OR REPLACE INTO game_sessions 
+            INSERT INTO game_sessions 
             (game_id, player1, player2, is_vs_bot, is_rated, board_state, current_player, created_at, last_move_time)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (game_id) DO UPDATE SET
+                board_state = excluded.board_state, current_player = excluded.current_player,
+                last_move_time = excluded.last_move_time
         ''', (game_id, self.player1, self.player2, self.is_vs_bot, self.is_rated,
               board_state, self.current_player, datetime.now().isoformat(), self.last_move_time.isoformat()))
 
         conn.commit()
         conn.close()
 
+    def to_compact(self) -> Dict[str, str]:
+        """Сериализует состояние игры в плоский словарь строк (поля хеша в хранилище)"""
+        return {
+            'p1': str(self.player1),
+            'p2': str(self.player2),
+            'flags': str(int(self.is_vs_bot) | int(self.is_rated) << 1),
+            'size': str(self.size),
+            'win': str(self.win_length),
+            'board': ''.join(CELL_CODES[cell] for row in self.board for cell in row),
+            'cur': str(self.current_player),
+            'moves': str(self.moves),
+            'bot': self.bot_name or '',
+            'ts': str(int(self.last_move_time.timestamp() * 1000)),
+            'msg': ','.join(f"{uid}:{mid}" for uid, mid in self.message_ids.items()),
+            'done': str(self.winner) if self.winner else ''
+        }
+
+    @classmethod
+    def from_compact(cls, data: Dict[str, str]) -> 'TicTacToeGame':
+        """Восстанавливает игру из результата to_compact"""
+        flags = int(data['flags'])
+        size = int(data.get('size', 3))
+        game = cls(int(data['p1']), int(data['p2']), is_vs_bot=bool(flags & 1), is_rated=bool(flags & 2),
+                   size=size, win_length=int(data.get('win', 3)))
+        marks = {'.': ' ', 'x': game.symbols[game.player1], 'o': game.symbols[game.player2]}
+        board = data['board']
+        game.board = [[marks[board[i * size + j]] for j in range(size)] for i in range(size)]
+        game.current_player = int(data['cur'])
+        game.moves = int(data['moves'])
+        game.bot_name = data['bot'] or None
+        game.last_move_time = datetime.fromtimestamp(int(data['ts']) / 1000)
+        if data['msg']:
+            for pair in data['msg'].split(','):
+                uid, mid = pair.split(':')
+                game.message_ids[int(uid)] = int(mid)
+        game.check_winner()
+        return game
+
 
 def get_user_rank(rating: int) -> dict:
     for rank_id in sorted(RANKS.keys(), reverse=True):
@@ -381,7 +652,18 @@ def get_user_rank(rating: int) -> dict:
     return RANKS[1]
 
 
+def elo_expected_score(rating: float, opponent_rating: float) -> float:
+    """Ожидаемый результат игрока против соперника по Эло"""
+    return 1 / (1 + 10 ** ((opponent_rating - rating) / 400))
+
+
 def calculate_rating_change(winner_rating: int, loser_rating: int, is_draw: bool = False) -> Tuple[int, int]:
+    if RATING_MODEL == "elo":
+        # Победитель получает столько же, сколько теряет проигравший (при ничьей изменение может быть отрицательным)
+        score = 0.5 if is_draw else 1.0
+        change = round(ELO_K * (score - elo_expected_score(winner_rating, loser_rating)))
+        return change, change
+
     if is_draw:
         return 0, 0
 
@@ -405,19 +687,29 @@ def get_global_ranking() -> List[Tuple[int, str, int]]:
     return ranked_users
 
 
-def get_user_position(user_id: int) -> int:
-    conn = get_db_connection()
-    cursor = conn.cursor()
+# Позиция игрока: сколько незаблокированных игроков с рейтингом выше (по индексу idx_users_ranking)
+POSITION_SUBQUERY = 'SELECT COUNT(*) + 1 FROM users AS r WHERE r.is_blocked = FALSE AND r.rating > users.rating'
 
-    cursor.execute('SELECT user_id, rating FROM users WHERE is_blocked = FALSE ORDER BY rating DESC')
-    ranked_users = cursor.fetchall()
 
-    conn.close()
+def username_key(username: Optional[str]) -> Optional[str]:
+    """Ключ поиска по username без учета регистра (в том числе для кириллицы)"""
+    return username.casefold() if username is not None else None
+
 
-    for i, (uid, _) in enumerate(ranked_users, 1):
-        if uid == user_id:
-            return i
-    return len(ranked_users) + 1
+def user_row_to_dict(user: tuple) -> dict:
+    return {
+        'user_id': user[0],
+        'username': user[1],
+        'rating': user[2],
+        'games_played': user[3],
+        'wins': user[4],
+        'losses': user[5],
+        'draws': user[6],
+        'registered_at': user[7],
+        'last_game_at': user[8],
+        'is_blocked': bool(user[9]) if user[9] is not None else False,
+        'active_status': user[10]
+    }
 
 
 def get_user_data(user_id: int) -> dict:
@@ -430,38 +722,80 @@ def get_user_data(user_id: int) -> dict:
     conn.close()
 
     if user:
-        return {
-            'user_id': user[0],
-            'username': user[1],
-            'rating': user[2],
-            'games_played': user[3],
-            'wins': user[4],
-            'losses': user[5],
-            'draws': user[6],
-            'registered_at': user[7],
-            'last_game_at': user[8],
-            'is_blocked': bool(user[9]) if user[9] is not None else False
-        }
+        return user_row_to_dict(user)
     return None
 
 
+# Готовые тексты профилей. Сбрасываются при изменении статистики или статуса пользователя,
+# TTL нужен потому, что позиция в рейтинге зависит и от других игроков
+PROFILE_CACHE_TTL = 60
+PROFILE_CACHE_SIZE = 10000
+profile_cache = {}  # user_id -> (время истечения, текст профиля)
+
+
+def invalidate_profile_cache(user_id: Optional[int] = None):
+    """Сбрасывает кэш профиля пользователя (None - всех)"""
+    if user_id is None:
+        profile_cache.clear()
+    else:
+        profile_cache.pop(user_id, None)
+
+
+def get_profile_data(user_id: int) -> Optional[dict]:
+    """Данные пользователя, активный статус и позиция в рейтинге одним запросом"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute(f'SELECT *, ({POSITION_SUBQUERY}) FROM users WHERE user_id = ?', (user_id,))
+    user = cursor.fetchone()
+
+    conn.close()
+
+    if not user:
+        return None
+    profile = user_row_to_dict(user)
+    profile['position'] = user[-1]
+    return profile
+
+
 def save_user_data(user_data: dict):
     conn = get_db_connection()
     cursor = conn.cursor()
 
+    # UPSERT, а не REPLACE: иначе колонки, которых нет в списке (active_status), сбрасывались бы
     cursor.execute('''
-        INSERT OR REPLACE INTO users 
-        (user_id, username, rating, games_played, wins, losses, draws, registered_at, last_game_at, is_blocked)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        INSERT INTO users 
+        (user_id, username, rating, games_played, wins, losses, draws, registered_at, last_game_at, is_blocked, username_key)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            username = excluded.username, username_key = excluded.username_key,
+            rating = excluded.rating, games_played = excluded.games_played,
+            wins = excluded.wins, losses = excluded.losses, draws = excluded.draws,
+            registered_at = excluded.registered_at, last_game_at = excluded.last_game_at,
+            is_blocked = excluded.is_blocked
     ''', (
         user_data['user_id'], user_data['username'], user_data['rating'],
         user_data['games_played'], user_data['wins'], user_data['losses'],
         user_data['draws'], user_data['registered_at'],
-        user_data.get('last_game_at'), user_data.get('is_blocked', False)
+        user_data.get('last_game_at'), user_data.get('is_blocked', False), username_key(user_data['username'])
     ))
 
     conn.commit()
     conn.close()
+    invalidate_profile_cache(user_data['user_id'])
+
+
+def update_username(user_id: int, username: str):
+    """Обновляет username, если пользователь его сменил"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('UPDATE users SET username = ?, username_key = ? WHERE user_id = ? AND username IS NOT ?',
+                   (username, username_key(username), user_id, username))
+
+    conn.commit()
+    conn.close()
+    invalidate_profile_cache(user_id)
 
 
 def update_last_game_time(user_id: int):
@@ -472,19 +806,38 @@ def update_last_game_time(user_id: int):
         save_user_data(user_data)
 
 
+SEEN_CHATS_SIZE = 100000
+seen_chats = {}  # chat_id -> (тип, название, участники), уже записанные в bot_chats этим процессом
+
+
 def save_chat_info(chat_id: int, chat_type: str, title: str = None, members_count: int = 0):
+    """Регистрирует чат. added_at не перезаписывается, повторный вызов без изменений не пишет в базу"""
+    info = (chat_type, title, members_count)
+    if seen_chats.get(chat_id) == info:
+        return
+
     conn = get_db_connection()
     cursor = conn.cursor()
 
     cursor.execute('''
-        INSERT OR REPLACE INTO bot_chats 
-        (chat_id, chat_type, title, members_count, added_at)
+        INSERT INTO bot_chats (chat_id, chat_type, title, members_count, added_at)
         VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(chat_id) DO UPDATE SET
+            chat_type = excluded.chat_type,
+            title = excluded.title,
+            members_count = excluded.members_count
+        WHERE chat_type IS NOT excluded.chat_type
+            OR title IS NOT excluded.title
+            OR members_count IS NOT excluded.members_count
     ''', (chat_id, chat_type, title, members_count, datetime.now().isoformat()))
 
     conn.commit()
     conn.close()
 
+    if len(seen_chats) >= SEEN_CHATS_SIZE:
+        seen_chats.clear()
+    seen_chats[chat_id] = info
+
 
 def get_all_chats():
     conn = get_db_connection()
@@ -560,30 +913,79 @@ def get_stats(period_hours: int):
     }
 
 
-def block_user(username: str):
-    """Блокирует пользователя по username"""
+BLOCKED_USERS_REFRESH = 60  # Секунды. Подхватывает блокировки, сделанные в других процессах (шардах)
+blocked_users = set()  # user_id заблокированных пользователей (копия users.is_blocked)
+
+
+def load_blocked_users():
+    """Загружает множество заблокированных пользователей из базы"""
+    global blocked_users
     conn = get_db_connection()
     cursor = conn.cursor()
 
-    cursor.execute('UPDATE users SET is_blocked = TRUE WHERE username = ?', (username,))
-    success = cursor.rowcount > 0
+    cursor.execute('SELECT user_id FROM users WHERE is_blocked = TRUE')
+    blocked_users = {row[0] for row in cursor.fetchall()}
 
-    conn.commit()
     conn.close()
-    return success
 
 
-def unblock_user(username: str):
-    """Разблокирует пользователя по username"""
+async def periodic_blocked_users_refresh():
+    while True:
+        await asyncio.sleep(BLOCKED_USERS_REFRESH)
+        try:
+            load_blocked_users()
+        except Exception as e:
+            print(f"Ошибка загрузки заблокированных пользователей: {e}")
+
+
+# Явная ссылка на ID: "id:123" или "#123"
+USER_ID_REF = re.compile(r'(?:id:|#)\s*(\d+)', re.IGNORECASE)
+
+
+def parse_user_refs(text: str) -> List[str]:
+    """Разбирает список пользователей: по одному на строке или через запятую.
+    Пробелы внутри ссылки сохраняются - имена из нескольких слов не разбиваются"""
+    refs = [ref.strip().lstrip('@').strip() for ref in re.split(r'[\n,;]+', text)]
+    return list(dict.fromkeys(ref for ref in refs if ref))
+
+
+def set_users_blocked(refs: List[str], blocked: bool) -> Tuple[List[Tuple[int, str]], List[str]]:
+    """Блокирует или разблокирует пользователей по username (без учета регистра) или ID одной транзакцией.
+    Ссылка считается ID, если у нее есть префикс id:/# или если такого username нет.
+    Возвращает найденных пользователей (user_id, username) и ненайденные ссылки"""
+    found = {}
+    not_found = []
+
     conn = get_db_connection()
     cursor = conn.cursor()
 
-    cursor.execute('UPDATE users SET is_blocked = FALSE WHERE username = ?', (username,))
-    success = cursor.rowcount > 0
+    for ref in refs:
+        id_ref = USER_ID_REF.fullmatch(ref)
+        if id_ref:
+            cursor.execute('UPDATE users SET is_blocked = ? WHERE user_id = ? RETURNING user_id, username',
+                           (blocked, int(id_ref.group(1))))
+        else:
+            cursor.execute('UPDATE users SET is_blocked = ? WHERE username_key = ? RETURNING user_id, username',
+                           (blocked, username_key(ref)))
+        rows = cursor.fetchall()
+        if not rows and not id_ref and ref.isdigit():
+            cursor.execute('UPDATE users SET is_blocked = ? WHERE user_id = ? RETURNING user_id, username',
+                           (blocked, int(ref)))
+            rows = cursor.fetchall()
+        if not rows:
+            not_found.append(ref)
+        found.update(rows)
 
     conn.commit()
     conn.close()
-    return success
+
+    if blocked:
+        blocked_users.update(found)
+    else:
+        blocked_users.difference_update(found)
+    for user_id in found:
+        invalidate_profile_cache(user_id)
+    return list(found.items()), not_found
 
 
 def save_broadcast_stats(success_count: int, fail_count: int):
@@ -642,131 +1044,224 @@ def mark_invite_used(invite_code: str, used_by: int):
     conn.close()
 
 
-def is_user_in_game(user_id: int) -> bool:
+async def is_user_in_game(user_id: int) -> bool:
     """Проверяет, находится ли пользователь в активной игре"""
-    for game in game_sessions.values():
-        if user_id in [game.player1, game.player2]:
-            return True
-    return False
+    return await state_store.find_player_game(user_id) is not None
 
 
-# РЕФЕРАЛЬНАЯ СИСТЕМА - ФУНКЦИИ
-def get_referral_data(referrer_id: int, referred_id: int):
-    """Получает данные о реферале"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+# ДАННЫЕ БОТА И ССЫЛКИ
+# username и id бота запрашиваются один раз при старте и изредка обновляются в фоне
+BOT_INFO_REFRESH = 6 * 60 * 60
+bot_info: Optional[User] = None
 
-    cursor.execute('''
-        SELECT * FROM referrals 
-        WHERE referrer_id = ? AND referred_id = ?
-    ''', (referrer_id, referred_id))
 
-    result = cursor.fetchone()
-    conn.close()
+async def refresh_bot_info() -> User:
+    global bot_info
+    bot_info = await bot.get_me()
+    return bot_info
+
+
+async def get_bot_info() -> User:
+    """Возвращает данные бота из кэша (в процессах-шардах запрашиваются при первом обращении)"""
+    if bot_info is None:
+        return await refresh_bot_info()
+    return bot_info
 
-    if result:
-        return {
-            'referrer_id': result[0],
-            'referred_id': result[1],
-            'games_played': result[2],
-            'is_completed': bool(result[3]),
-            'created_at': result[4]
-        }
-    return None
 
+async def build_start_link(payload: str) -> str:
+    """Ссылка на бота с параметром /start"""
+    return f"https://t.me/{(await get_bot_info()).username}?start={payload}"
 
+
+async def periodic_bot_info_refresh():
+    while True:
+        await asyncio.sleep(BOT_INFO_REFRESH)
+        try:
+            await refresh_bot_info()
+        except Exception as e:
+            print(f"Ошибка обновления данных бота: {e}")
+
+
+# РЕФЕРАЛЬНАЯ СИСТЕМА - ФУНКЦИИ
 def create_referral(referrer_id: int, referred_id: int):
     """Создает запись о реферале"""
     conn = get_db_connection()
     cursor = conn.cursor()
 
+    # Существующий реферал не трогаем: сброс завершенного уменьшил бы счетчики и отнял прокрутки
     cursor.execute('''
-        INSERT OR REPLACE INTO referrals 
+        INSERT INTO referrals 
         (referrer_id, referred_id, games_played, is_completed, created_at)
         VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (referrer_id, referred_id) DO NOTHING
     ''', (referrer_id, referred_id, 0, False, datetime.now().isoformat()))
 
     conn.commit()
     conn.close()
 
 
-def update_referral_games(referrer_id: int, referred_id: int):
-    """Обновляет количество сыгранных игр рефералом"""
+def advance_referrals(player_ids: List[int]) -> List[dict]:
+    """Засчитывает сыгранную игру во все незавершенные рефералы игроков одним запросом.
+    Рефералы, выполнившие условия, отмечаются завершенными в том же запросе и возвращаются"""
+    required_rating = next(rank["min_rating"] for rank in RANKS.values() if rank["name"] == REF_REQUIRED_RANK)
+    placeholders = ','.join('?' * len(player_ids))
     conn = get_db_connection()
     cursor = conn.cursor()
 
-    cursor.execute('''
-        UPDATE referrals 
-        SET games_played = games_played + 1 
-        WHERE referrer_id = ? AND referred_id = ?
-    ''', (referrer_id, referred_id))
+    # В SET и WHERE games_played - значение до обновления, в RETURNING - после
+    cursor.execute(f'''
+        UPDATE referrals
+        SET games_played = games_played + 1,
+            is_completed = (
+                games_played + 1 >= ?
+                AND IFNULL((SELECT rating FROM users WHERE user_id = referred_id), 0) >= ?
+            )
+        WHERE referred_id IN ({placeholders}) AND is_completed = FALSE
+        RETURNING referrer_id, referred_id, games_played, is_completed,
+                  (SELECT username FROM users WHERE user_id = referred_id),
+                  (SELECT rating FROM users WHERE user_id = referred_id)
+    ''', (REF_REQUIRED_GAMES, required_rating, *player_ids))
+    completed = [
+        {'referrer_id': row[0], 'referred_id': row[1], 'games_played': row[2], 'username': row[4], 'rating': row[5]}
+        for row in cursor.fetchall() if row[3]
+    ]
 
     conn.commit()
     conn.close()
+    return completed
 
 
-def complete_referral(referrer_id: int, referred_id: int):
-    """Отмечает реферала как завершенного"""
+def get_referral_counts(referrer_id: int) -> Tuple[int, int]:
+    """Получает количество завершенных и незавершенных рефералов"""
     conn = get_db_connection()
     cursor = conn.cursor()
 
-    cursor.execute('''
-        UPDATE referrals 
-        SET is_completed = TRUE 
-        WHERE referrer_id = ? AND referred_id = ?
-    ''', (referrer_id, referred_id))
+    cursor.execute('SELECT completed, pending FROM referral_counts WHERE user_id = ?', (referrer_id,))
 
-    conn.commit()
+    result = cursor.fetchone()
     conn.close()
+    return result if result else (0, 0)
 
 
 def get_completed_referrals_count(referrer_id: int) -> int:
     """Получает количество завершенных рефералов"""
+    return get_referral_counts(referrer_id)[0]
+
+
+def get_available_spins(user_id: int) -> int:
+    """Заработанные (по завершенным рефералам) минус потраченные прокрутки рулетки"""
     conn = get_db_connection()
     cursor = conn.cursor()
 
     cursor.execute('''
-        SELECT COUNT(*) FROM referrals 
-        WHERE referrer_id = ? AND is_completed = TRUE
-    ''', (referrer_id,))
+        SELECT IFNULL((SELECT completed FROM referral_counts WHERE user_id = ?), 0) / ?
+             - IFNULL((SELECT consumed FROM roulette_spins WHERE user_id = ?), 0)
+    ''', (user_id, REF_FOR_ROULETTE, user_id))
 
-    count = cursor.fetchone()[0]
+    available = cursor.fetchone()[0]
     conn.close()
-    return count
+    return max(available, 0)
 
 
-def get_pending_referrals_count(referrer_id: int) -> int:
-    """Получает количество незавершенных рефералов"""
+def spend_spins(user_id: int, count: int) -> Optional[List[dict]]:
+    """Списывает count прокруток и выдает выпавшие призы одной транзакцией.
+    Возвращает список призов или None, если прокруток не хватает"""
     conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
 
+    cursor.execute('INSERT OR IGNORE INTO roulette_spins (user_id, consumed) VALUES (?, 0)', (user_id,))
     cursor.execute('''
-        SELECT COUNT(*) FROM referrals 
-        WHERE referrer_id = ? AND is_completed = FALSE
-    ''', (referrer_id,))
+        UPDATE roulette_spins SET consumed = consumed + ?
+        WHERE user_id = ?
+          AND consumed + ? <= IFNULL((SELECT completed FROM referral_counts WHERE user_id = ?), 0) / ?
+    ''', (count, user_id, count, user_id, REF_FOR_ROULETTE))
+    if cursor.rowcount == 0:
+        conn.rollback()
+        conn.close()
+        return None
+
+    prizes = [spin_roulette() for _ in range(count)]
+    grants = {}
+    for prize in prizes:
+        if prize['type'] != 'nothing':
+            key = (prize['type'], prize['name'])
+            grants[key] = grants.get(key, 0) + 1
+
+    now = datetime.now().isoformat()
+    cursor.executemany(INVENTORY_UPSERT, [(user_id, item_type, item_name, quantity, now)
+                                          for (item_type, item_name), quantity in grants.items()])
+    # Выпавшие статусы пополняют коллекцию (/mystatus)
+    cursor.executemany('''
+        INSERT OR IGNORE INTO user_statuses (user_id, status_name, is_active, obtained_at) VALUES (?, ?, FALSE, ?)
+    ''', [(user_id, item_name, now) for item_type, item_name in grants if item_type == 'status'])
+
+    conn.commit()
+    conn.close()
+    invalidate_inventory_cache([user_id])
+    return prizes
+
+
+INVENTORY_CACHE_TTL = 60  # Секунды. Кэш сбрасывается при выдаче предметов, TTL страхует от выдачи в другом процессе
+INVENTORY_CACHE_SIZE = 10000
+inventory_cache = {}  # user_id -> (время истечения, предметы)
+
+# Начисление предмета: строка создается или количество увеличивается на месте, без удаления строки
+INVENTORY_UPSERT = '''
+    INSERT INTO inventory (user_id, item_type, item_name, quantity, obtained_at)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (user_id, item_type, item_name) DO UPDATE
+    SET quantity = quantity + excluded.quantity, obtained_at = excluded.obtained_at
+'''
+
+
+def invalidate_inventory_cache(user_ids=None):
+    """Сбрасывает кэш инвентаря указанных пользователей (None - всех)"""
+    if user_ids is None:
+        inventory_cache.clear()
+        return
+    for user_id in user_ids:
+        inventory_cache.pop(user_id, None)
 
-    count = cursor.fetchone()[0]
+
+def grant_inventory_items(grants: List[Tuple[int, str, str, int]]):
+    """Начисляет предметы (user_id, тип, название, количество) одной транзакцией"""
+    now = datetime.now().isoformat()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.executemany(INVENTORY_UPSERT, [(*grant, now) for grant in grants])
+
+    conn.commit()
     conn.close()
-    return count
+    invalidate_inventory_cache({grant[0] for grant in grants})
 
 
-def add_inventory_item(user_id: int, item_type: str, item_name: str):
-    """Добавляет предмет в инвентарь"""
+def grant_item_to_all_users(item_type: str, item_name: str, quantity: int = 1) -> int:
+    """Начисляет предмет всем незаблокированным пользователям одним запросом. Возвращает количество получателей"""
     conn = get_db_connection()
     cursor = conn.cursor()
 
     cursor.execute('''
-        INSERT OR REPLACE INTO inventory 
-        (user_id, item_type, item_name, quantity, obtained_at)
-        VALUES (?, ?, ?, COALESCE((SELECT quantity FROM inventory WHERE user_id = ? AND item_type = ? AND item_name = ?), 0) + 1, ?)
-    ''', (user_id, item_type, item_name, user_id, item_type, item_name, datetime.now().isoformat()))
+        INSERT INTO inventory (user_id, item_type, item_name, quantity, obtained_at)
+        SELECT user_id, ?, ?, ?, ? FROM users WHERE is_blocked = FALSE
+        ON CONFLICT (user_id, item_type, item_name) DO UPDATE
+        SET quantity = quantity + excluded.quantity, obtained_at = excluded.obtained_at
+    ''', (item_type, item_name, quantity, datetime.now().isoformat()))
+    granted = cursor.rowcount
 
     conn.commit()
     conn.close()
+    invalidate_inventory_cache()
+    return granted
 
 
 def get_inventory(user_id: int):
     """Получает инвентарь пользователя"""
+    cached = inventory_cache.get(user_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
     conn = get_db_connection()
     cursor = conn.cursor()
 
@@ -777,6 +1272,10 @@ def get_inventory(user_id: int):
 
     items = cursor.fetchall()
     conn.close()
+
+    if len(inventory_cache) >= INVENTORY_CACHE_SIZE:
+        inventory_cache.clear()
+    inventory_cache[user_id] = (time.monotonic() + INVENTORY_CACHE_TTL, items)
     return items
 
 
@@ -800,12 +1299,14 @@ def get_user_statuses(user_id: int):
     conn = get_db_connection()
     cursor = conn.cursor()
 
+    # Активный статус определяется по users.active_status (IS, чтобы NULL давал FALSE, а не NULL)
     cursor.execute('''
-        SELECT status_name, is_active FROM user_statuses 
-        WHERE user_id = ? ORDER BY obtained_at
+        SELECT s.status_name, s.status_name IS u.active_status
+        FROM user_statuses AS s LEFT JOIN users AS u ON u.user_id = s.user_id
+        WHERE s.user_id = ? ORDER BY s.obtained_at
     ''', (user_id,))
 
-    statuses = cursor.fetchall()
+    statuses = [(status_name, bool(is_active)) for status_name, is_active in cursor.fetchall()]
     conn.close()
     return statuses
 
@@ -815,123 +1316,831 @@ def set_active_status(user_id: int, status_name: str):
     conn = get_db_connection()
     cursor = conn.cursor()
 
-    # Сначала сбрасываем все статусы
+    # Можно выбрать только полученный статус
     cursor.execute('''
-        UPDATE user_statuses 
-        SET is_active = FALSE 
-        WHERE user_id = ?
-    ''', (user_id,))
-
-    # Устанавливаем выбранный статус как активный
-    cursor.execute('''
-        UPDATE user_statuses 
-        SET is_active = TRUE 
-        WHERE user_id = ? AND status_name = ?
-    ''', (user_id, status_name))
+        UPDATE users SET active_status = ?
+        WHERE user_id = ? AND EXISTS (SELECT 1 FROM user_statuses WHERE user_id = ? AND status_name = ?)
+    ''', (status_name, user_id, user_id, status_name))
 
     conn.commit()
     conn.close()
+    invalidate_profile_cache(user_id)
+
+
+# Глобальные переменные для матчмейкинга
+matchmaking_queue = []
+game_sessions = {}
+friend_invites = {}
+move_timeout_tasks = {}  # Задачи для отслеживания таймаута ходов
+
+# Шардирование: номер текущего шарда и очередь сообщений координатору (None - не шард)
+SHARD_INDEX = None
+shard_outbox = None
 
 
-def get_active_status(user_id: int):
-    """Получает активный статус пользователя"""
+def mark_game_finished(game_id: str, winner):
+    """Отмечает игру завершенной и дописывает ее ходы из буфера журнала. winner - id победителя или 'draw'"""
     conn = get_db_connection()
     cursor = conn.cursor()
 
-    cursor.execute('''
-        SELECT status_name FROM user_statuses 
-        WHERE user_id = ? AND is_active = TRUE
-    ''', (user_id,))
+    cursor.execute('UPDATE game_sessions SET finished_at = ?, winner = ? WHERE game_id = ?',
+                   (datetime.now().isoformat(), 0 if winner == 'draw' else winner, game_id))
+    # Ходы только этой игры, в той же транзакции: повтор сразу полный (в том числе на другом шарде),
+    # а ходы остальных игр по-прежнему копятся в буфере
+    cursor.executemany('INSERT OR IGNORE INTO game_moves (game_id, first_ply, records) VALUES (?, ?, ?)',
+                       take_game_moves(game_id))
 
-    result = cursor.fetchone()
+    conn.commit()
     conn.close()
-    return result[0] if result else DEFAULT_STATUS
 
 
-# Глобальные переменные для матчмейкинга
-matchmaking_queue = []
-game_sessions = {}
-friend_invites = {}
-move_timeout_tasks = {}  # Задачи для отслеживания таймаута ходов
+async def remove_game_session(game_id: str, game: TicTacToeGame, winner=None):
+    """Удаляет игру из активных и снимает привязку игроков к шарду"""
+    await state_store.delete_game(game_id, game)
+    mark_game_finished(game_id, winner)
+    log_game_end(game_id)
+    if shard_outbox is not None:
+        shard_outbox.put(('unpin', SHARD_INDEX, [game.player1, game.player2], game_id))
 
 
-async def check_move_timeout(game_id: str):
-    """Проверяет таймаут хода в игре"""
-    await asyncio.sleep(MOVE_TIMEOUT)  # Ждем 1 минуту
+async def find_user_game(user_id: int) -> Tuple[Optional[str], Optional[TicTacToeGame]]:
+    """Находит активную игру пользователя"""
+    game_id = await state_store.find_player_game(user_id)
+    if not game_id:
+        return None, None
+    return game_id, await state_store.load_game(game_id)
 
-    if game_id not in game_sessions:
-        return
 
-    game = game_sessions[game_id]
+# ХРАНИЛИЩЕ СОСТОЯНИЯ ИГР
+# Адрес внешнего хранилища (redis://[:пароль@]host:port/db). Если не задан - всё хранится в памяти процесса
+STATE_STORE_URL = os.environ.get("STATE_STORE_URL")
+GAME_STATE_TTL = 24 * 60 * 60  # Сколько живет брошенная игра во внешнем хранилище (секунды)
 
-    # Проверяем, сколько времени прошло с последнего хода
-    time_since_last_move = (datetime.now() - game.last_move_time).total_seconds()
 
-    if time_since_last_move >= MOVE_TIMEOUT:
-        # Таймаут! Игрок проигрывает
-        await process_move_timeout(game, game_id)
+# Результат apply_move
+MOVE_OK = 'ok'
+MOVE_NO_GAME = 'no_game'  # Игры нет или игрок в ней не участвует
+MOVE_FINISHED = 'finished'  # У игры уже есть победитель или ничья
+MOVE_NOT_TURN = 'not_turn'
+MOVE_INVALID = 'invalid'  # Клетка занята или вне поля
 
 
-async def process_move_timeout(game: TicTacToeGame, game_id: str):
-    """Обрабатывает таймаут хода"""
-    if game.winner:
-        return  # Игра уже завершена
+class InMemoryStateStore:
+    """Игры и очередь поиска в памяти процесса (game_sessions и matchmaking_queue)"""
 
-    timeout_player = game.current_player
-    winner_id = game.player1 if timeout_player == game.player2 else game.player2
+    async def create_game(self, game_id: str, game: TicTacToeGame):
+        game_sessions[game_id] = game
 
-    # Обновляем статистику
-    winner_data = get_user_data(winner_id)
-    loser_data = get_user_data(timeout_player)
+    async def save_game(self, game_id: str, game: TicTacToeGame):
+        # Объект игры и так лежит в game_sessions
+        pass
 
-    if game.is_rated and winner_data and loser_data:
-        # Даем победителю рейтинг
-        win_change = int(RATING_CHANGE_BASE * 0.5)  # 50% от стандартной победы
-        winner_data['rating'] += win_change
-        winner_data['games_played'] += 1
-        winner_data['wins'] += 1
-        save_user_data(winner_data)
+    async def load_game(self, game_id: str) -> Optional[TicTacToeGame]:
+        return game_sessions.get(game_id)
 
-        # Отнимаем рейтинг у проигравшего по таймауту
-        lose_change = int(RATING_CHANGE_BASE * 1.0)  # 100% штраф за таймаут
-        loser_data['rating'] -= lose_change
-        loser_data['games_played'] += 1
-        loser_data['losses'] += 1
-        save_user_data(loser_data)
+    async def delete_game(self, game_id: str, game: TicTacToeGame):
+        game_sessions.pop(game_id, None)
 
-        # Обновляем время последней игры
-        update_last_game_time(winner_id)
-        update_last_game_time(timeout_player)
+    async def find_player_game(self, user_id: int) -> Optional[str]:
+        for game_id, game in game_sessions.items():
+            if user_id in [game.player1, game.player2]:
+                return game_id
+        return None
 
-        # Отправляем сообщения игрокам
+    async def apply_move(self, game_id: str, player_id: int, row: int, col: int) -> Tuple[str, Optional[TicTacToeGame]]:
+        """Делает ход. Возвращает (MOVE_*, обновленная игра или None, если ход не сделан)"""
+        game = game_sessions.get(game_id)
+        if not game or player_id not in (game.player1, game.player2):
+            return MOVE_NO_GAME, None
+        if game.winner:
+            return MOVE_FINISHED, None
+        if game.current_player != player_id:
+            return MOVE_NOT_TURN, None
+        if not game.make_move(row, col, player_id):
+            return MOVE_INVALID, None
+        return MOVE_OK, game
+
+    async def queue_contains(self, user_id: int) -> bool:
+        return user_id in matchmaking_queue
+
+    async def queue_join(self, user_id: int, rating: int):
+        if user_id not in matchmaking_queue:
+            matchmaking_queue.append(user_id)
+
+    async def queue_leave(self, user_id: int):
+        if user_id in matchmaking_queue:
+            matchmaking_queue.remove(user_id)
+
+    async def queue_pair(self, user_id: int, rating: int, max_diff: int) -> Tuple[bool, Optional[int]]:
+        """Забирает пользователя из очереди вместе с подходящим соперником.
+
+        Возвращает (был ли пользователь в очереди, id соперника или None).
+        """
+        if user_id not in matchmaking_queue:
+            return False, None
+
+        for opponent_id in matchmaking_queue:
+            if opponent_id != user_id:
+                opponent_data = get_user_data(opponent_id)
+                if opponent_data and abs(rating - opponent_data['rating']) <= max_diff:
+                    matchmaking_queue.remove(user_id)
+                    matchmaking_queue.remove(opponent_id)
+                    return True, opponent_id
+
+        matchmaking_queue.remove(user_id)
+        return True, None
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisConnection:
+    """Минимальный асинхронный клиент протокола Redis (RESP2)"""
+
+    def __init__(self, url: str):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            await self._roundtrip([('AUTH', self.password)])
+        if self.db:
+            await self._roundtrip([('SELECT', self.db)])
+
+    @staticmethod
+    def _encode(args) -> bytes:
+        out = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            out.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        return b''.join(out)
+
+    async def _read_reply(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("Соединение с Redis закрыто")
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b'+':
+            return payload.decode()
+        if prefix == b'-':
+            return RedisError(payload.decode())
+        if prefix == b':':
+            return int(payload)
+        if prefix == b'$':
+            length = int(payload)
+            if length == -1:
+                return None
+            data = await self.reader.readexactly(length + 2)
+            return data[:-2].decode()
+        if prefix == b'*':
+            length = int(payload)
+            if length == -1:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise RedisError(f"Неизвестный ответ Redis: {line!r}")
+
+    async def _roundtrip(self, commands: list) -> list:
+        self.writer.write(b''.join(self._encode(command) for command in commands))
+        await self.writer.drain()
+        replies = [await self._read_reply() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    async def pipeline(self, *commands) -> list:
+        """Отправляет несколько команд за один сетевой обмен"""
+        async with self.lock:
+            if self.writer is None or self.writer.is_closing():
+                await self.connect()
+            try:
+                return await self._roundtrip(list(commands))
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.writer.close()
+                self.writer = None
+                raise
+
+    async def execute(self, *args):
+        return (await self.pipeline(args))[0]
+
+
+# Ход за один вызов: проверка игрока, окончания игры, очереди и клетки, запись хода, проверка победы.
+# Возвращает {статус} или {'ok', поля игры...}
+REDIS_MOVE_SCRIPT = """
+local g = redis.call('HMGET', KEYS[1], 'p1', 'p2', 'cur', 'board', 'size', 'win', 'moves', 'done')
+local p1, p2, cur, board = g[1], g[2], g[3], g[4]
+if (not p1) or (ARGV[1] ~= p1 and ARGV[1] ~= p2) then return {'no_game'} end
+if g[8] and g[8] ~= '' then return {'finished'} end
+if cur ~= ARGV[1] then return {'not_turn'} end
+local size, win_length = tonumber(g[5] or 3), tonumber(g[6] or 3)
+local row, col = tonumber(ARGV[2]), tonumber(ARGV[3])
+if (not row) or (not col) or row < 0 or col < 0 or row >= size or col >= size then return {'invalid'} end
+local i = row * size + col + 1
+if string.sub(board, i, i) ~= '.' then return {'invalid'} end
+local mark, nxt = 'x', p2
+if cur ~= p1 then mark, nxt = 'o', p1 end
+board = string.sub(board, 1, i - 1) .. mark .. string.sub(board, i + 1)
+
+local function cell(r, c)
+    if r < 0 or c < 0 or r >= size or c >= size then return nil end
+    local j = r * size + c + 1
+    return string.sub(board, j, j)
+end
+local done = ''
+for _, d in ipairs({{0, 1}, {1, 0}, {1, 1}, {1, -1}}) do
+    local length = 1
+    local r, c = row + d[1], col + d[2]
+    while cell(r, c) == mark do length, r, c = length + 1, r + d[1], c + d[2] end
+    r, c = row - d[1], col - d[2]
+    while cell(r, c) == mark do length, r, c = length + 1, r - d[1], c - d[2] end
+    if length >= win_length then done = cur break end
+end
+local moves = tonumber(g[7]) + 1
+if done == '' and moves == size * size then done = 'draw' end
+
+redis.call('HSET', KEYS[1], 'board', board, 'cur', nxt, 'ts', ARGV[4], 'moves', moves, 'done', done)
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+local reply = redis.call('HGETALL', KEYS[1])
+table.insert(reply, 1, 'ok')
+return reply
+"""
+
+# Подбор пары: забирает игрока и ближайшего по рейтингу соперника из очереди атомарно
+REDIS_PAIR_SCRIPT = """
+local rating = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not rating then return {0} end
+rating = tonumber(rating)
+local range = tonumber(ARGV[2])
+local candidates = redis.call('ZRANGEBYSCORE', KEYS[1], rating - range, rating + range, 'WITHSCORES')
+local best, best_diff
+for i = 1, #candidates, 2 do
+    local uid = candidates[i]
+    local diff = math.abs(tonumber(candidates[i + 1]) - rating)
+    if uid ~= ARGV[1] and (not best or diff < best_diff) then
+        best, best_diff = uid, diff
+    end
+end
+if best then
+    redis.call('ZREM', KEYS[1], ARGV[1], best)
+    return {1, best}
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+return {1}
+"""
+
+
+class RedisStateStore:
+    """Игры и очередь поиска во внешнем Redis - общие для нескольких реплик бота"""
+
+    QUEUE_KEY = 'mm:queue'
+
+    def __init__(self, url: str):
+        self.redis = RedisConnection(url)
+        self.script_shas = {}
+
+    @staticmethod
+    def _game_key(game_id: str) -> str:
+        return f'game:{game_id}'
+
+    @staticmethod
+    def _player_key(user_id: int) -> str:
+        return f'player:{user_id}'
+
+    async def _eval(self, script: str, keys: list, args: list):
+        """Выполняет Lua скрипт по sha (один обмен), при первом вызове загружает его"""
+        sha = self.script_shas.get(script)
+        if sha:
+            try:
+                return await self.redis.execute('EVALSHA', sha, len(keys), *keys, *args)
+            except RedisError as e:
+                if not str(e).startswith('NOSCRIPT'):
+                    raise
+        self.script_shas[script] = await self.redis.execute('SCRIPT', 'LOAD', script)
+        return await self.redis.execute('EVAL', script, len(keys), *keys, *args)
+
+    async def create_game(self, game_id: str, game: TicTacToeGame):
+        key = self._game_key(game_id)
+        fields = [item for pair in game.to_compact().items() for item in pair]
+        commands = [('HSET', key, *fields), ('EXPIRE', key, GAME_STATE_TTL)]
         for player_id in [game.player1, game.player2]:
-            if player_id != -1:  # Не бот
-                user_data = get_user_data(player_id)
-                if user_data:
-                    if player_id == winner_id:
-                        message_text = (
-                            f"⏰ Игра завершена по таймауту!\n\n"
-                            f"Противник не сделал ход вовремя!\n\n"
-                            f"🏆 Вы победили!\n"
-                            f"Ваш рейтинг: {user_data['rating']}⭐"
-                        )
-                    else:
-                        message_text = (
-                            f"⏰ Игра завершена по таймауту!\n\n"
-                            f"Вы не сделали ход вовремя! ⏰\n\n"
-                            f"📉 Изменение рейтинга: -{lose_change}⭐\n"
-                            f"Ваш рейтинг: {user_data['rating']}⭐"
-                        )
+            if player_id != -1:
+                commands.append(('SET', self._player_key(player_id), game_id, 'EX', GAME_STATE_TTL))
+        await self.redis.pipeline(*commands)
+
+    async def save_game(self, game_id: str, game: TicTacToeGame):
+        key = self._game_key(game_id)
+        fields = [item for pair in game.to_compact().items() for item in pair]
+        await self.redis.pipeline(('HSET', key, *fields), ('EXPIRE', key, GAME_STATE_TTL))
+
+    async def load_game(self, game_id: str) -> Optional[TicTacToeGame]:
+        reply = await self.redis.execute('HGETALL', self._game_key(game_id))
+        if not reply:
+            return None
+        return TicTacToeGame.from_compact(dict(zip(reply[::2], reply[1::2])))
+
+    async def delete_game(self, game_id: str, game: TicTacToeGame):
+        commands = [('DEL', self._game_key(game_id))]
+        for player_id in [game.player1, game.player2]:
+            if player_id != -1:
+                commands.append(('DEL', self._player_key(player_id)))
+        await self.redis.pipeline(*commands)
 
-                    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="🎮 Новая игра", callback_data="find_game")],
-                        [InlineKeyboardButton(text="👤 Профиль", callback_data="profile")],
-                        [InlineKeyboardButton(text="📋 Меню", callback_data="back_to_main")]
-                    ])
+    async def find_player_game(self, user_id: int) -> Optional[str]:
+        return await self.redis.execute('GET', self._player_key(user_id))
 
-                    await bot.send_message(
-                        player_id,
-                        message_text,
+    async def apply_move(self, game_id: str, player_id: int, row: int, col: int) -> Tuple[str, Optional[TicTacToeGame]]:
+        reply = await self._eval(
+            REDIS_MOVE_SCRIPT,
+            [self._game_key(game_id)],
+            [player_id, row, col, int(datetime.now().timestamp() * 1000), GAME_STATE_TTL]
+        )
+        if reply[0] != MOVE_OK:
+            return reply[0], None
+        fields = reply[1:]
+        return MOVE_OK, TicTacToeGame.from_compact(dict(zip(fields[::2], fields[1::2])))
+
+    async def queue_contains(self, user_id: int) -> bool:
+        return await self.redis.execute('ZSCORE', self.QUEUE_KEY, user_id) is not None
+
+    async def queue_join(self, user_id: int, rating: int):
+        await self.redis.execute('ZADD', self.QUEUE_KEY, 'NX', rating, user_id)
+
+    async def queue_leave(self, user_id: int):
+        await self.redis.execute('ZREM', self.QUEUE_KEY, user_id)
+
+    async def queue_pair(self, user_id: int, rating: int, max_diff: int) -> Tuple[bool, Optional[int]]:
+        reply = await self._eval(REDIS_PAIR_SCRIPT, [self.QUEUE_KEY], [user_id, max_diff])
+        if not reply[0]:
+            return False, None
+        return True, int(reply[1]) if len(reply) > 1 else None
+
+
+def create_state_store(url: Optional[str]):
+    if url and url.startswith('redis://'):
+        return RedisStateStore(url)
+    return InMemoryStateStore()
+
+
+state_store = create_state_store(STATE_STORE_URL)
+
+
+# ЖУРНАЛ ХОДОВ
+# Запись хода: номер хода (uint16), клетка row * size + col (uint8), мс с предыдущего хода (uint16)
+MOVE_RECORD = struct.Struct('<HBH')
+MOVE_LOG_BATCH = 200  # Сбрасываем буфер в базу, когда накопилось столько ходов
+MOVE_LOG_FLUSH_INTERVAL = 10  # ... или раз в столько секунд
+
+move_log_buffer = {}  # game_id -> [(номер первого хода в буфере, bytearray записей)]
+move_log_clock = {}  # game_id -> время предыдущего хода (time.monotonic())
+move_log_pending = 0
+
+
+def log_game_start(game_id: str):
+    move_log_clock[game_id] = time.monotonic()
+
+
+def log_move(game_id: str, game: TicTacToeGame, row: int, col: int):
+    """Добавляет ход в буфер журнала (ход уже сделан, game.moves - его номер)"""
+    global move_log_pending
+    now = time.monotonic()
+    previous = move_log_clock.get(game_id, now)
+    move_log_clock[game_id] = now
+    delta_ms = min(int((now - previous) * 1000), 0xFFFF)
+
+    record = MOVE_RECORD.pack(game.moves, row * game.size + col, delta_ms)
+    chunks = move_log_buffer.setdefault(game_id, [])
+    if not chunks:
+        chunks.append((game.moves, bytearray()))
+    chunks[-1][1].extend(record)
+
+    move_log_pending += 1
+    if move_log_pending >= MOVE_LOG_BATCH:
+        flush_move_log()
+
+
+def log_game_end(game_id: str):
+    move_log_clock.pop(game_id, None)
+
+
+def take_game_moves(game_id: str) -> List[Tuple[str, int, bytes]]:
+    """Забирает из буфера ходы одной игры в виде строк game_moves"""
+    global move_log_pending
+    chunks = move_log_buffer.pop(game_id, [])
+    move_log_pending -= sum(len(records) // MOVE_RECORD.size for _, records in chunks)
+    return [(game_id, first_ply, bytes(records)) for first_ply, records in chunks]
+
+
+def flush_move_log() -> int:
+    """Записывает все накопленные ходы одной транзакцией. Возвращает количество записанных ходов"""
+    global move_log_buffer, move_log_pending
+    if not move_log_buffer:
+        return 0
+
+    flushed = move_log_pending
+    rows = [(game_id, first_ply, bytes(records))
+            for game_id, chunks in move_log_buffer.items()
+            for first_ply, records in chunks]
+    move_log_buffer = {}
+    move_log_pending = 0
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executemany('INSERT OR IGNORE INTO game_moves (game_id, first_ply, records) VALUES (?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+    return flushed
+
+
+def load_game_moves(game_id: str) -> List[Tuple[int, int, int]]:
+    """Все ходы игры (номер хода, клетка, мс с предыдущего хода) по порядку"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('SELECT records FROM game_moves WHERE game_id = ? ORDER BY first_ply', (game_id,))
+    blobs = [row[0] for row in cursor.fetchall()]
+
+    conn.close()
+
+    # Ходы, которые еще не успели попасть в базу
+    blobs.extend(bytes(records) for _, records in move_log_buffer.get(game_id, []))
+
+    moves = []
+    for blob in blobs:
+        moves.extend(MOVE_RECORD.iter_unpack(blob))
+    return moves
+
+
+async def periodic_move_log_flush():
+    while True:
+        await asyncio.sleep(MOVE_LOG_FLUSH_INTERVAL)
+        flush_move_log()
+
+
+# ОГРАНИЧЕНИЕ ЧАСТОТЫ НАЖАТИЙ
+# Корзины токенов: (емкость, пополнение токенов в секунду)
+THROTTLE_USER_LIMIT = (10, 3.0)  # Общий лимит на все кнопки пользователя
+# Лимиты по действию кнопки (после разбора callback_data, поэтому старые кнопки "move_..." попадают в "m")
+THROTTLE_ACTION_LIMITS = {
+    "m": (3, 2.0),
+    "surrender": (1, 0.5),
+    "find_game": (2, 0.2),
+    "create_invite": (2, 0.2),
+    "spin_roulette": (2, 0.5),
+}
+THROTTLE_SHARED_BUCKETS = {"spin_roulette_all": "spin_roulette"}  # Действия с общей корзиной
+THROTTLE_MAX_BUCKETS = 100000  # При превышении удаляем давно неактивные корзины
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Отбрасывает слишком частые нажатия кнопок до любой работы с базой данных"""
+
+    def __init__(self):
+        self.buckets = {}  # (user_id, действие) -> (токены, время последнего пополнения)
+        self.throttled = {}  # действие -> количество отброшенных апдейтов
+
+    def _take_token(self, key: tuple, limit: tuple, now: float) -> bool:
+        capacity, rate = limit
+        tokens, updated_at = self.buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            return False
+        self.buckets[key] = (tokens - 1, now)
+        return True
+
+    def _cleanup(self, now: float):
+        # Корзина, которая не использовалась минуту, в любом случае уже полная
+        self.buckets = {key: value for key, value in self.buckets.items() if now - value[1] < 60}
+
+    async def __call__(
+        self,
+        handler: Callable[[CallbackQuery, Dict[str, Any]], Awaitable[Any]],
+        event: CallbackQuery,
+        data: Dict[str, Any]
+    ) -> Any:
+        now = time.monotonic()
+        if len(self.buckets) > THROTTLE_MAX_BUCKETS:
+            self._cleanup(now)
+
+        user_id = event.from_user.id
+        action, _ = parse_callback_data(event.data or "")
+        action = THROTTLE_SHARED_BUCKETS.get(action, action)
+        if action not in THROTTLE_ACTION_LIMITS:
+            action = None
+
+        allowed = self._take_token((user_id, None), THROTTLE_USER_LIMIT, now)
+        if allowed and action:
+            allowed = self._take_token((user_id, action), THROTTLE_ACTION_LIMITS[action], now)
+
+        if not allowed:
+            counter_key = action or "*"
+            self.throttled[counter_key] = self.throttled.get(counter_key, 0) + 1
+            try:
+                await event.answer("⏳ Слишком часто! Подождите немного.")
+            except Exception:
+                pass
+            return None
+
+        return await handler(event, data)
+
+
+throttling_middleware = ThrottlingMiddleware()
+dp.callback_query.outer_middleware(throttling_middleware)
+THROTTLE_LOG_INTERVAL = 600  # Как часто печатать счетчики отброшенных нажатий, секунды
+
+
+def format_throttle_stats() -> str:
+    """Счетчики отброшенных нажатий текущего процесса с момента запуска"""
+    throttled = throttling_middleware.throttled
+    if not throttled:
+        return "0"
+    details = ", ".join(f"{key}: {count}" for key, count in sorted(throttled.items(), key=lambda item: -item[1]))
+    return f"{sum(throttled.values())} ({details})"
+
+
+async def periodic_throttle_log():
+    """Печатает счетчики в лог: в режиме long polling нет /health, а в шардах у каждого процесса свои счетчики"""
+    last = None
+    while True:
+        await asyncio.sleep(THROTTLE_LOG_INTERVAL)
+        stats = format_throttle_stats()
+        if stats != last:
+            print(f"Отброшено нажатий{'' if SHARD_INDEX is None else f' (шард {SHARD_INDEX})'}: {stats}")
+            last = stats
+
+
+# МАРШРУТИЗАЦИЯ КНОПОК
+# callback_data: "действие" или "действие:арг1:арг2" (не больше 64 байт).
+# Обработчик выбирается по действию из словаря, а не перебором фильтров
+callback_routes = {}  # действие -> (обработчик, нужен ли FSMContext)
+# Кнопки из сообщений, отправленных до перехода на новый формат: префикс -> (действие, maxsplit аргументов)
+LEGACY_CALLBACK_PREFIXES = {
+    "move_": ("m", -1),
+    "copy_ref_": ("copy_ref", 0),  # Раньше "copy_": иначе он перехватит и эти кнопки
+    "copy_": ("copy", 0),
+    "set_status_": ("set_status", 0),
+    "stats_": ("stats", 0),
+}
+
+
+def callback_route(*actions: str):
+    """Регистрирует обработчик кнопок с указанными действиями"""
+    def decorator(handler):
+        wants_state = 'state' in inspect.signature(handler).parameters
+        for action in actions:
+            callback_routes[action] = (handler, wants_state)
+        return handler
+    return decorator
+
+
+def parse_callback_data(data: str, maxsplit: int = -1) -> Tuple[str, List[str]]:
+    """Разбирает callback_data на действие и аргументы"""
+    action, _, args = data.partition(':')
+    if action not in callback_routes:
+        for prefix, (legacy_action, legacy_maxsplit) in LEGACY_CALLBACK_PREFIXES.items():
+            if action.startswith(prefix):
+                return legacy_action, action[len(prefix):].split('_', legacy_maxsplit)
+    return action, args.split(':', maxsplit) if args else []
+
+
+def callback_args(callback: CallbackQuery, maxsplit: int = -1) -> List[str]:
+    """Аргументы кнопки. maxsplit ограничивает разбиение, если последний аргумент может содержать ':'"""
+    return parse_callback_data(callback.data or '', maxsplit)[1]
+
+
+@router.callback_query()
+async def dispatch_callback(callback: CallbackQuery, state: FSMContext):
+    action, _ = parse_callback_data(callback.data or '')
+    route = callback_routes.get(action)
+    if not route:
+        # Занятая клетка поля или устаревшая кнопка
+        await callback.answer()
+        return
+
+    handler, wants_state = route
+    if wants_state:
+        return await handler(callback, state)
+    return await handler(callback)
+
+
+# ПЛАВНАЯ ОСТАНОВКА
+SHUTDOWN_DEADLINE = float(os.environ.get("SHUTDOWN_DEADLINE", "10"))  # Сколько ждем начатые обработчики, секунды
+
+
+class InFlightMiddleware(BaseMiddleware):
+    """Запоминает обрабатываемые сейчас апдейты, чтобы при остановке дать им доработать"""
+
+    def __init__(self):
+        self.tasks = set()
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any]
+    ) -> Any:
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            return await handler(event, data)
+        finally:
+            self.tasks.discard(task)
+
+
+inflight_middleware = InFlightMiddleware()
+dp.update.outer_middleware(inflight_middleware)
+
+
+class BlockedUserMiddleware(BaseMiddleware):
+    """Отклоняет апдейты заблокированных пользователей до обработчиков и обращений к базе"""
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get('event_from_user')
+        if user is None or user.id not in blocked_users or user.id == ADMIN_ID:
+            return await handler(event, data)
+
+        try:
+            if event.callback_query:
+                await event.callback_query.answer("❌ Вы заблокированы и не можете использовать бота.", show_alert=True)
+            elif event.message and event.message.chat.type == 'private':
+                await event.message.answer("❌ Вы заблокированы и не можете использовать бота.")
+        except Exception:
+            pass
+        return None
+
+
+dp.update.outer_middleware(BlockedUserMiddleware())
+background_tasks = set()  # Периодические задачи, которые отменяются при остановке
+
+
+def start_background_task(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def drain_inflight_handlers(timeout: float) -> Tuple[int, int]:
+    """Ждет завершения начатых обработчиков. Возвращает (завершились, не успели)"""
+    tasks = {task for task in inflight_middleware.tasks if task is not asyncio.current_task()}
+    if not tasks:
+        return 0, 0
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    return len(done), len(pending)
+
+
+async def persist_active_games() -> int:
+    """Сохраняет активные игры этого процесса (с id сообщений и оставшимся временем на ход) в active_games"""
+    game_ids = set(move_timeout_tasks) | set(game_sessions)
+    now = datetime.now()
+    rows = []
+    for game_id in game_ids:
+        game = await state_store.load_game(game_id)
+        if not game or game.winner:
+            continue
+        time_left = max(0.0, MOVE_TIMEOUT - (now - game.last_move_time).total_seconds())
+        rows.append((game_id, json.dumps(game.to_compact()), time_left, now.isoformat()))
+
+    if rows:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.executemany('INSERT OR REPLACE INTO active_games (game_id, state, time_left, saved_at) VALUES (?, ?, ?, ?)', rows)
+        conn.commit()
+        conn.close()
+    return len(rows)
+
+
+async def restore_active_games() -> int:
+    """Возвращает в работу игры, сохраненные при прошлой остановке.
+    В режиме шардов каждый шард забирает игры, первый игрок которых относится к нему"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT game_id, state, time_left FROM active_games')
+    rows = cursor.fetchall()
+
+    restored = []
+    for game_id, state, time_left in rows:
+        game = TicTacToeGame.from_compact(json.loads(state))
+        if shard_outbox is not None and jump_consistent_hash(game.player1, SHARD_COUNT) != SHARD_INDEX:
+            continue
+
+        # Время простоя не засчитываем: у игрока остается столько же времени на ход, сколько было при остановке
+        game.last_move_time = datetime.now() - timedelta(seconds=MOVE_TIMEOUT - time_left)
+        if not await state_store.load_game(game_id):
+            await state_store.create_game(game_id, game)
+        else:
+            await state_store.save_game(game_id, game)
+        move_timeout_tasks[game_id] = asyncio.create_task(check_move_timeout(game_id, time_left))
+        if game.is_vs_bot and game.current_player == -1:
+            # Бота остановили до его хода: ходим сразу, иначе игра простоит до таймаута
+            start_background_task(make_bot_move(game, game_id))
+        if shard_outbox is not None:
+            players = [game.player1] if game.is_vs_bot else [game.player1, game.player2]
+            shard_outbox.put(('pin', SHARD_INDEX, players, game_id))
+        restored.append((game_id,))
+
+    cursor.executemany('DELETE FROM active_games WHERE game_id = ?', restored)
+    conn.commit()
+    conn.close()
+    return len(restored)
+
+
+async def check_move_timeout(game_id: str, delay: float = MOVE_TIMEOUT):
+    """Проверяет таймаут хода в игре"""
+    await asyncio.sleep(delay)  # Ждем 1 минуту (для восстановленной игры - оставшееся время)
+
+    game = await state_store.load_game(game_id)
+    if not game:
+        return
+
+    # Проверяем, сколько времени прошло с последнего хода
+    time_since_last_move = (datetime.now() - game.last_move_time).total_seconds()
+
+    if time_since_last_move >= MOVE_TIMEOUT:
+        # Таймаут! Игрок проигрывает
+        await process_move_timeout(game, game_id)
+
+
+async def process_move_timeout(game: TicTacToeGame, game_id: str):
+    """Обрабатывает таймаут хода"""
+    if game.winner:
+        return  # Игра уже завершена
+
+    timeout_player = game.current_player
+    winner_id = game.player1 if timeout_player == game.player2 else game.player2
+
+    # Обновляем статистику
+    winner_data = get_user_data(winner_id)
+    loser_data = get_user_data(timeout_player)
+
+    if game.is_rated and winner_data and loser_data:
+        if RATING_MODEL == "elo":
+            # По Эло таймаут - обычное поражение
+            win_change, lose_change = calculate_rating_change(winner_data['rating'], loser_data['rating'])
+        else:
+            win_change = int(RATING_CHANGE_BASE * 0.5)  # 50% от стандартной победы
+            lose_change = int(RATING_CHANGE_BASE * 1.0)  # 100% штраф за таймаут
+
+        # Даем победителю рейтинг
+        winner_data['rating'] += win_change
+        winner_data['games_played'] += 1
+        winner_data['wins'] += 1
+        save_user_data(winner_data)
+
+        # Отнимаем рейтинг у проигравшего по таймауту
+        loser_data['rating'] -= lose_change
+        loser_data['games_played'] += 1
+        loser_data['losses'] += 1
+        save_user_data(loser_data)
+
+        # Обновляем время последней игры
+        update_last_game_time(winner_id)
+        update_last_game_time(timeout_player)
+
+        # Отправляем сообщения игрокам
+        for player_id in [game.player1, game.player2]:
+            if player_id != -1:  # Не бот
+                user_data = get_user_data(player_id)
+                if user_data:
+                    if player_id == winner_id:
+                        message_text = (
+                            f"⏰ Игра завершена по таймауту!\n\n"
+                            f"Противник не сделал ход вовремя!\n\n"
+                            f"🏆 Вы победили!\n"
+                            f"Ваш рейтинг: {user_data['rating']}⭐"
+                        )
+                    else:
+                        message_text = (
+                            f"⏰ Игра завершена по таймауту!\n\n"
+                            f"Вы не сделали ход вовремя! ⏰\n\n"
+                            f"📉 Изменение рейтинга: -{lose_change}⭐\n"
+                            f"Ваш рейтинг: {user_data['rating']}⭐"
+                        )
+
+                    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                        [InlineKeyboardButton(text="🎮 Новая игра", callback_data="find_game")],
+                        [InlineKeyboardButton(text="👤 Профиль", callback_data="profile")],
+                        [InlineKeyboardButton(text="📋 Меню", callback_data="back_to_main")]
+                    ])
+
+                    await bot.send_message(
+                        player_id,
+                        message_text,
                         reply_markup=keyboard
                     )
     else:
@@ -969,12 +2178,11 @@ async def process_move_timeout(game: TicTacToeGame, game_id: str):
                     await bot.send_message(player_id, "⏰ Вы не сделали ход вовремя! Вы проиграли! ⏰",
                                            reply_markup=keyboard)
 
-    # Удаляем игру
-    if game_id in game_sessions:
-        if game_id in move_timeout_tasks:
-            move_timeout_tasks[game_id].cancel()
-            del move_timeout_tasks[game_id]
-        del game_sessions[game_id]
+    # Удаляем игру (до отмены задачи таймаута - эта функция может выполняться внутри нее)
+    await remove_game_session(game_id, game, winner_id)
+    if game_id in move_timeout_tasks:
+        move_timeout_tasks[game_id].cancel()
+        del move_timeout_tasks[game_id]
 
 
 @router.message(CommandStart())
@@ -982,11 +2190,7 @@ async def cmd_start(message: Message):
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.first_name
 
-    # Проверяем блокировку
     user_data = get_user_data(user_id)
-    if user_data and user_data.get('is_blocked'):
-        await message.answer("❌ Вы заблокированы и не можете использовать бота.")
-        return
 
     # Сохраняем информацию о чате
     if message.chat.type == 'private':
@@ -1001,7 +2205,7 @@ async def cmd_start(message: Message):
         user_data = {
             'user_id': user_id,
             'username': username,
-            'rating': 100,
+            'rating': NEW_USER_RATING,
             'games_played': 0,
             'wins': 0,
             'losses': 0,
@@ -1011,6 +2215,8 @@ async def cmd_start(message: Message):
             'is_blocked': False
         }
         save_user_data(user_data)
+    elif user_data['username'] != username:
+        update_username(user_id, username)
 
     # Проверяем параметры команды start
     args = message.text.split()
@@ -1031,7 +2237,7 @@ async def cmd_start(message: Message):
                     return
 
                 # Проверяем, не находится ли пользователь уже в игре
-                if is_user_in_game(user_id):
+                if await is_user_in_game(user_id):
                     await message.answer(
                         "❌ Вы уже находитесь в активной игре! Завершите текущую игру перед началом новой.")
                     return
@@ -1082,7 +2288,7 @@ async def cmd_start(message: Message):
             )
 
     # Проверяем, не находится ли пользователь уже в игре
-    if is_user_in_game(user_id):
+    if await is_user_in_game(user_id):
         await message.answer("🎮 Вы уже находитесь в активной игре! Завершите текущую игру перед началом новой.")
         return
 
@@ -1091,6 +2297,7 @@ async def cmd_start(message: Message):
         [InlineKeyboardButton(text="👤 Профиль", callback_data="profile"),
          InlineKeyboardButton(text="🏆 Топ-10", callback_data="top_10")],
         [InlineKeyboardButton(text="👥 Играть с другом", callback_data="play_friend")],
+        [InlineKeyboardButton(text="🧩 Большие поля", callback_data="variants")],
         [InlineKeyboardButton(text="🎁 Реферальная программа", callback_data="ref_program")]
     ])
 
@@ -1105,12 +2312,10 @@ async def cmd_start(message: Message):
 async def cmd_ref(message: Message):
     """Реферальная программа"""
     user_id = message.from_user.id
-    bot_username = (await bot.get_me()).username
 
-    completed_refs = get_completed_referrals_count(user_id)
-    pending_refs = get_pending_referrals_count(user_id)
+    completed_refs, pending_refs = get_referral_counts(user_id)
 
-    ref_link = f"https://t.me/{bot_username}?start=ref_{user_id}"
+    ref_link = await build_start_link(f"ref_{user_id}")
 
     ref_text = (
         "🎁 Реферальная программа\n\n"
@@ -1121,7 +2326,7 @@ async def cmd_ref(message: Message):
         "• После этого реферал засчитывается\n\n"
         f"✅ Завершенных рефералов: {completed_refs}\n"
         f"⏳ Ожидающих завершения: {pending_refs}\n"
-        f"🎰 Доступно прокруток рулетки: {completed_refs // REF_FOR_ROULETTE}\n\n"
+        f"🎰 Доступно прокруток рулетки: {get_available_spins(user_id)}\n\n"
         f"🔗 Ваша реферальная ссылка:\n{ref_link}\n\n"
         f"За каждые {REF_FOR_ROULETTE} рефералов вы получаете прокрутку рулетки!"
     )
@@ -1129,20 +2334,20 @@ async def cmd_ref(message: Message):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🎰 Крутить рулетку", callback_data="roulette")],
         [InlineKeyboardButton(text="ℹ️ Посмотреть призы", callback_data="view_prizes")],
-        [InlineKeyboardButton(text="🔗 Скопировать ссылку", callback_data=f"copy_ref_{user_id}")],
+        [InlineKeyboardButton(text="🔗 Скопировать ссылку", callback_data=f"copy_ref:{user_id}")],
         [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")]
     ])
 
     await message.answer(ref_text, reply_markup=keyboard)
 
 
-@router.callback_query(F.data == "ref_program")
+@callback_route("ref_program")
 async def ref_program_handler(callback: CallbackQuery):
     """Обработчик кнопки реферальной программы"""
     await cmd_ref(callback.message)
 
 
-@router.callback_query(F.data == "view_prizes")
+@callback_route("view_prizes")
 async def view_prizes_handler(callback: CallbackQuery):
     """Показывает информацию о призах"""
     await cmd_rouletteprize(callback.message)
@@ -1187,17 +2392,16 @@ async def cmd_rouletteprize(message: Message):
         await message.edit_text(prize_text, reply_markup=keyboard)
 
 
-@router.callback_query(F.data.startswith("copy_ref_"))
+@callback_route("copy_ref")
 async def copy_ref_link(callback: CallbackQuery):
     """Копирование реферальной ссылки"""
-    user_id = int(callback.data.replace("copy_ref_", ""))
-    bot_username = (await bot.get_me()).username
-    ref_link = f"https://t.me/{bot_username}?start=ref_{user_id}"
+    user_id = int(callback_args(callback)[0])
+    ref_link = await build_start_link(f"ref_{user_id}")
 
     await callback.answer(f"Реферальная ссылка скопирована: {ref_link}", show_alert=True)
 
 
-@router.callback_query(F.data == "roulette")
+@callback_route("roulette")
 async def roulette_handler(callback: CallbackQuery):
     """Обработчик рулетки"""
     user_id = callback.from_user.id
@@ -1206,8 +2410,7 @@ async def roulette_handler(callback: CallbackQuery):
         await callback.answer("❌ Рулетка доступна только в личных сообщениях с ботом!", show_alert=True)
         return
 
-    completed_refs = get_completed_referrals_count(user_id)
-    available_spins = completed_refs // REF_FOR_ROULETTE
+    available_spins = get_available_spins(user_id)
 
     if available_spins <= 0:
         await callback.answer(
@@ -1217,54 +2420,53 @@ async def roulette_handler(callback: CallbackQuery):
         return
 
     # Показываем информацию о рулетке
+    chances = "".join(f"• {name} - {weight:g}%\n" for _, name, weight in ROULETTE_PRIZES)
     roulette_info = (
         "🎰 Рулетка призов\n\n"
         "🎲 Шансы выпадения:\n"
-        "• NFT подарок - 0.1%\n"
-        "• Обычный подарок - 10%\n"
-        "• Мишка - 5%\n"
-        "• Сердечко - 5%\n"
-        "• Ничего - 30%\n"
-        "• Статус - 49.9%\n\n"
+        f"{chances}\n"
         f"🔄 Доступно прокруток: {available_spins}"
     )
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🎰 Крутить рулетку!", callback_data="spin_roulette")],
-        [InlineKeyboardButton(text="ℹ️ Посмотреть призы", callback_data="view_prizes")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="ref_program")]
-    ])
+    await callback.message.edit_text(roulette_info, reply_markup=get_roulette_keyboard(available_spins))
+
 
-    await callback.message.edit_text(roulette_info, reply_markup=keyboard)
+def get_roulette_keyboard(available_spins: int, again: bool = False) -> InlineKeyboardMarkup:
+    keyboard = [[InlineKeyboardButton(text="🎰 Крутить еще раз" if again else "🎰 Крутить рулетку!",
+                                      callback_data="spin_roulette")]]
+    if available_spins > 1:
+        keyboard.append([InlineKeyboardButton(text=f"🎰 Крутить все ({available_spins})",
+                                              callback_data="spin_roulette_all")])
+    if again:
+        keyboard.append([InlineKeyboardButton(text="📦 Мой инвентарь", callback_data="my_inventory")])
+    else:
+        keyboard.append([InlineKeyboardButton(text="ℹ️ Посмотреть призы", callback_data="view_prizes")])
+    keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data="ref_program")])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
-@router.callback_query(F.data == "spin_roulette")
+@callback_route("spin_roulette", "spin_roulette_all")
 async def spin_roulette_handler(callback: CallbackQuery):
-    """Прокрутка рулетки"""
+    """Прокрутка рулетки (одна или все доступные сразу)"""
     user_id = callback.from_user.id
 
-    completed_refs = get_completed_referrals_count(user_id)
-    available_spins = completed_refs // REF_FOR_ROULETTE
+    count = get_available_spins(user_id) if callback.data == "spin_roulette_all" else 1
+    prizes = spend_spins(user_id, count) if count > 0 else None
 
-    if available_spins <= 0:
+    if prizes is None:
         await callback.answer("❌ Нет доступных прокруток!", show_alert=True)
         return
 
-    # Спин рулетки
-    spin_result = spin_roulette()
-
-    # Добавляем приз в инвентарь
-    if spin_result['type'] != 'nothing':
-        add_inventory_item(user_id, spin_result['type'], spin_result['name'])
-
+    won = [prize for prize in prizes if prize['type'] != 'nothing']
+    if won:
         # Отправляем уведомление админу о выигрыше подарка
         try:
             user_data = get_user_data(user_id)
             gift_text = (
                 f"🎁 ПОЛУЧЕН ПОДАРОК!\n\n"
                 f"👤 Пользователь: @{user_data['username']} (ID: {user_id})\n"
-                f"🏆 Выиграл: {spin_result['name']}\n"
-                f"📦 Тип: {spin_result['type']}\n"
+                f"🏆 Выиграл: {', '.join(prize['name'] for prize in won)}\n"
+                f"📦 Тип: {', '.join(sorted({prize['type'] for prize in won}))}\n"
                 f"🕐 Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
                 f"🎮 Игр сыграно: {user_data['games_played']}\n"
                 f"⭐ Рейтинг: {user_data['rating']}"
@@ -1273,47 +2475,63 @@ async def spin_roulette_handler(callback: CallbackQuery):
         except Exception as e:
             print(f"Ошибка отправки уведомления о подарке: {e}")
 
-    # Уменьшаем количество доступных прокруток
-    # Не обновляем базу данных здесь, т.к. это демонстрационная логика
-    # В реальном боте нужно было бы обновить счетчик прокруток
-
-    result_text = (
-        f"🎰 Результат прокрутки:\n\n"
-        f"🏆 Вы выиграли: {spin_result['name']}!\n"
-        f"📦 Тип: {spin_result['type']}\n\n"
-    )
-
-    if spin_result['type'] == 'status':
+    if len(prizes) == 1:
+        spin_result = prizes[0]
+        result_text = (
+            f"🎰 Результат прокрутки:\n\n"
+            f"🏆 Вы выиграли: {spin_result['name']}!\n"
+            f"📦 Тип: {spin_result['type']}\n\n"
+        )
+    else:
+        counts = {}
+        for prize in prizes:
+            counts[prize['name']] = counts.get(prize['name'], 0) + 1
+        result_text = f"🎰 Результат {len(prizes)} прокруток:\n\n" + "".join(
+            f"🏆 {name} ×{quantity}\n" for name, quantity in sorted(counts.items(), key=lambda item: -item[1])
+        ) + "\n"
+
+    if any(prize['type'] == 'status' for prize in prizes):
         result_text += "✨ Новый статус добавлен в вашу коллекцию! Используйте /mystatus чтобы посмотреть."
-    elif spin_result['type'] != 'nothing':
+    elif won:
         result_text += "🎁 Предмет добавлен в инвентарь!"
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🎰 Крутить еще раз", callback_data="spin_roulette")],
-        [InlineKeyboardButton(text="📦 Мой инвентарь", callback_data="my_inventory")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="ref_program")]
-    ])
+    await callback.message.edit_text(result_text, reply_markup=get_roulette_keyboard(get_available_spins(user_id), again=True))
+
+
+def build_alias_table(weights: List[float]) -> Tuple[List[float], List[int]]:
+    """Таблица для выбора по весам за O(1) (метод псевдонимов Уолкера, вариант Воуза)"""
+    n = len(weights)
+    total = sum(weights)
+    scaled = [weight * n / total for weight in weights]
+    prob = [1.0] * n
+    alias = list(range(n))
+    small = [i for i, value in enumerate(scaled) if value < 1]
+    large = [i for i, value in enumerate(scaled) if value >= 1]
 
-    await callback.message.edit_text(result_text, reply_markup=keyboard)
+    while small and large:
+        less, more = small.pop(), large.pop()
+        prob[less] = scaled[less]
+        alias[less] = more
+        scaled[more] -= 1 - scaled[less]
+        (small if scaled[more] < 1 else large).append(more)
+
+    return prob, alias
+
+
+ROULETTE_ALIAS = build_alias_table([weight for _, _, weight in ROULETTE_PRIZES])
 
 
 def spin_roulette():
     """Логика прокрутки рулетки"""
-    rand = random.random() * 100
-
-    if rand < 0.1:  # 0.1%
-        return {'type': 'nft', 'name': 'NFT подарок'}
-    elif rand < 10.1:  # 10%
-        return {'type': 'gift', 'name': 'Обычный подарок'}
-    elif rand < 15.1:  # 5%
-        return {'type': 'gift', 'name': 'Мишка'}
-    elif rand < 20.1:  # 5%
-        return {'type': 'gift', 'name': 'Сердечко'}
-    elif rand < 50.1:  # 30%
-        return {'type': 'nothing', 'name': 'Ничего'}
-    else:  # 49.9%
-        status = random.choice(STATUSES)
-        return {'type': 'status', 'name': status}
+    prob, alias = ROULETTE_ALIAS
+    index = random.randrange(len(prob))
+    if random.random() >= prob[index]:
+        index = alias[index]
+
+    prize_type, name, _ = ROULETTE_PRIZES[index]
+    if prize_type == 'status':
+        name = random.choice(STATUSES)
+    return {'type': prize_type, 'name': name}
 
 
 @router.message(Command("help"))
@@ -1330,6 +2548,7 @@ async def cmd_help(message: Message):
         "/status - Список всех статусов\n"
         "/mystatus - Ваши статусы\n"
         "/inventory - Ваш инвентарь\n"
+        "/replay - Повтор последней партии\n"
         "/report - Отправить отчет администратору\n\n"
         "🎮 Игровые команды:\n"
         "• Просто нажмите 'Найти игру' в меню\n"
@@ -1360,7 +2579,7 @@ async def cmd_mystatus(message: Message):
     """Показывает статусы пользователя"""
     user_id = message.from_user.id
     user_statuses = get_user_statuses(user_id)
-    active_status = get_active_status(user_id)
+    active_status = next((name for name, is_active in user_statuses if is_active), DEFAULT_STATUS)
 
     if not user_statuses:
         status_text = f"📊 Ваши статусы:\n\n• {DEFAULT_STATUS}\n\nУ вас пока нет статусов. Получите их через рулетку!"
@@ -1381,7 +2600,7 @@ async def cmd_mystatus(message: Message):
     await message.answer(status_text, reply_markup=keyboard)
 
 
-@router.callback_query(F.data == "change_status")
+@callback_route("change_status")
 async def change_status_handler(callback: CallbackQuery):
     """Смена статуса"""
     user_id = callback.from_user.id
@@ -1395,7 +2614,7 @@ async def change_status_handler(callback: CallbackQuery):
     keyboard_buttons = []
     row = []
     for i, (status_name, is_active) in enumerate(user_statuses, 1):
-        row.append(InlineKeyboardButton(text=str(i), callback_data=f"set_status_{i}"))
+        row.append(InlineKeyboardButton(text=str(i), callback_data=f"set_status:{i}"))
         if i % 5 == 0:  # 5 кнопок в ряду
             keyboard_buttons.append(row)
             row = []
@@ -1412,11 +2631,11 @@ async def change_status_handler(callback: CallbackQuery):
     )
 
 
-@router.callback_query(F.data.startswith("set_status_"))
+@callback_route("set_status")
 async def set_status_handler(callback: CallbackQuery):
     """Установка статуса по номеру"""
     user_id = callback.from_user.id
-    status_num = int(callback.data.replace("set_status_", "")) - 1
+    status_num = int(callback_args(callback)[0]) - 1
 
     user_statuses = get_user_statuses(user_id)
 
@@ -1430,7 +2649,7 @@ async def set_status_handler(callback: CallbackQuery):
         await callback.answer("❌ Неверный номер статуса!", show_alert=True)
 
 
-@router.callback_query(F.data == "mystatus_back")
+@callback_route("mystatus_back")
 async def mystatus_back_handler(callback: CallbackQuery):
     """Назад к просмотру статусов"""
     await cmd_mystatus(callback.message)
@@ -1512,7 +2731,7 @@ async def process_report(message: Message, state: FSMContext):
     await state.clear()
 
 
-@router.callback_query(F.data == "my_inventory")
+@callback_route("my_inventory")
 async def my_inventory_handler(callback: CallbackQuery):
     """Показывает инвентарь пользователя"""
     user_id = callback.from_user.id
@@ -1576,136 +2795,289 @@ async def cmd_inventory(message: Message):
     await message.answer(inventory_text, reply_markup=keyboard)
 
 
-@router.callback_query(F.data == "create_invite")
+@callback_route("create_invite")
 async def create_invite_handler(callback: CallbackQuery):
     user_id = callback.from_user.id
 
-    # Проверяем блокировку
-    user_data = get_user_data(user_id)
-    if user_data and user_data.get('is_blocked'):
-        await callback.answer("❌ Вы заблокированы и не можете использовать бота.", show_alert=True)
-        return
-
     # Проверяем, не находится ли пользователь уже в игре
-    if is_user_in_game(user_id):
+    if await is_user_in_game(user_id):
         await callback.answer(
             "❌ Вы уже находитесь в активной игре! Завершите текущую игру перед созданием приглашения.", show_alert=True)
         return
 
     user_data = get_user_data(user_id)
-    bot_username = (await bot.get_me()).username
-
     invite_code = create_invite(user_id)
 
     invite_text = (
         f"🎯 {user_data['username']} приглашает вас сыграть в Крестики-Нолики!\n\n"
         f"Чтобы принять вызов, перейдите по ссылке:\n"
-        f"https://t.me/{bot_username}?start={invite_code}"
+        f"{await build_start_link(invite_code)}"
     )
 
     await callback.message.edit_text(
         invite_text,
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔗 Скопировать ссылку", callback_data=f"copy_{invite_code}")],
+            [InlineKeyboardButton(text="🔗 Скопировать ссылку", callback_data=f"copy:{invite_code}")],
             [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")]
         ])
     )
 
 
-@router.callback_query(F.data.startswith("copy_"))
+@callback_route("copy")
 async def copy_invite_link(callback: CallbackQuery):
-    invite_code = callback.data.replace("copy_", "")
-    bot_username = (await bot.get_me()).username
-    invite_link = f"https://t.me/{bot_username}?start={invite_code}"
+    invite_code = callback_args(callback)[0]
+    invite_link = await build_start_link(invite_code)
 
     await callback.answer(f"Ссылка скопирована: {invite_link}", show_alert=True)
 
 
+# ИЗОБРАЖЕНИЯ
+# IMAGE_MODE=1 - итог партии и топ-10 отправляются картинками (Pillow)
+IMAGE_MODE = os.environ.get("IMAGE_MODE") == "1"
+IMAGE_FONT = os.environ.get("IMAGE_FONT", "DejaVuSans.ttf")  # Шрифт с кириллицей
+# Если IMAGE_FONT не найден, ищем шрифт с кириллицей среди системных (в Docker ставится fonts-dejavu-core)
+IMAGE_FONT_FALLBACKS = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/TTF/DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
+    "/usr/share/fonts/truetype/noto/NotoSans-Regular.ttf",
+    "C:\\Windows\\Fonts\\arial.ttf",
+]
+IMAGE_STYLE_VERSION = 1  # Увеличьте при изменении оформления, чтобы не отправлять старые картинки
+IMAGE_CACHE_SIZE = 10000  # Сколько file_id держим в памяти (остальные читаются из image_cache)
+image_file_ids = OrderedDict()  # хеш содержимого -> file_id, недавно использованные в конце
+
+
+def image_content_hash(kind: str, content) -> str:
+    return hashlib.sha256(repr((IMAGE_STYLE_VERSION, kind, content)).encode()).hexdigest()
+
+
+def get_image_file_id(content_hash: str) -> Optional[str]:
+    if content_hash in image_file_ids:
+        image_file_ids.move_to_end(content_hash)
+        return image_file_ids[content_hash]
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT file_id FROM image_cache WHERE content_hash = ?', (content_hash,))
+    result = cursor.fetchone()
+    conn.close()
+
+    if result:
+        remember_image_file_id(content_hash, result[0])
+        return result[0]
+    return None
+
+
+def remember_image_file_id(content_hash: str, file_id: str):
+    """Кладет file_id в память, вытесняя давно не использованные"""
+    image_file_ids[content_hash] = file_id
+    image_file_ids.move_to_end(content_hash)
+    while len(image_file_ids) > IMAGE_CACHE_SIZE:
+        image_file_ids.popitem(last=False)
+
+
+def save_image_file_id(content_hash: str, file_id: Optional[str]):
+    """Запоминает file_id картинки (None - забыть)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    if file_id:
+        remember_image_file_id(content_hash, file_id)
+        cursor.execute('INSERT OR REPLACE INTO image_cache (content_hash, file_id, created_at) VALUES (?, ?, ?)',
+                       (content_hash, file_id, datetime.now().isoformat()))
+    else:
+        image_file_ids.pop(content_hash, None)
+        cursor.execute('DELETE FROM image_cache WHERE content_hash = ?', (content_hash,))
+    conn.commit()
+    conn.close()
+
+
+@lru_cache(maxsize=1)
+def find_image_font() -> Optional[str]:
+    """Первый доступный шрифт: IMAGE_FONT, затем системные. None - подходящего шрифта нет"""
+    from PIL import ImageFont
+    for path in [IMAGE_FONT] + IMAGE_FONT_FALLBACKS:
+        try:
+            ImageFont.truetype(path, 10)
+            return path
+        except OSError:
+            continue
+    # Встроенный шрифт Pillow не содержит кириллицы: русские имена в топе будут нарисованы квадратами
+    print(f"Шрифт {IMAGE_FONT} не найден, картинки рисуются встроенным шрифтом Pillow без кириллицы")
+    return None
+
+
+def load_image_font(size: int):
+    from PIL import ImageFont
+    path = find_image_font()
+    if path:
+        return ImageFont.truetype(path, size)
+    return ImageFont.load_default(size)
+
+
+def render_board_image(board: List[List[str]]) -> bytes:
+    """Рисует поле: сетка, крестики и нолики"""
+    from PIL import Image, ImageDraw
+
+    size = len(board)
+    cell = 480 // size
+    padding = 20
+    side = cell * size + padding * 2
+    image = Image.new("RGB", (side, side), "white")
+    draw = ImageDraw.Draw(image)
+
+    for i in range(1, size):
+        offset = padding + i * cell
+        draw.line([(offset, padding), (offset, side - padding)], fill="#333333", width=4)
+        draw.line([(padding, offset), (side - padding, offset)], fill="#333333", width=4)
+
+    margin = cell // 5
+    width = max(cell // 10, 3)
+    for row in range(size):
+        for col in range(size):
+            left, top = padding + col * cell + margin, padding + row * cell + margin
+            right, bottom = padding + (col + 1) * cell - margin, padding + (row + 1) * cell - margin
+            if board[row][col] == '❌':
+                draw.line([(left, top), (right, bottom)], fill="#d62828", width=width)
+                draw.line([(left, bottom), (right, top)], fill="#d62828", width=width)
+            elif board[row][col] == '⭕':
+                draw.ellipse([left, top, right, bottom], outline="#1d4ed8", width=width)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def render_top_image(top_players: List[Tuple[int, str, int]]) -> bytes:
+    """Рисует таблицу топ-10 игроков"""
+    from PIL import Image, ImageDraw
+
+    row_height = 56
+    width, header = 640, 90
+    image = Image.new("RGB", (width, header + row_height * max(len(top_players), 1) + 20), "white")
+    draw = ImageDraw.Draw(image)
+    title_font, font = load_image_font(40), load_image_font(28)
+    medals = ["#d4af37", "#a8a9ad", "#cd7f32"]
+
+    draw.text((30, 25), "Топ-10 игроков", font=title_font, fill="#111111")
+    for i, (_, username, rating) in enumerate(top_players):
+        top = header + i * row_height
+        if i % 2 == 0:
+            draw.rectangle([0, top, width, top + row_height], fill="#f3f4f6")
+        color = medals[i] if i < len(medals) else "#6b7280"
+        draw.ellipse([24, top + 10, 60, top + 46], fill=color)
+        draw.text((42, top + 28), str(i + 1), font=font, fill="white", anchor="mm")
+        draw.text((80, top + 28), str(username)[:28], font=font, fill="#111111", anchor="lm")
+        draw.text((width - 30, top + 28), f"{rating}", font=font, fill="#111111", anchor="rm")
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+async def send_cached_image(chat_id: int, kind: str, content, render: Callable[[], bytes], **kwargs) -> Message:
+    """Отправляет картинку: по сохраненному file_id, а если его нет - рисует и загружает один раз"""
+    content_hash = image_content_hash(kind, content)
+    file_id = get_image_file_id(content_hash)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id, file_id, **kwargs)
+        except TelegramBadRequest:
+            save_image_file_id(content_hash, None)  # file_id больше не действителен
+
+    data = await asyncio.to_thread(render)
+    message = await bot.send_photo(chat_id, BufferedInputFile(data, filename=f"{kind}.png"), **kwargs)
+    save_image_file_id(content_hash, message.photo[-1].file_id)
+    return message
+
+
+async def send_board_image(chat_id: int, game: TicTacToeGame, **kwargs) -> Message:
+    board = [row[:] for row in game.board]
+    return await send_cached_image(chat_id, "board", tuple(map(tuple, board)), lambda: render_board_image(board), **kwargs)
+
+
+async def send_top_image(chat_id: int, top_players: List[Tuple[int, str, int]], **kwargs) -> Message:
+    snapshot = tuple((username, rating) for _, username, rating in top_players)
+    return await send_cached_image(chat_id, "top", snapshot, lambda: render_top_image(top_players), **kwargs)
+
+
 # ОБРАБОТЧИКИ КНОПОК ГЛАВНОГО МЕНЮ
-@router.callback_query(F.data == "find_game")
+@callback_route("find_game")
 async def find_game_handler(callback: CallbackQuery):
     user_id = callback.from_user.id
 
-    # Проверяем блокировку
     user_data = get_user_data(user_id)
-    if user_data and user_data.get('is_blocked'):
-        await callback.answer("❌ Вы заблокированы и не можете использовать бота.", show_alert=True)
-        return
 
     # Проверяем, не находится ли пользователь уже в игре
-    if is_user_in_game(user_id):
+    if await is_user_in_game(user_id):
         await callback.answer("❌ Вы уже находитесь в активной игре! Завершите текущую игру перед поиском новой.",
                               show_alert=True)
         return
 
-    if user_id in matchmaking_queue:
-        await callback.answer("⏳ Вы уже в поиске игры!")
-        return
+    if shard_outbox is not None:
+        # В шардированном режиме очередью поиска управляет координатор
+        shard_outbox.put(('mm_join', user_id, user_data['rating'] if user_data else 0))
+    else:
+        if await state_store.queue_contains(user_id):
+            await callback.answer("⏳ Вы уже в поиске игры!")
+            return
+        await state_store.queue_join(user_id, user_data['rating'] if user_data else 0)
 
-    matchmaking_queue.append(user_id)
     await callback.message.edit_text(
         "🔍 Поиск соперника...\n\n"
-        "Ищем игрока с похожим рейтингом (5 сек)",
+        f"Ищем игрока с похожим рейтингом ({MATCHMAKING_WAIT} сек)",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="❌ Отменить поиск", callback_data="cancel_search")]
         ])
     )
 
-    # Поиск соперника в течение 5 секунд
-    await asyncio.sleep(5)
-
-    if user_id not in matchmaking_queue:
+    if shard_outbox is not None:
         return
 
+    # Поиск соперника в течение 5 секунд
+    await asyncio.sleep(MATCHMAKING_WAIT)
+
     # После 5 секунд ищем любого соперника или бота
     user_data = get_user_data(user_id)
     if not user_data:
-        matchmaking_queue.remove(user_id)
+        await state_store.queue_leave(user_id)
         return
 
-    user_rating = user_data['rating']
-    opponent_found = False
-
-    for opponent_id in matchmaking_queue:
-        if opponent_id != user_id:
-            opponent_data = get_user_data(opponent_id)
-            if opponent_data:
-                opponent_rating = opponent_data['rating']
-                rating_diff = abs(user_rating - opponent_rating)
-                if rating_diff <= 300:  # Увеличиваем диапазон после 5 секунд
-                    matchmaking_queue.remove(user_id)
-                    matchmaking_queue.remove(opponent_id)
-                    await start_game(user_id, opponent_id, is_rated=True)
-                    opponent_found = True
-                    break
+    in_queue, opponent_id = await state_store.queue_pair(user_id, user_data['rating'], MATCHMAKING_RATING_RANGE)
+    if not in_queue:
+        return  # Поиск отменен или пользователя уже забрал соперник
 
-    if not opponent_found and user_id in matchmaking_queue:
-        matchmaking_queue.remove(user_id)
+    if opponent_id is not None:
+        await start_game(user_id, opponent_id, is_rated=True)
+    else:
         await start_game_with_bot(user_id, is_rated=True)
 
 
-@router.callback_query(F.data == "profile")
-async def show_profile(callback: CallbackQuery):
-    user_id = callback.from_user.id
-    user_data = get_user_data(user_id)
+PROFILE_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")]
+])
+
 
+def render_profile(user_id: int) -> Optional[str]:
+    """Текст профиля игрока (из кэша, если статистика не менялась). None - пользователь не найден"""
+    cached = profile_cache.get(user_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    user_data = get_profile_data(user_id)
     if not user_data:
-        await callback.answer("❌ Сначала зарегистрируйтесь через /start")
-        return
+        return None
 
     rank = get_user_rank(user_data['rating'])
-    position = get_user_position(user_id)
-    active_status = get_active_status(user_id)
-
     win_rate = (user_data['wins'] / user_data['games_played'] * 100) if user_data['games_played'] > 0 else 0
 
     profile_text = (
         f"👤 Профиль игрока\n\n"
         f"📛 Имя: {user_data['username']}\n"
-        f"🎯 Статус: {active_status}\n"
+        f"🎯 Статус: {user_data['active_status'] or DEFAULT_STATUS}\n"
         f"🏅 Звание: {rank['name']}\n"
         f"⭐ Рейтинг: {user_data['rating']}\n"
-        f"📊 Позиция в рейтинге: #{position}\n\n"
+        f"📊 Позиция в рейтинге: #{user_data['position']}\n\n"
         f"📈 Статистика:\n"
         f"🎮 Игр сыграно: {user_data['games_played']}\n"
         f"✅ Побед: {user_data['wins']}\n"
@@ -1714,51 +3086,33 @@ async def show_profile(callback: CallbackQuery):
         f"📊 Win Rate: {win_rate:.1f}%"
     )
 
-    await callback.message.edit_text(
-        profile_text,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")]
-        ])
-    )
+    if len(profile_cache) >= PROFILE_CACHE_SIZE:
+        profile_cache.clear()
+    profile_cache[user_id] = (time.monotonic() + PROFILE_CACHE_TTL, profile_text)
+    return profile_text
+
+
+@callback_route("profile")
+async def show_profile(callback: CallbackQuery):
+    profile_text = render_profile(callback.from_user.id)
+
+    if not profile_text:
+        await callback.answer("❌ Сначала зарегистрируйтесь через /start")
+        return
+
+    await callback.message.edit_text(profile_text, reply_markup=PROFILE_KEYBOARD)
 
 
 @router.message(Command("profile"))
 async def cmd_profile(message: Message):
     """Показывает профиль через команду"""
-    user_id = message.from_user.id
-    user_data = get_user_data(user_id)
+    profile_text = render_profile(message.from_user.id)
 
-    if not user_data:
+    if not profile_text:
         await message.answer("❌ Сначала зарегистрируйтесь через /start")
         return
 
-    rank = get_user_rank(user_data['rating'])
-    position = get_user_position(user_id)
-    active_status = get_active_status(user_id)
-
-    win_rate = (user_data['wins'] / user_data['games_played'] * 100) if user_data['games_played'] > 0 else 0
-
-    profile_text = (
-        f"👤 Профиль игрока\n\n"
-        f"📛 Имя: {user_data['username']}\n"
-        f"🎯 Статус: {active_status}\n"
-        f"🏅 Звание: {rank['name']}\n"
-        f"⭐ Рейтинг: {user_data['rating']}\n"
-        f"📊 Позиция в рейтинге: #{position}\n\n"
-        f"📈 Статистика:\n"
-        f"🎮 Игр сыграно: {user_data['games_played']}\n"
-        f"✅ Побед: {user_data['wins']}\n"
-        f"❌ Поражений: {user_data['losses']}\n"
-        f"🤝 Ничьих: {user_data['draws']}\n"
-        f"📊 Win Rate: {win_rate:.1f}%"
-    )
-
-    await message.answer(
-        profile_text,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")]
-        ])
-    )
+    await message.answer(profile_text, reply_markup=PROFILE_KEYBOARD)
 
 
 @router.message(Command("top"))
@@ -1766,6 +3120,12 @@ async def cmd_top(message: Message):
     """Показывает топ-10 через команду"""
     top_players = get_global_ranking()
 
+    if IMAGE_MODE:
+        await send_top_image(message.chat.id, top_players, reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")]
+        ]))
+        return
+
     top_text = "🏆 Топ-10 игроков:\n\n"
     for i, (user_id, username, rating) in enumerate(top_players, 1):
         rank_emoji = ["🥇", "🥈", "🥉", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟"]
@@ -1780,10 +3140,18 @@ async def cmd_top(message: Message):
     )
 
 
-@router.callback_query(F.data == "top_10")
+@callback_route("top_10")
 async def show_top_10(callback: CallbackQuery):
     top_players = get_global_ranking()
 
+    if IMAGE_MODE:
+        # Текстовое сообщение нельзя превратить в фото, отправляем картинку новым сообщением
+        await callback.answer()
+        await send_top_image(callback.message.chat.id, top_players, reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")]
+        ]))
+        return
+
     top_text = "🏆 Топ-10 игроков:\n\n"
     for i, (user_id, username, rating) in enumerate(top_players, 1):
         rank_emoji = ["🥇", "🥈", "🥉", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟"]
@@ -1798,18 +3166,12 @@ async def show_top_10(callback: CallbackQuery):
     )
 
 
-@router.callback_query(F.data == "play_friend")
+@callback_route("play_friend")
 async def play_with_friend(callback: CallbackQuery):
     user_id = callback.from_user.id
 
-    # Проверяем блокировку
-    user_data = get_user_data(user_id)
-    if user_data and user_data.get('is_blocked'):
-        await callback.answer("❌ Вы заблокированы и не можете использовать бота.", show_alert=True)
-        return
-
     # Проверяем, не находится ли пользователь уже в игре
-    if is_user_in_game(user_id):
+    if await is_user_in_game(user_id):
         await callback.answer(
             "❌ Вы уже находитесь в активной игре! Завершите текущую игру перед созданием приглашения.", show_alert=True)
         return
@@ -1826,28 +3188,72 @@ async def play_with_friend(callback: CallbackQuery):
     )
 
 
-@router.callback_query(F.data == "back_to_main")
+@callback_route("back_to_main")
 async def back_to_main(callback: CallbackQuery):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🎮 Найти игру", callback_data="find_game")],
         [InlineKeyboardButton(text="👤 Профиль", callback_data="profile"),
          InlineKeyboardButton(text="🏆 Топ-10", callback_data="top_10")],
         [InlineKeyboardButton(text="👥 Играть с другом", callback_data="play_friend")],
+        [InlineKeyboardButton(text="🧩 Большие поля", callback_data="variants")],
         [InlineKeyboardButton(text="🎁 Реферальная программа", callback_data="ref_program")]
     ])
 
-    await callback.message.edit_text(
+    # Под картинкой (топ-10) нет текста для редактирования - отправляем меню новым сообщением
+    send = callback.message.answer if callback.message.photo else callback.message.edit_text
+    await send(
         "🎯 Главное меню Крестики-Нолики!\n\n"
         "Выберите действие:",
         reply_markup=keyboard
     )
 
 
-@router.callback_query(F.data == "cancel_search")
+@callback_route("variants")
+async def variants_handler(callback: CallbackQuery):
+    """Выбор большого поля для игры с соперником"""
+    buttons = [
+        [InlineKeyboardButton(text=f"{size}×{size}, {win_length} в ряд", callback_data=f"variant:{key}")]
+        for key, (size, win_length) in BOARD_VARIANTS.items() if size > 3
+    ]
+    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")])
+
+    await callback.message.edit_text(
+        "🧩 Игра на большом поле (без рейтинга)\n\n"
+        "Выберите размер поля:",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons)
+    )
+
+
+@callback_route("variant")
+async def start_variant_handler(callback: CallbackQuery):
+    user_id = callback.from_user.id
+
+    variant = BOARD_VARIANTS.get(callback_args(callback)[0])
+    if not variant:
+        await callback.answer("❌ Неизвестный вариант поля!")
+        return
+
+    user_data = get_user_data(user_id)
+    if not user_data:
+        await callback.answer("❌ Вы не зарегистрированы. Нажмите /start", show_alert=True)
+        return
+
+    if await is_user_in_game(user_id):
+        await callback.answer("❌ Вы уже находитесь в активной игре! Завершите текущую игру перед началом новой.",
+                              show_alert=True)
+        return
+
+    size, win_length = variant
+    await callback.answer()
+    await start_game_with_bot(user_id, is_rated=False, size=size, win_length=win_length)
+
+
+@callback_route("cancel_search")
 async def cancel_search(callback: CallbackQuery):
     user_id = callback.from_user.id
-    if user_id in matchmaking_queue:
-        matchmaking_queue.remove(user_id)
+    await state_store.queue_leave(user_id)
+    if shard_outbox is not None:
+        shard_outbox.put(('mm_cancel', user_id))
 
     await callback.message.edit_text(
         "❌ Поиск отменен",
@@ -1858,33 +3264,33 @@ async def cancel_search(callback: CallbackQuery):
 
 
 # ОБРАБОТЧИКИ ИГРЫ
-@router.callback_query(F.data.startswith("move_"))
+@callback_route("m")
 async def process_move(callback: CallbackQuery):
     user_id = callback.from_user.id
+    try:
+        row, col, *rest = callback_args(callback)
+        row, col = int(row), int(col)
+    except ValueError:
+        await callback.answer("❌ Некорректный ход!")
+        return
 
-    # Находим игру
-    game = None
-    game_id = None
-    for gid, g in game_sessions.items():
-        if user_id in [g.player1, g.player2]:
-            game = g
-            game_id = gid
-            break
+    # Игра берется по id из кнопки, у старых кнопок - по игроку.
+    # Проверки и сам ход выполняются хранилищем за один вызов
+    game_id = rest[0] if rest and rest[0] else await state_store.find_player_game(user_id)
+    status, game = await state_store.apply_move(game_id, user_id, row, col) if game_id else (MOVE_NO_GAME, None)
 
-    if not game:
+    if status == MOVE_NO_GAME:
         await callback.answer("❌ Игра не найдена!")
         return
-
-    if game.current_player != user_id:
+    if status == MOVE_FINISHED:
+        await callback.answer("❌ Игра уже завершена!")
+        return
+    if status == MOVE_NOT_TURN:
         await callback.answer("⏳ Сейчас не ваш ход!")
         return
 
-    # Парсим ход
-    _, row, col = callback.data.split('_')
-    row, col = int(row), int(col)
-
-    # Делаем ход
-    if game.make_move(row, col, user_id):
+    if game:
+        log_move(game_id, game, row, col)
         game.save_to_db(game_id)
 
         # Отменяем старую задачу таймаута и запускаем новую
@@ -1937,16 +3343,17 @@ async def update_game_messages(game: TicTacToeGame, game_id: str, action_text: s
                         chat_id=player_id,
                         message_id=game.message_ids[player_id],
                         text=f"🎮 Игра идет...\n{current_player_name}\n\n{board_text}",
-                        reply_markup=game.get_keyboard()
+                        reply_markup=game.get_keyboard(game_id)
                     )
                 except:
                     # Если не удалось редактировать, отправляем новое сообщение
                     msg = await bot.send_message(
                         player_id,
                         f"🎮 Игра идет...\n{current_player_name}\n\n{board_text}",
-                        reply_markup=game.get_keyboard()
+                        reply_markup=game.get_keyboard(game_id)
                     )
                     game.message_ids[player_id] = msg.message_id
+                    await state_store.save_game(game_id, game)
 
 
 async def make_bot_move(game: TicTacToeGame, game_id: str):
@@ -1956,7 +3363,9 @@ async def make_bot_move(game: TicTacToeGame, game_id: str):
     difficulty = rank['bot_difficulty']
 
     # Умный ИИ в зависимости от сложности
-    if difficulty >= 5:
+    if difficulty >= 6:
+        move = await compute_search_move(game)
+    elif difficulty >= 5:
         move = find_best_move(game)
     elif difficulty >= 3:
         if random.random() > 0.3:
@@ -1968,7 +3377,10 @@ async def make_bot_move(game: TicTacToeGame, game_id: str):
 
     if move:
         row, col = move
-        game.make_move(row, col, -1)
+        status, game = await state_store.apply_move(game_id, -1, row, col)
+        if status != MOVE_OK:
+            return
+        log_move(game_id, game, row, col)
         game.save_to_db(game_id)
 
         if game.winner:
@@ -1982,18 +3394,20 @@ async def make_bot_move(game: TicTacToeGame, game_id: str):
 
 def find_random_move(game):
     available_moves = []
-    for i in range(3):
-        for j in range(3):
+    for i in range(game.size):
+        for j in range(game.size):
             if game.board[i][j] == ' ':
                 available_moves.append((i, j))
     return random.choice(available_moves) if available_moves else None
 
 
 def find_good_move(game):
-    if game.board[1][1] == ' ':
-        return (1, 1)
+    center = game.size // 2
+    if game.board[center][center] == ' ':
+        return (center, center)
 
-    corners = [(0, 0), (0, 2), (2, 0), (2, 2)]
+    last = game.size - 1
+    corners = [(0, 0), (0, last), (last, 0), (last, last)]
     random.shuffle(corners)
     for i, j in corners:
         if game.board[i][j] == ' ':
@@ -2004,14 +3418,15 @@ def find_good_move(game):
 
 def find_best_move(game):
     available_moves = []
-    for i in range(3):
-        for j in range(3):
+    for i in range(game.size):
+        for j in range(game.size):
             if game.board[i][j] == ' ':
                 available_moves.append((i, j))
 
     # Проверяем выигрышные ходы
     for i, j in available_moves:
-        temp_game = TicTacToeGame(game.player1, game.player2, game.is_vs_bot, game.is_rated)
+        temp_game = TicTacToeGame(game.player1, game.player2, game.is_vs_bot, game.is_rated,
+                                  game.size, game.win_length)
         temp_game.board = [row[:] for row in game.board]
         temp_game.current_player = game.current_player
         temp_game.make_move(i, j, -1)
@@ -2020,7 +3435,8 @@ def find_best_move(game):
 
     # Блокируем выигрышные ходы противника
     for i, j in available_moves:
-        temp_game = TicTacToeGame(game.player1, game.player2, game.is_vs_bot, game.is_rated)
+        temp_game = TicTacToeGame(game.player1, game.player2, game.is_vs_bot, game.is_rated,
+                                  game.size, game.win_length)
         temp_game.board = [row[:] for row in game.board]
         temp_game.current_player = game.player1
         temp_game.make_move(i, j, game.player1)
@@ -2030,50 +3446,306 @@ def find_best_move(game):
     return find_good_move(game)
 
 
+class SearchTimeout(Exception):
+    pass
+
+
+@lru_cache(maxsize=None)
+def get_win_windows(size: int, win_length: int) -> Tuple[Tuple[int, ...], ...]:
+    """Все отрезки длины win_length на поле (индексы клеток плоского поля)"""
+    windows = []
+    for r in range(size):
+        for c in range(size):
+            for dr, dc in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                end_r, end_c = r + dr * (win_length - 1), c + dc * (win_length - 1)
+                if 0 <= end_r < size and 0 <= end_c < size:
+                    windows.append(tuple((r + dr * k) * size + c + dc * k for k in range(win_length)))
+    return tuple(windows)
+
+
+@lru_cache(maxsize=None)
+def get_zobrist_keys(size: int) -> Tuple[Tuple[int, int, int], ...]:
+    """Случайные ключи для хеширования позиций (по клетке на каждого игрока)"""
+    rng = random.Random(size)
+    return tuple((0, rng.getrandbits(64), rng.getrandbits(64)) for _ in range(size * size))
+
+
+class AlphaBetaSearch:
+    """Итеративное углубление с альфа-бета отсечением и таблицей транспозиций.
+
+    Поле хранится плоским списком: 0 - пусто, 1 - ходящий сейчас игрок, 2 - его соперник.
+    """
+
+    WIN_SCORE = 10 ** 9
+    EXACT, LOWER, UPPER = 0, 1, 2
+
+    def __init__(self, game: TicTacToeGame, time_budget: float):
+        self.size = game.size
+        self.win_length = game.win_length
+        me = game.symbols[game.current_player]
+        self.cells = [0 if cell == ' ' else (1 if cell == me else 2) for row in game.board for cell in row]
+        self.empty_count = self.cells.count(0)
+        self.windows = get_win_windows(self.size, self.win_length)
+        self.zobrist = get_zobrist_keys(self.size)
+        self.hash = 0
+        for idx, who in enumerate(self.cells):
+            if who:
+                self.hash ^= self.zobrist[idx][who]
+        self.deadline = time.monotonic() + time_budget
+        self.table = {}
+        self.nodes = 0
+        self.root_move = None
+
+    def run(self) -> Optional[Tuple[int, int]]:
+        moves = self.candidate_moves()
+        if not moves:
+            return None
+
+        best_move = moves[0]
+        for depth in range(1, self.empty_count + 1):
+            try:
+                score = self.negamax(depth, -self.WIN_SCORE - 1, self.WIN_SCORE + 1, 1, 0)
+            except SearchTimeout:
+                break
+            best_move = self.root_move
+            if abs(score) >= self.WIN_SCORE - self.size * self.size:
+                break  # Исход партии уже просчитан до конца
+        return divmod(best_move, self.size)
+
+    def place(self, idx: int, who: int):
+        self.cells[idx] = who
+        self.hash ^= self.zobrist[idx][who]
+        self.empty_count -= 1
+
+    def unplace(self, idx: int, who: int):
+        self.cells[idx] = 0
+        self.hash ^= self.zobrist[idx][who]
+        self.empty_count += 1
+
+    def is_win_at(self, idx: int, who: int) -> bool:
+        """Проверяет только линии, проходящие через последний ход"""
+        size, cells = self.size, self.cells
+        row, col = divmod(idx, size)
+        for dr, dc in ((0, 1), (1, 0), (1, 1), (1, -1)):
+            length = 1
+            for sign in (1, -1):
+                r, c = row + dr * sign, col + dc * sign
+                while 0 <= r < size and 0 <= c < size and cells[r * size + c] == who:
+                    length += 1
+                    r += dr * sign
+                    c += dc * sign
+            if length >= self.win_length:
+                return True
+        return False
+
+    def candidate_moves(self, first: int = None) -> List[int]:
+        """Свободные клетки; на больших полях - только рядом с уже занятыми"""
+        size, cells = self.size, self.cells
+        center = (size - 1) / 2
+        if size <= 3 or self.empty_count == size * size:
+            moves = [idx for idx in range(size * size) if cells[idx] == 0]
+        else:
+            moves = []
+            for idx in range(size * size):
+                if cells[idx]:
+                    continue
+                row, col = divmod(idx, size)
+                for r in range(max(0, row - 1), min(size, row + 2)):
+                    if any(cells[r * size + c] for c in range(max(0, col - 1), min(size, col + 2))):
+                        moves.append(idx)
+                        break
+        moves.sort(key=lambda idx: abs(idx // size - center) + abs(idx % size - center))
+        if first is not None and first in moves:
+            moves.remove(first)
+            moves.insert(0, first)
+        return moves
+
+    def evaluate(self) -> int:
+        """Оценка позиции для ходящего игрока по незаблокированным отрезкам"""
+        score = 0
+        cells = self.cells
+        for window in self.windows:
+            mine = theirs = 0
+            for idx in window:
+                who = cells[idx]
+                if who == 1:
+                    mine += 1
+                elif who == 2:
+                    theirs += 1
+            if mine and not theirs:
+                score += 10 ** mine
+            elif theirs and not mine:
+                score -= 10 ** theirs
+        return score
+
+    def negamax(self, depth: int, alpha: int, beta: int, player: int, ply: int) -> int:
+        self.nodes += 1
+        if self.nodes & 1023 == 0 and time.monotonic() > self.deadline:
+            raise SearchTimeout()
+
+        entry = self.table.get(self.hash)
+        table_move = None
+        if entry:
+            entry_depth, entry_value, entry_flag, table_move = entry
+            if entry_depth >= depth and ply > 0:
+                if entry_flag == self.EXACT:
+                    return entry_value
+                if entry_flag == self.LOWER:
+                    alpha = max(alpha, entry_value)
+                elif entry_flag == self.UPPER:
+                    beta = min(beta, entry_value)
+                if alpha >= beta:
+                    return entry_value
+
+        if depth == 0:
+            value = self.evaluate()
+            return value if player == 1 else -value
+
+        moves = self.candidate_moves(table_move)
+        if not moves:
+            return 0
+
+        original_alpha = alpha
+        best_value = -self.WIN_SCORE - 1
+        best_move = moves[0]
+        for idx in moves:
+            self.place(idx, player)
+            try:
+                if self.is_win_at(idx, player):
+                    value = self.WIN_SCORE - ply  # Быстрая победа лучше медленной
+                elif self.empty_count == 0:
+                    value = 0
+                else:
+                    value = -self.negamax(depth - 1, -beta, -alpha, 3 - player, ply + 1)
+            finally:
+                self.unplace(idx, player)
+
+            if value > best_value:
+                best_value, best_move = value, idx
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                break
+
+        if best_value <= original_alpha:
+            flag = self.UPPER
+        elif best_value >= beta:
+            flag = self.LOWER
+        else:
+            flag = self.EXACT
+        self.table[self.hash] = (depth, best_value, flag, best_move)
+        if ply == 0:
+            self.root_move = best_move
+        return best_value
+
+
+def find_search_move(game, time_budget: float = BOT_SEARCH_TIME):
+    """Сильный ход: поиск с альфа-бета отсечением в пределах time_budget секунд"""
+    return AlphaBetaSearch(game, time_budget).run()
+
+
+# Пул процессов для поиска хода и его метрики
+bot_search_pool = None
+bot_search_pool_ready = []  # Прогревочные задачи: выполнены - значит процессы пула запущены
+bot_search_stats = {
+    'searches': 0,  # Сколько раз запускали поиск
+    'fallbacks': 0,  # Сколько раз не уложились в срок и сходили find_good_move
+    'queued': 0,  # Сколько поисков сейчас ждут или выполняются в пуле
+    'total_time': 0.0,
+    'max_time': 0.0
+}
+
+
+def start_bot_search_pool():
+    """Создает пул и заранее поднимает процессы, чтобы первый ход не ждал их запуска"""
+    global bot_search_pool, bot_search_pool_ready
+    if bot_search_pool is None:
+        bot_search_pool = ProcessPoolExecutor(
+            max_workers=BOT_SEARCH_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        bot_search_pool_ready = [bot_search_pool.submit(get_win_windows, 3, 3) for _ in range(BOT_SEARCH_WORKERS)]
+    return bot_search_pool
+
+
+async def warm_bot_search_pool():
+    """Создает пул и ждет, пока его процессы запустятся"""
+    global bot_search_pool_ready
+    start_bot_search_pool()
+    if bot_search_pool_ready:
+        await asyncio.wait_for(
+            asyncio.gather(*(asyncio.wrap_future(future) for future in bot_search_pool_ready)),
+            BOT_SEARCH_POOL_START_TIMEOUT
+        )
+        bot_search_pool_ready = []
+
+
+def shutdown_bot_search_pool():
+    global bot_search_pool, bot_search_pool_ready
+    if bot_search_pool is not None:
+        bot_search_pool.shutdown(wait=False, cancel_futures=True)
+        bot_search_pool = None
+        bot_search_pool_ready = []
+
+
+async def compute_search_move(game: TicTacToeGame) -> Optional[Tuple[int, int]]:
+    """Считает ход поиском в пуле процессов; если не успели к сроку - ход попроще.
+    Поиск никогда не выполняется прямо в цикле событий"""
+    pool = start_bot_search_pool() if BOT_SEARCH_WORKERS > 0 else None
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    bot_search_stats['searches'] += 1
+    bot_search_stats['queued'] += 1
+    try:
+        if pool is not None:
+            # Запуск процессов (первый поиск, если пул не прогрели при старте) не входит в срок на ход
+            await warm_bot_search_pool()
+            started = time.monotonic()
+        # pool=None - стандартный пул потоков
+        move = await asyncio.wait_for(
+            loop.run_in_executor(pool, find_search_move, game, BOT_SEARCH_TIME),
+            BOT_SEARCH_DEADLINE
+        )
+    except Exception as e:
+        print(f"Поиск хода не уложился в срок или упал: {e!r}")
+        bot_search_stats['fallbacks'] += 1
+        move = find_good_move(game)
+    finally:
+        bot_search_stats['queued'] -= 1
+        elapsed = time.monotonic() - started
+        bot_search_stats['total_time'] += elapsed
+        bot_search_stats['max_time'] = max(bot_search_stats['max_time'], elapsed)
+    return move
+
+
 async def finish_game(game: TicTacToeGame, game_id: str):
     winner_text = ""
     rating_changes = {}
 
-    # Обновляем реферальную статистику для всех игроков
-    for player_id in [game.player1, game.player2]:
-        if player_id != -1:  # Не бот
-            # Ищем реферальные связи где этот игрок является рефералом
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute('SELECT referrer_id FROM referrals WHERE referred_id = ? AND is_completed = FALSE',
-                           (player_id,))
-            referrals = cursor.fetchall()
-            conn.close()
-
-            for (referrer_id,) in referrals:
-                update_referral_games(referrer_id, player_id)
-
-                # Проверяем условия завершения реферала
-                referral_data = get_referral_data(referrer_id, player_id)
-                user_data = get_user_data(player_id)
-
-                if (referral_data and user_data and
-                        referral_data['games_played'] >= REF_REQUIRED_GAMES and
-                        user_data['rating'] >= 100):  # Звание Любитель
-                    complete_referral(referrer_id, player_id)
-
-                    # Уведомляем реферера
-                    try:
-                        referrer_data = get_user_data(referrer_id)
-                        await bot.send_message(
-                            referrer_id,
-                            f"🎉 Ваш реферал выполнил все условия!\n\n"
-                            f"👤 Пользователь: @{user_data['username']}\n"
-                            f"✅ Игр сыграно: {referral_data['games_played']}\n"
-                            f"🏅 Достиг звания: {get_user_rank(user_data['rating'])['name']}\n\n"
-                            f"Теперь у вас +1 завершенный реферал!\n"
-                            f"Всего завершенных: {get_completed_referrals_count(referrer_id)}"
-                        )
-                    except:
-                        pass
+    # Обновляем реферальную статистику для всех игроков (одним запросом)
+    for referral in advance_referrals([player_id for player_id in [game.player1, game.player2] if player_id != -1]):
+        # Уведомляем реферера
+        try:
+            await bot.send_message(
+                referral['referrer_id'],
+                f"🎉 Ваш реферал выполнил все условия!\n\n"
+                f"👤 Пользователь: @{referral['username']}\n"
+                f"✅ Игр сыграно: {referral['games_played']}\n"
+                f"🏅 Достиг звания: {get_user_rank(referral['rating'])['name']}\n\n"
+                f"Теперь у вас +1 завершенный реферал!\n"
+                f"Всего завершенных: {get_completed_referrals_count(referral['referrer_id'])}"
+            )
+        except:
+            pass
 
     if game.winner == 'draw':
         winner_text = "🤝 Ничья!"
+        # По Эло ничья с более сильным соперником повышает рейтинг
+        draw_change = 0
+        if game.is_rated and not game.is_vs_bot and RATING_MODEL == "elo":
+            player1_data = get_user_data(game.player1)
+            player2_data = get_user_data(game.player2)
+            if player1_data and player2_data:
+                draw_change, _ = calculate_rating_change(player1_data['rating'], player2_data['rating'], is_draw=True)
         # Обновляем статистику
         for player_id in [game.player1, game.player2]:
             if player_id != -1:  # Не бот
@@ -2081,6 +3753,10 @@ async def finish_game(game: TicTacToeGame, game_id: str):
                 if user_data:
                     user_data['games_played'] += 1
                     user_data['draws'] += 1
+                    if draw_change:
+                        change = draw_change if player_id == game.player1 else -draw_change
+                        user_data['rating'] += change
+                        rating_changes[player_id] = change
                     save_user_data(user_data)
                     update_last_game_time(player_id)
     else:
@@ -2095,7 +3771,7 @@ async def finish_game(game: TicTacToeGame, game_id: str):
                 if game.is_rated:
                     if loser_id != -1:  # Против реального игрока
                         winner_rating = winner_data['rating']
-                        loser_rating = loser_data['rating'] if loser_data else 100
+                        loser_rating = loser_data['rating'] if loser_data else NEW_USER_RATING
                         win_change, lose_change = calculate_rating_change(winner_rating, loser_rating)
 
                         # Обновляем рейтинг победителя
@@ -2166,15 +3842,25 @@ async def finish_game(game: TicTacToeGame, game_id: str):
                 rating_change = rating_changes.get(player_id)
                 rating_text = f"\nИзменение рейтинга: {rating_change}⭐" if rating_change else ""
 
+                # В режиме картинок поле отправляется отдельным изображением
+                board_text = f"{game.get_board_display()}\n"
+                if IMAGE_MODE:
+                    try:
+                        await send_board_image(player_id, game)
+                        board_text = ""
+                    except Exception as e:
+                        print(f"Ошибка отправки картинки поля: {e}")
+
                 final_message = (
                     f"🎮 Игра завершена!\n\n"
-                    f"{game.get_board_display()}\n"
+                    f"{board_text}"
                     f"{winner_text}{rating_text}\n\n"
                     f"Ваш рейтинг: {user_data['rating']}⭐"
                 )
 
                 keyboard = InlineKeyboardMarkup(inline_keyboard=[
                     [InlineKeyboardButton(text="🎮 Новая игра", callback_data="find_game")],
+                    [InlineKeyboardButton(text="🎞 Повтор партии", callback_data=f"replay:0:{game_id}")],
                     [InlineKeyboardButton(text="👤 Профиль", callback_data="profile")],
                     [InlineKeyboardButton(text="📋 Меню", callback_data="back_to_main")]
                 ])
@@ -2186,15 +3872,19 @@ async def finish_game(game: TicTacToeGame, game_id: str):
                 )
 
     # Удаляем игру
-    if game_id in game_sessions:
-        del game_sessions[game_id]
+    await remove_game_session(game_id, game, game.winner)
 
 
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ДЛЯ ИГРЫ
 async def start_game(player1: int, player2: int, is_rated: bool = True, chat_id: int = None):
     game_id = f"{player1}_{player2}_{datetime.now().timestamp()}"
     game = TicTacToeGame(player1, player2, is_rated=is_rated)
-    game_sessions[game_id] = game
+    await state_store.create_game(game_id, game)
+    log_game_start(game_id)
+
+    # Все апдейты обоих игроков должны приходить в шард, где живет игра
+    if shard_outbox is not None:
+        shard_outbox.put(('pin', SHARD_INDEX, [player1, player2], game_id))
 
     player1_data = get_user_data(player1)
     player2_data = get_user_data(player2)
@@ -2221,40 +3911,49 @@ async def start_game(player1: int, player2: int, is_rated: bool = True, chat_id:
         msg = await bot.send_message(
             player_id,
             text,
-            reply_markup=game.get_keyboard()
+            reply_markup=game.get_keyboard(game_id)
         )
         game.message_ids[player_id] = msg.message_id
 
+    await state_store.save_game(game_id, game)
     game.save_to_db(game_id)
 
 
-async def start_game_with_bot(player_id: int, is_rated: bool = True, chat_id: int = None):
+async def start_game_with_bot(player_id: int, is_rated: bool = True, chat_id: int = None,
+                              size: int = 3, win_length: int = 3):
     game_id = f"{player_id}_bot_{datetime.now().timestamp()}"
     user_data = get_user_data(player_id)
 
     # Создаем игру с ботом, но не показываем что это бот
-    game = TicTacToeGame(player_id, -1, is_vs_bot=True, is_rated=is_rated)
-    game_sessions[game_id] = game
+    game = TicTacToeGame(player_id, -1, is_vs_bot=True, is_rated=is_rated, size=size, win_length=win_length)
+    await state_store.create_game(game_id, game)
+    log_game_start(game_id)
+
+    if shard_outbox is not None:
+        shard_outbox.put(('pin', SHARD_INDEX, [player_id], game_id))
 
     rated_text = " (на рейтинг)" if is_rated else " (без рейтинга)"
 
     # Запускаем задачу проверки таймаута
     move_timeout_tasks[game_id] = asyncio.create_task(check_move_timeout(game_id))
 
+    goal_text = f"Цель: {win_length} в ряд\n" if size != 3 else ""
     text = (
         f"🎮 Игра началась{rated_text}!\n"
         f"Соперник: {game.bot_name}\n"
-        f"Ваш символ: {game.symbols[player_id]}\n\n"
+        f"Ваш символ: {game.symbols[player_id]}\n"
+        f"{goal_text}\n"
         f"{game.get_board_display()}"
     )
 
     msg = await bot.send_message(
         player_id,
         text,
-        reply_markup=game.get_keyboard()
+        reply_markup=game.get_keyboard(game_id)
     )
     game.message_ids[player_id] = msg.message_id
 
+    await state_store.save_game(game_id, game)
     game.save_to_db(game_id)
 
 
@@ -2279,7 +3978,7 @@ async def cmd_sms(message: Message, state: FSMContext):
     await state.set_state(SMSStates.waiting_text)
 
 
-@router.callback_query(F.data == "skip_text")
+@callback_route("skip_text")
 async def skip_text(callback: CallbackQuery, state: FSMContext):
     await state.update_data(text=None)
     await callback.message.edit_text(
@@ -2303,9 +4002,33 @@ async def process_sms_text(message: Message, state: FSMContext):
     await state.set_state(SMSStates.waiting_photo)
 
 
-@router.callback_query(F.data == "skip_photo")
+MEDIA_GROUP_LIMIT = 10  # Telegram: не больше 10 фото и видео в одном альбоме
+# Файлы альбома приходят отдельными апдейтами и обрабатываются параллельно: без блокировки
+# два обработчика читают один и тот же список и последний затирает файл первого
+broadcast_media_locks: Dict[int, asyncio.Lock] = {}
+
+
+async def add_broadcast_media(message: Message, state: FSMContext, key: str, file_id: str, next_callback: str):
+    """Добавляет фото/видео к рассылке. Несколько файлов отправляются одним альбомом"""
+    lock = broadcast_media_locks.setdefault(message.from_user.id, asyncio.Lock())
+    async with lock:
+        data = await state.get_data()
+        if len(data.get('photos', [])) + len(data.get('videos', [])) >= MEDIA_GROUP_LIMIT:
+            await message.answer(f"❌ В одном альбоме не больше {MEDIA_GROUP_LIMIT} фото и видео.")
+            return
+
+        files = data.get(key, []) + [file_id]
+        await state.update_data(**{key: files})
+    await message.answer(
+        f"✅ Добавлено: {len(files)}. Отправьте еще или нажмите 'Далее':",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="➡️ Далее", callback_data=next_callback)]
+        ])
+    )
+
+
+@callback_route("skip_photo")
 async def skip_photo(callback: CallbackQuery, state: FSMContext):
-    await state.update_data(photo=None)
     await callback.message.edit_text(
         "🎥 Хотите добавить видео? Отправьте видео или нажмите 'Пропустить':",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
@@ -2318,9 +4041,8 @@ async def skip_photo(callback: CallbackQuery, state: FSMContext):
 @router.message(SMSStates.waiting_photo)
 async def process_sms_photo(message: Message, state: FSMContext):
     if message.photo:
-        await state.update_data(photo=message.photo[-1].file_id)
-    else:
-        await state.update_data(photo=None)
+        await add_broadcast_media(message, state, 'photos', message.photo[-1].file_id, "skip_photo")
+        return
 
     await message.answer(
         "🎥 Хотите добавить видео? Отправьте видео или нажмите 'Пропустить':",
@@ -2331,9 +4053,8 @@ async def process_sms_photo(message: Message, state: FSMContext):
     await state.set_state(SMSStates.waiting_video)
 
 
-@router.callback_query(F.data == "skip_video")
+@callback_route("skip_video")
 async def skip_video(callback: CallbackQuery, state: FSMContext):
-    await state.update_data(video=None)
     await callback.message.edit_text(
         "🔄 Хотите добавить GIF? Отправьте GIF или нажмите 'Пропустить':",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
@@ -2346,9 +4067,8 @@ async def skip_video(callback: CallbackQuery, state: FSMContext):
 @router.message(SMSStates.waiting_video)
 async def process_sms_video(message: Message, state: FSMContext):
     if message.video:
-        await state.update_data(video=message.video.file_id)
-    else:
-        await state.update_data(video=None)
+        await add_broadcast_media(message, state, 'videos', message.video.file_id, "skip_video")
+        return
 
     await message.answer(
         "🔄 Хотите добавить GIF? Отправьте GIF или нажмите 'Пропустить':",
@@ -2359,7 +4079,7 @@ async def process_sms_video(message: Message, state: FSMContext):
     await state.set_state(SMSStates.waiting_gif)
 
 
-@router.callback_query(F.data == "skip_gif")
+@callback_route("skip_gif")
 async def skip_gif(callback: CallbackQuery, state: FSMContext):
     await state.update_data(gif=None)
     await callback.message.edit_text(
@@ -2393,7 +4113,7 @@ async def process_sms_gif(message: Message, state: FSMContext):
     await state.set_state(SMSStates.waiting_buttons)
 
 
-@router.callback_query(F.data == "skip_buttons")
+@callback_route("skip_buttons")
 async def skip_buttons(callback: CallbackQuery, state: FSMContext):
     await state.update_data(buttons=None)
     await send_broadcast_message(callback, state)
@@ -2409,62 +4129,86 @@ async def process_sms_buttons(message: Message, state: FSMContext):
     await send_broadcast_message(message, state)
 
 
+def build_broadcast_keyboard(buttons_text: Optional[str]) -> Optional[InlineKeyboardMarkup]:
+    """Кнопки-ссылки из строк вида 'Текст - ссылка'"""
+    if not buttons_text:
+        return None
+    buttons = []
+    for line in buttons_text.split('\n'):
+        if ' - ' in line:
+            text, url = line.split(' - ', 1)
+            buttons.append([InlineKeyboardButton(text=text.strip(), url=url.strip())])
+    return InlineKeyboardMarkup(inline_keyboard=buttons) if buttons else None
+
+
+async def send_broadcast_payload(chat_id: int, data: dict, keyboard: Optional[InlineKeyboardMarkup]) -> List[Message]:
+    """Отправляет сообщение рассылки одному получателю. Возвращает отправленные сообщения"""
+    text = data.get('text')
+    media = [InputMediaPhoto(media=file_id) for file_id in data.get('photos', [])]
+    media += [InputMediaVideo(media=file_id) for file_id in data.get('videos', [])]
+
+    if len(media) > 1:
+        # У альбома не бывает кнопок: подпись у первого файла, кнопки отдельным сообщением
+        media[0].caption = text
+        messages = await bot.send_media_group(chat_id, media)
+        if keyboard:
+            messages.append(await bot.send_message(chat_id, "⬇️", reply_markup=keyboard))
+        return messages
+    if data.get('photos'):
+        return [await bot.send_photo(chat_id, data['photos'][0], caption=text or '', reply_markup=keyboard)]
+    if data.get('videos'):
+        return [await bot.send_video(chat_id, data['videos'][0], caption=text or '', reply_markup=keyboard)]
+    if data.get('gif'):
+        return [await bot.send_animation(chat_id, data['gif'], caption=text or '', reply_markup=keyboard)]
+    return [await bot.send_message(chat_id, text or '📢 Сообщение от администратора', reply_markup=keyboard)]
+
+
+def pin_broadcast_file_ids(data: dict, messages: List[Message]) -> dict:
+    """Берет file_id из уже отправленных сообщений: дальше рассылка идет по проверенным file_id"""
+    photos = [m.photo[-1].file_id for m in messages if m.photo]
+    videos = [m.video.file_id for m in messages if m.video]
+    gifs = [m.animation.file_id for m in messages if m.animation]
+    return {
+        **data,
+        'photos': photos or data.get('photos', []),
+        'videos': videos or data.get('videos', []),
+        'gif': gifs[0] if gifs else data.get('gif'),
+    }
+
+
 async def send_broadcast_message(update, state: FSMContext):
     data = await state.get_data()
+    message = update.message if isinstance(update, CallbackQuery) else update
+    await state.clear()
 
     # Создаем клавиатуру из кнопок
     keyboard = None
-    if data.get('buttons'):
-        try:
-            buttons = []
-            for line in data['buttons'].split('\n'):
-                if ' - ' in line:
-                    text, url = line.split(' - ', 1)
-                    buttons.append([InlineKeyboardButton(text=text.strip(), url=url.strip())])
-            if buttons:
-                keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-        except Exception as e:
-            print(f"Ошибка создания кнопок: {e}")
+    try:
+        keyboard = build_broadcast_keyboard(data.get('buttons'))
+    except Exception as e:
+        print(f"Ошибка создания кнопок: {e}")
+
+    # Сначала отправляем сообщение админу: если оно некорректно (ссылка, файл, длина подписи),
+    # рассылка не начинается и ошибка не повторяется для каждого пользователя
+    try:
+        await message.answer("👀 Так будет выглядеть рассылка:")
+        data = pin_broadcast_file_ids(data, await send_broadcast_payload(message.chat.id, data, keyboard))
+    except Exception as e:
+        await message.answer(f"❌ Сообщение не удалось отправить, рассылка отменена:\n{e}")
+        return
 
     # Получаем всех пользователей (только ЛС, не чаты)
-    users = get_all_users()
-    success_count = 0
+    all_users = get_all_users()
+    users = [user_id for user_id in all_users if user_id != message.chat.id]
+    # Админ уже получил сообщение, но в статистику он входит, только если сам есть среди получателей
+    success_count = len(all_users) - len(users)
     fail_count = 0
 
-    if isinstance(update, CallbackQuery):
-        await update.answer("🔄 Начинаю рассылку сообщений...")
-    else:
-        await update.answer("🔄 Начинаю рассылку сообщений...")
+    await message.answer("🔄 Начинаю рассылку сообщений...")
 
     for user_id in users:
         try:
-            if data.get('photo'):
-                await bot.send_photo(
-                    chat_id=user_id,
-                    photo=data['photo'],
-                    caption=data.get('text', ''),
-                    reply_markup=keyboard
-                )
-            elif data.get('video'):
-                await bot.send_video(
-                    chat_id=user_id,
-                    video=data['video'],
-                    caption=data.get('text', ''),
-                    reply_markup=keyboard
-                )
-            elif data.get('gif'):
-                await bot.send_animation(
-                    chat_id=user_id,
-                    animation=data['gif'],
-                    caption=data.get('text', ''),
-                    reply_markup=keyboard
-                )
-            else:
-                await bot.send_message(
-                    chat_id=user_id,
-                    text=data.get('text', '📢 Сообщение от администратора'),
-                    reply_markup=keyboard
-                )
+            await send_broadcast_payload(user_id, data, keyboard)
             success_count += 1
         except Exception as e:
             print(f"Ошибка отправки пользователю {user_id}: {e}")
@@ -2481,12 +4225,7 @@ async def send_broadcast_message(update, state: FSMContext):
         f"❌ Ошибок: {fail_count}"
     )
 
-    if isinstance(update, CallbackQuery):
-        await update.message.answer(report_message)
-    else:
-        await update.answer(report_message)
-
-    await state.clear()
+    await message.answer(report_message)
 
 
 # АДМИН ПАНЕЛЬ
@@ -2500,7 +4239,8 @@ async def cmd_apanel(message: Message):
         [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
         [InlineKeyboardButton(text="🚫 Заблокировать пользователя", callback_data="admin_block")],
         [InlineKeyboardButton(text="✅ Разблокировать пользователя", callback_data="admin_unblock")],
-        [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")]
+        [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")],
+        [InlineKeyboardButton(text="🧹 Обслуживание БД", callback_data="admin_maintenance")]
     ])
 
     await message.answer(
@@ -2510,12 +4250,12 @@ async def cmd_apanel(message: Message):
     )
 
 
-@router.callback_query(F.data == "admin_stats")
+@callback_route("admin_stats")
 async def admin_stats(callback: CallbackQuery, state: FSMContext):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="1 день", callback_data="stats_24")],
-        [InlineKeyboardButton(text="1 неделя", callback_data="stats_168")],
-        [InlineKeyboardButton(text="1 месяц", callback_data="stats_720")]
+        [InlineKeyboardButton(text="1 день", callback_data="stats:24")],
+        [InlineKeyboardButton(text="1 неделя", callback_data="stats:168")],
+        [InlineKeyboardButton(text="1 месяц", callback_data="stats:720")]
     ])
 
     await callback.message.edit_text(
@@ -2524,10 +4264,9 @@ async def admin_stats(callback: CallbackQuery, state: FSMContext):
     )
 
 
-@router.callback_query(F.data.startswith("stats_"))
+@callback_route("stats")
 async def show_stats(callback: CallbackQuery):
-    period = callback.data.replace("stats_", "")
-    period_hours = int(period)
+    period_hours = int(callback_args(callback)[0])
 
     stats = get_stats(period_hours)
 
@@ -2544,7 +4283,8 @@ async def show_stats(callback: CallbackQuery):
         f"👤 Новые пользователи: {stats['new_users']}\n"
         f"🎮 Сыграно игр: {stats['games_played']}\n"
         f"😴 Неактивных пользователей: {stats['inactive_users']}\n"
-        f"💬 Новых чатов: {stats['new_chats']}"
+        f"💬 Новых чатов: {stats['new_chats']}\n\n"
+        f"🚦 Отброшено частых нажатий с запуска: {format_throttle_stats()}"
     )
 
     await callback.message.edit_text(
@@ -2555,60 +4295,64 @@ async def show_stats(callback: CallbackQuery):
     )
 
 
-@router.callback_query(F.data == "admin_block")
+USER_REFS_PROMPT = "username или ID (id:123). Можно несколько: с новой строки или через запятую"
+
+
+def format_block_report(found: List[Tuple[int, str]], not_found: List[str], action: str) -> str:
+    lines = [f"✅ {action}: {len(found)}"]
+    lines += [f"• @{username} ({user_id})" for user_id, username in found[:50]]
+    if len(found) > 50:
+        lines.append(f"… и еще {len(found) - 50}")
+    if not_found:
+        lines.append(f"\n❌ Не найдены: {', '.join(not_found)}")
+    return "\n".join(lines)
+
+
+@callback_route("admin_block")
 async def admin_block(callback: CallbackQuery, state: FSMContext):
     await callback.message.edit_text(
-        "🚫 Введите username пользователя для блокировки (без @):"
+        f"🚫 Введите пользователей для блокировки ({USER_REFS_PROMPT}):"
     )
     await state.set_state(AdminStates.waiting_username_for_block)
 
 
 @router.message(AdminStates.waiting_username_for_block)
 async def process_block_user(message: Message, state: FSMContext):
-    username = message.text.strip()
-
-    if block_user(username):
-        await message.answer(f"✅ Пользователь @{username} заблокирован!")
-    else:
-        await message.answer(f"❌ Пользователь @{username} не найден!")
-
+    found, not_found = set_users_blocked(parse_user_refs(message.text or ''), True)
+    await message.answer(format_block_report(found, not_found, "Заблокировано"))
     await state.clear()
 
 
-@router.callback_query(F.data == "admin_unblock")
+@callback_route("admin_unblock")
 async def admin_unblock(callback: CallbackQuery, state: FSMContext):
     await callback.message.edit_text(
-        "✅ Введите username пользователя для разблокировки (без @):"
+        f"✅ Введите пользователей для разблокировки ({USER_REFS_PROMPT}):"
     )
     await state.set_state(AdminStates.waiting_username_for_unblock)
 
 
 @router.message(AdminStates.waiting_username_for_unblock)
 async def process_unblock_user(message: Message, state: FSMContext):
-    username = message.text.strip()
-
-    if unblock_user(username):
-        await message.answer(f"✅ Пользователь @{username} разблокирован!")
-    else:
-        await message.answer(f"❌ Пользователь @{username} не найден или не был заблокирован!")
-
+    found, not_found = set_users_blocked(parse_user_refs(message.text or ''), False)
+    await message.answer(format_block_report(found, not_found, "Разблокировано"))
     await state.clear()
 
 
-@router.callback_query(F.data == "admin_broadcast")
+@callback_route("admin_broadcast")
 async def admin_broadcast(callback: CallbackQuery):
     await callback.message.edit_text(
         "📢 Для начала рассылки используйте команду /sms"
     )
 
 
-@router.callback_query(F.data == "back_to_apanel")
+@callback_route("back_to_apanel")
 async def back_to_apanel(callback: CallbackQuery):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
         [InlineKeyboardButton(text="🚫 Заблокировать пользователя", callback_data="admin_block")],
         [InlineKeyboardButton(text="✅ Разблокировать пользователя", callback_data="admin_unblock")],
-        [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")]
+        [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")],
+        [InlineKeyboardButton(text="🧹 Обслуживание БД", callback_data="admin_maintenance")]
     ])
 
     await callback.message.edit_text(
@@ -2618,6 +4362,260 @@ async def back_to_apanel(callback: CallbackQuery):
     )
 
 
+@router.message(Command("giveaway"))
+async def cmd_giveaway(message: Message):
+    """Раздача предмета всем пользователям (только для админа)"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ У вас нет прав для использования этой команды.")
+        return
+
+    args = message.text.split(maxsplit=2)
+    if len(args) < 3:
+        await message.answer("❌ Использование: /giveaway <тип> <название>\nНапример: /giveaway gift Мишка")
+        return
+
+    granted = await asyncio.to_thread(grant_item_to_all_users, args[1], args[2])
+    await message.answer(f"🎁 Предмет «{args[2]}» ({args[1]}) выдан пользователям: {granted}")
+
+
+# ОБСЛУЖИВАНИЕ БАЗЫ ДАННЫХ
+RETENTION_DAYS = int(os.environ.get("RETENTION_DAYS", "30"))  # Сколько дней храним завершенные игры в базе
+INVITE_TTL_DAYS = int(os.environ.get("INVITE_TTL_DAYS", "7"))  # Через сколько дней приглашение истекает
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")  # Куда складываем архивы старых игр
+MAINTENANCE_INTERVAL = 24 * 60 * 60  # Раз в сутки
+ARCHIVE_BATCH = 1000
+STALE_GAME_HOURS = int(os.environ.get("STALE_GAME_HOURS", "24"))  # Через сколько часов без ходов игра считается брошенной
+VACUUM_BATCH_PAGES = 1000  # Сколько страниц освобождаем за один шаг incremental_vacuum
+
+
+def close_stale_sessions(conn: sqlite3.Connection, cutoff: str) -> int:
+    """Помечает брошенные игры (нет ходов с cutoff) завершенными без победителя, чтобы их забрал архив"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE game_sessions SET finished_at = COALESCE(last_move_time, created_at)
+        WHERE finished_at IS NULL AND COALESCE(last_move_time, created_at) < ?
+    ''', (cutoff,))
+    conn.commit()
+    return cursor.rowcount
+
+
+async def archive_finished_sessions(conn: sqlite3.Connection, cutoff: str) -> Tuple[int, Optional[str]]:
+    """Переносит завершенные до cutoff игры (вместе с журналом ходов) в gzip архив и удаляет их из базы"""
+    cursor = conn.cursor()
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(ARCHIVE_DIR, f"game_sessions_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.jsonl.gz")
+    archived = 0
+
+    with gzip.open(path, 'wb') as archive:
+        while True:
+            cursor.execute('''
+                SELECT game_id, player1, player2, is_vs_bot, is_rated, board_state,
+                       created_at, last_move_time, finished_at, winner
+                FROM game_sessions
+                WHERE finished_at IS NOT NULL AND finished_at < ?
+                LIMIT ?
+            ''', (cutoff, ARCHIVE_BATCH))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            game_ids = [row[0] for row in rows]
+            placeholders = ','.join('?' * len(game_ids))
+            cursor.execute(f'''
+                SELECT game_id, records FROM game_moves
+                WHERE game_id IN ({placeholders}) ORDER BY game_id, first_ply
+            ''', game_ids)
+            moves = {}
+            for game_id, records in cursor.fetchall():
+                moves[game_id] = moves.get(game_id, b'') + records
+
+            for row in rows:
+                record = dict(zip(
+                    ['game_id', 'player1', 'player2', 'is_vs_bot', 'is_rated', 'board_state',
+                     'created_at', 'last_move_time', 'finished_at', 'winner'],
+                    row
+                ))
+                record['moves'] = moves.get(row[0], b'').hex()
+                archive.write((json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8'))
+            # Сначала данные должны оказаться в архиве, потом удаляем их из базы
+            archive.flush()
+
+            cursor.execute(f'DELETE FROM game_moves WHERE game_id IN ({placeholders})', game_ids)
+            cursor.execute(f'DELETE FROM game_sessions WHERE game_id IN ({placeholders})', game_ids)
+            conn.commit()
+            archived += len(rows)
+            # Между пачками отдаем управление обработчикам: их запись не ждет все обслуживание
+            await asyncio.sleep(0)
+
+    if not archived:
+        os.remove(path)
+        return 0, None
+    return archived, path
+
+
+async def run_maintenance() -> dict:
+    """Архивирует старые игры, чистит приглашения и сжимает базу.
+
+    Работает в потоке цикла событий короткими шагами, а не в отдельном потоке: так обслуживание
+    не пишет в базу одновременно с обработчиками бота и не ловит "database is locked".
+    """
+    size_before = os.path.getsize(DB_PATH)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    stale_cutoff = (datetime.now() - timedelta(hours=STALE_GAME_HOURS)).isoformat()
+    stale_closed = close_stale_sessions(conn, stale_cutoff)
+
+    cutoff = (datetime.now() - timedelta(days=RETENTION_DAYS)).isoformat()
+    archived, archive_path = await archive_finished_sessions(conn, cutoff)
+
+    # Использованные и просроченные приглашения больше не нужны
+    invite_cutoff = (datetime.now() - timedelta(days=INVITE_TTL_DAYS)).isoformat()
+    cursor.execute('DELETE FROM invites WHERE used = TRUE OR created_at < ?', (invite_cutoff,))
+    invites_deleted = cursor.rowcount
+    conn.commit()
+
+    # Возвращаем свободные страницы файлу порциями. База переведена в режим incremental в setup_database:
+    # полный VACUUM здесь остановил бы бота на все время сжатия
+    if cursor.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        while cursor.execute('PRAGMA freelist_count').fetchone()[0]:
+            cursor.execute(f'PRAGMA incremental_vacuum({VACUUM_BATCH_PAGES})').fetchall()
+            conn.commit()
+            await asyncio.sleep(0)
+    # Ограничиваем выборку ANALYZE, чтобы на большой базе он не держал блокировку надолго
+    cursor.execute('PRAGMA analysis_limit = 1000')
+    cursor.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+
+    return {
+        'stale_closed': stale_closed,
+        'archived_games': archived,
+        'archive_path': archive_path,
+        'invites_deleted': invites_deleted,
+        'bytes_reclaimed': size_before - os.path.getsize(DB_PATH)
+    }
+
+
+async def perform_maintenance() -> Optional[dict]:
+    """Запускает обслуживание и отправляет отчет админу"""
+    try:
+        report = await run_maintenance()
+    except Exception as e:
+        print(f"Ошибка обслуживания базы данных: {e}")
+        return None
+
+    report_text = (
+        f"🧹 Обслуживание базы данных завершено!\n\n"
+        f"⏳ Брошенных игр закрыто: {report['stale_closed']}\n"
+        f"📦 Игр перенесено в архив: {report['archived_games']}\n"
+        f"🔗 Удалено приглашений: {report['invites_deleted']}\n"
+        f"💾 Освобождено: {report['bytes_reclaimed'] / 1024:.1f} КБ"
+    )
+    print(report_text)
+    try:
+        await bot.send_message(ADMIN_ID, report_text)
+    except Exception:
+        pass
+    return report
+
+
+async def periodic_maintenance():
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+        await perform_maintenance()
+
+
+@callback_route("admin_maintenance")
+async def admin_maintenance(callback: CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer("❌ У вас нет прав для этого действия.", show_alert=True)
+        return
+
+    await callback.answer("🧹 Обслуживание запущено, отчет придет отдельным сообщением")
+    await perform_maintenance()
+
+
+# ПАКЕТНЫЙ ПЕРЕСЧЕТ РЕЙТИНГА
+def load_rated_games(include_archive: bool = True) -> List[Tuple[str, int, int, int]]:
+    """Завершенные рейтинговые игры между людьми (finished_at, player1, player2, winner) из базы и архивов"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        SELECT finished_at, player1, player2, winner FROM game_sessions
+        WHERE finished_at IS NOT NULL AND is_rated AND NOT is_vs_bot AND winner IS NOT NULL
+    ''')
+    games = cursor.fetchall()
+    conn.close()
+
+    if include_archive and os.path.isdir(ARCHIVE_DIR):
+        for name in sorted(os.listdir(ARCHIVE_DIR)):
+            if not name.startswith('game_sessions_'):
+                continue
+            with gzip.open(os.path.join(ARCHIVE_DIR, name), 'rt', encoding='utf-8') as archive:
+                for line in archive:
+                    record = json.loads(line)
+                    if record['is_rated'] and not record['is_vs_bot'] and record['winner'] is not None:
+                        games.append((record['finished_at'], record['player1'], record['player2'], record['winner']))
+
+    games.sort()
+    return games
+
+
+def rerate_games(games: List[Tuple[str, int, int, int]], period_hours: int = RATING_PERIOD_HOURS):
+    """Прогоняет историю игр через Эло. Возвращает (id игроков, новые рейтинги).
+
+    Игры группируются в периоды: внутри периода ожидаемые результаты считаются от рейтингов
+    на начало периода, поэтому весь период обсчитывается одной векторной операцией.
+    """
+    import numpy as np
+
+    finished_at = np.array([datetime.fromisoformat(g[0]).timestamp() for g in games])
+    players = np.array([(g[1], g[2]) for g in games], dtype=np.int64).reshape(-1, 2)
+    winners = np.array([g[3] for g in games], dtype=np.int64)
+
+    # Переводим id пользователей в индексы массива рейтингов
+    player_ids, indexes = np.unique(players, return_inverse=True)
+    indexes = indexes.reshape(-1, 2)
+    first, second = indexes[:, 0], indexes[:, 1]
+    # Результат первого игрока: 1 - победа, 0 - поражение, 0.5 - ничья
+    scores = np.where(winners == players[:, 0], 1.0, np.where(winners == 0, 0.5, 0.0))
+
+    periods = (finished_at // (period_hours * 3600)).astype(np.int64)
+    bounds = np.flatnonzero(np.diff(periods)) + 1
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(games)]))
+
+    ratings = np.full(len(player_ids), float(NEW_USER_RATING))
+    for start, end in zip(starts, ends):
+        a, b = first[start:end], second[start:end]
+        expected = 1 / (1 + 10 ** ((ratings[b] - ratings[a]) / 400))
+        delta = ELO_K * (scores[start:end] - expected)
+        ratings += (np.bincount(a, delta, len(ratings)) - np.bincount(b, delta, len(ratings)))
+
+    return player_ids, np.rint(ratings).astype(np.int64)
+
+
+def rerate_all(period_hours: int = RATING_PERIOD_HOURS, dry_run: bool = False) -> dict:
+    """Пересчитывает рейтинг всех игроков по истории игр и записывает его одной транзакцией"""
+    started = time.perf_counter()
+    games = load_rated_games()
+    if not games:
+        return {'games': 0, 'players': 0, 'seconds': 0.0}
+
+    player_ids, ratings = rerate_games(games, period_hours)
+
+    if not dry_run:
+        conn = get_db_connection()
+        with conn:
+            conn.executemany('UPDATE users SET rating = ? WHERE user_id = ?',
+                             zip(ratings.tolist(), player_ids.tolist()))
+        conn.close()
+
+    return {'games': len(games), 'players': len(player_ids), 'seconds': time.perf_counter() - started}
+
+
 # ФУНКЦИЯ РАССЫЛКИ НЕАКТИВНЫМ ПОЛЬЗОВАТЕЛЯМ
 async def send_inactive_users_reminder():
     """Рассылает напоминания неактивным пользователям"""
@@ -2650,19 +4648,123 @@ async def send_inactive_users_reminder():
         pass
 
 
+# ПОВТОР ПАРТИЙ
+def get_game_info(game_id: str) -> Optional[Tuple[int, int, int, Optional[str]]]:
+    """Игроки, размер поля и время окончания сохраненной игры: (player1, player2, size, finished_at)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('SELECT player1, player2, board_state, finished_at FROM game_sessions WHERE game_id = ?', (game_id,))
+    result = cursor.fetchone()
+
+    conn.close()
+    if not result:
+        return None
+    player1, player2, board_state, finished_at = result
+    return player1, player2, len(board_state.split('|')), finished_at
+
+
+def replay_access_error(info: Optional[tuple], user_id: int) -> Optional[str]:
+    """Повтор доступен участникам (и админу) и только после окончания игры, иначе он раскрывает идущую партию"""
+    if not info or user_id not in (info[0], info[1], ADMIN_ID):
+        return "❌ Игра не найдена!"
+    if not info[3]:
+        return "❌ Игра еще идет! Повтор доступен после ее завершения."
+    return None
+
+
+def get_last_game_id(user_id: int) -> Optional[str]:
+    """Последняя завершенная игра пользователя"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        SELECT game_id FROM game_sessions
+        WHERE (player1 = ? OR player2 = ?) AND finished_at IS NOT NULL
+        ORDER BY last_move_time DESC LIMIT 1
+    ''', (user_id, user_id))
+    result = cursor.fetchone()
+
+    conn.close()
+    return result[0] if result else None
+
+
+def render_replay(game_id: str, info: tuple, ply: int) -> Tuple[str, InlineKeyboardMarkup]:
+    """Поле партии после хода номер ply и кнопки навигации"""
+    player1, player2, size, _ = info
+    moves = load_game_moves(game_id)
+    total = len(moves)
+    ply = max(0, min(ply, total))
+
+    game = TicTacToeGame(player1, player2, size=size)
+    elapsed_ms = 0
+    for move_ply, cell, delta_ms in moves[:ply]:
+        row, col = divmod(cell, size)
+        game.board[row][col] = '❌' if move_ply % 2 == 1 else '⭕'
+        elapsed_ms += delta_ms
+
+    text = (
+        f"🎞 Повтор партии\n"
+        f"Ход {ply} из {total} (⏱ {elapsed_ms / 1000:.1f} сек)\n\n"
+        f"{game.get_board_display()}"
+    )
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⏮", callback_data=f"replay:0:{game_id}"),
+         InlineKeyboardButton(text="◀️", callback_data=f"replay:{max(ply - 1, 0)}:{game_id}"),
+         InlineKeyboardButton(text="▶️", callback_data=f"replay:{min(ply + 1, total)}:{game_id}"),
+         InlineKeyboardButton(text="⏭", callback_data=f"replay:{total}:{game_id}")],
+        [InlineKeyboardButton(text="📋 Меню", callback_data="back_to_main")]
+    ])
+    return text, keyboard
+
+
+@router.message(Command("replay"))
+async def cmd_replay(message: Message):
+    """Повтор завершенной партии: /replay [id игры]"""
+    user_id = message.from_user.id
+    args = message.text.split()
+
+    game_id = args[1] if len(args) > 1 else get_last_game_id(user_id)
+    info = get_game_info(game_id) if game_id else None
+    error = replay_access_error(info, user_id)
+    if error:
+        await message.answer(error)
+        return
+
+    text, keyboard = render_replay(game_id, info, 0)
+    await message.answer(text, reply_markup=keyboard)
+
+
+@callback_route("replay")
+async def replay_handler(callback: CallbackQuery):
+    try:
+        ply, game_id = callback_args(callback, 1)
+        ply = int(ply)
+    except ValueError:
+        await callback.answer("❌ Некорректная кнопка!")
+        return
+
+    info = get_game_info(game_id)
+    error = replay_access_error(info, callback.from_user.id)
+    if error:
+        await callback.answer(error)
+        return
+
+    text, keyboard = render_replay(game_id, info, ply)
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    except Exception:
+        pass  # Нажали на ту же позицию - сообщение не изменилось
+    await callback.answer()
+
+
 # ОБРАБОТЧИК СДАЧИ В ИГРЕ
-@router.callback_query(F.data == "surrender")
+@callback_route("surrender")
 async def process_surrender(callback: CallbackQuery):
     user_id = callback.from_user.id
 
     # Находим игру
-    game = None
-    game_id = None
-    for gid, g in game_sessions.items():
-        if user_id in [g.player1, g.player2]:
-            game = g
-            game_id = gid
-            break
+    game_id, game = await find_user_game(user_id)
 
     if not game:
         await callback.answer("❌ Игра не найдена!")
@@ -2686,8 +4788,14 @@ async def process_surrender(callback: CallbackQuery):
     loser_data = get_user_data(loser_id)
 
     if game.is_rated and winner_data and loser_data:
-        # Отнимаем рейтинг за сдачу
-        lose_change = int(RATING_CHANGE_BASE * 0.8)  # 80% от стандартного штрафа
+        if RATING_MODEL == "elo":
+            # По Эло сдача - обычное поражение, победитель получает столько же, сколько теряет проигравший
+            win_change, lose_change = calculate_rating_change(winner_data['rating'], loser_data['rating'])
+            winner_data['rating'] += win_change
+            save_user_data(winner_data)
+        else:
+            # Отнимаем рейтинг за сдачу
+            lose_change = int(RATING_CHANGE_BASE * 0.8)  # 80% от стандартного штрафа
         loser_data['rating'] -= lose_change
         loser_data['games_played'] += 1
         loser_data['losses'] += 1
@@ -2758,14 +4866,362 @@ async def process_surrender(callback: CallbackQuery):
                     await bot.send_message(player_id, "🎮 Вы сдались! 🏳️", reply_markup=keyboard)
 
     # Удаляем игру
-    if game_id in game_sessions:
-        del game_sessions[game_id]
+    await remove_game_session(game_id, game, winner_id)
 
     await callback.answer("Вы сдались!")
 
 
+# ШАРДИРОВАНИЕ ПО ПРОЦЕССАМ
+def jump_consistent_hash(key: int, buckets: int) -> int:
+    """Jump consistent hash: при изменении числа шардов переезжает минимум игроков"""
+    key &= 0xFFFFFFFFFFFFFFFF
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+async def run_shard_command(coro):
+    """Выполняет команду шарда, не роняя цикл при ошибке"""
+    try:
+        await coro
+    except Exception as e:
+        print(f"Ошибка в шарде {SHARD_INDEX}: {e}")
+
+
+async def run_shard_worker(shard_index: int, inbox, outbox):
+    """Цикл процесса-шарда: обрабатывает апдейты и команды координатора"""
+    global SHARD_INDEX, shard_outbox
+    SHARD_INDEX = shard_index
+    shard_outbox = outbox
+
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    print(f"Шард {shard_index} запущен (pid {os.getpid()})")
+    start_background_task(periodic_blocked_users_refresh())
+    start_background_task(periodic_throttle_log())
+    start_background_task(periodic_move_log_flush())
+    restored = await restore_active_games()
+    if restored:
+        print(f"Шард {shard_index}: восстановлено игр после перезапуска: {restored}")
+
+    while True:
+        command = await loop.run_in_executor(None, inbox.get)
+        kind = command[0]
+
+        if kind == 'stop':
+            break
+        elif kind == 'update':
+            coro = dp.feed_raw_update(bot, command[1])
+        elif kind == 'start_game':
+            _, player1, player2, is_rated = command
+            if player2 is None:
+                coro = start_game_with_bot(player1, is_rated=is_rated)
+            else:
+                coro = start_game(player1, player2, is_rated=is_rated)
+        else:
+            print(f"Неизвестная команда шарда: {kind}")
+            continue
+
+        task = asyncio.create_task(run_shard_command(coro))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    # Даем доработать начатым обработчикам
+    if tasks:
+        await asyncio.wait(tasks, timeout=10)
+    await shutdown()
+
+
+def shard_worker_main(shard_index: int, inbox, outbox):
+    """Точка входа процесса-шарда"""
+    # Шард останавливается командой координатора, Ctrl+C в общем терминале его не прерывает
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    startup()
+    asyncio.run(run_shard_worker(shard_index, inbox, outbox))
+
+
+class ShardCoordinator:
+    """Фронт-процесс: получает апдейты, раскладывает их по шардам и ведет общую очередь поиска"""
+
+    def __init__(self, inboxes: list):
+        self.inboxes = inboxes
+        self.pinned = {}  # user_id -> (шард, id игры или None пока шард ее создает)
+        self.queue = {}  # user_id -> (рейтинг, время входа в поиск)
+
+    def shard_for_user(self, user_id: int) -> int:
+        pin = self.pinned.get(user_id)
+        if pin is None:
+            return jump_consistent_hash(user_id, len(self.inboxes))
+        return pin[0]
+
+    def pin(self, user_id: int, shard: int, game_id: Optional[str]) -> bool:
+        """Привязывает игрока к шарду игры. Игрока, уже занятого другой игрой, не перепривязываем"""
+        current = self.pinned.get(user_id)
+        if current is not None and current[1] is not None and current[1] != game_id:
+            print(f"Игрок {user_id} уже в игре {current[1]} (шард {current[0]}), привязка к {game_id} пропущена")
+            return False
+        self.pinned[user_id] = (shard, game_id)
+        return True
+
+    def unpin(self, user_id: int, shard: int, game_id: str):
+        """Снимает привязку, только если она относится к этой игре: запоздавшее сообщение
+        о старой игре не должно отвязать игрока от новой"""
+        if self.pinned.get(user_id) in ((shard, game_id), (shard, None)):
+            del self.pinned[user_id]
+
+    def route(self, update: Update):
+        try:
+            user = getattr(update.event, 'from_user', None)
+        except Exception:
+            user = None
+        shard = self.shard_for_user(user.id) if user else 0
+        raw = update.model_dump(mode="json", by_alias=True, exclude_none=True)
+        self.inboxes[shard].put(('update', raw))
+
+    def start_game(self, player1: int, player2: Optional[int]):
+        """Запускает игру в шарде первого игрока, второго игрока привязываем туда же"""
+        shard = self.shard_for_user(player1)
+        self.pin(player1, shard, None)
+        if player2 is not None:
+            self.pin(player2, shard, None)
+        self.inboxes[shard].put(('start_game', player1, player2, True))
+
+    def handle_control(self, command: tuple):
+        kind = command[0]
+        if kind == 'pin':
+            _, shard, user_ids, game_id = command
+            for user_id in user_ids:
+                if user_id != -1:
+                    self.pin(user_id, shard, game_id)
+        elif kind == 'unpin':
+            _, shard, user_ids, game_id = command
+            for user_id in user_ids:
+                self.unpin(user_id, shard, game_id)
+        elif kind == 'mm_join':
+            _, user_id, rating = command
+            if user_id not in self.queue and user_id not in self.pinned:
+                self.queue[user_id] = (rating, time.monotonic())
+        elif kind == 'mm_cancel':
+            self.queue.pop(command[1], None)
+
+    async def read_control(self, outbox):
+        loop = asyncio.get_running_loop()
+        while True:
+            command = await loop.run_in_executor(None, outbox.get)
+            if command[0] == 'stop':
+                return
+            self.handle_control(command)
+
+    def match_players(self):
+        """Подбирает пары среди игроков, которые ждут дольше MATCHMAKING_WAIT"""
+        now = time.monotonic()
+        for user_id, (rating, joined_at) in sorted(self.queue.items(), key=lambda item: item[1][1]):
+            if user_id not in self.queue or now - joined_at < MATCHMAKING_WAIT:
+                continue
+            del self.queue[user_id]
+
+            opponent_id = None
+            for other_id, (other_rating, _) in self.queue.items():
+                if abs(rating - other_rating) <= MATCHMAKING_RATING_RANGE:
+                    opponent_id = other_id
+                    break
+            if opponent_id is not None:
+                del self.queue[opponent_id]
+
+            self.start_game(user_id, opponent_id)
+
+    async def matchmaking_loop(self):
+        while True:
+            await asyncio.sleep(0.5)
+            self.match_players()
+
+    async def poll_updates(self):
+        offset = None
+        allowed_updates = dp.resolve_used_update_types()
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+            except Exception as e:
+                print(f"Ошибка получения апдейтов: {e}")
+                await asyncio.sleep(5)
+                continue
+
+            for update in updates:
+                offset = update.update_id + 1
+                self.route(update)
+
+
+async def run_sharded():
+    """Запускает SHARD_COUNT процессов-шардов и координатор в текущем процессе"""
+    ctx = multiprocessing.get_context("spawn")
+    outbox = ctx.Queue()
+    inboxes = [ctx.Queue() for _ in range(SHARD_COUNT)]
+    workers = [
+        ctx.Process(target=shard_worker_main, args=(i, inboxes[i], outbox))
+        for i in range(SHARD_COUNT)
+    ]
+    for worker in workers:
+        worker.start()
+
+    coordinator = ShardCoordinator(inboxes)
+    control_task = asyncio.create_task(coordinator.read_control(outbox))
+    matchmaking_task = asyncio.create_task(coordinator.matchmaking_loop())
+    print(f"Координатор запущен, шардов: {SHARD_COUNT}")
+
+    try:
+        await coordinator.poll_updates()
+    finally:
+        matchmaking_task.cancel()
+        for inbox in inboxes:
+            inbox.put(('stop',))
+        outbox.put(('stop',))
+        await control_task
+        for worker in workers:
+            await asyncio.get_running_loop().run_in_executor(None, worker.join, 15)
+
+
+# WEBHOOK РЕЖИМ
+webhook_semaphore = None  # Ограничивает количество одновременно обрабатываемых апдейтов
+webhook_tasks = set()
+
+
+async def process_webhook_update(update: Update):
+    """Обрабатывает апдейт из webhook и освобождает слот"""
+    try:
+        await dp.feed_update(bot, update)
+    except Exception as e:
+        print(f"Ошибка обработки апдейта {update.update_id}: {e}")
+    finally:
+        webhook_semaphore.release()
+
+
+async def webhook_handler(request: web.Request) -> web.Response:
+    """Принимает апдейт от Telegram и запускает его обработку в фоне"""
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=401)
+
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+    except Exception as e:
+        print(f"Некорректный апдейт в webhook: {e}")
+        return web.Response(status=400)
+
+    # Если все слоты заняты - ждем, не отвечая Telegram (естественное ограничение нагрузки)
+    await webhook_semaphore.acquire()
+    task = asyncio.create_task(process_webhook_update(update))
+    webhook_tasks.add(task)
+    task.add_done_callback(webhook_tasks.discard)
+
+    return web.Response()
+
+
+async def health_handler(request: web.Request) -> web.Response:
+    """Проверка живости для балансировщика / reverse proxy"""
+    return web.json_response({
+        "status": "ok",
+        "in_flight": len(webhook_tasks),
+        "active_games": len(game_sessions),
+        "throttled": throttling_middleware.throttled,
+        "bot_search": bot_search_stats
+    })
+
+
+def create_webhook_app() -> web.Application:
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    app.router.add_get("/health", health_handler)
+    return app
+
+
+async def run_webhook():
+    """Запускает бота в режиме webhook на aiohttp сервере"""
+    global webhook_semaphore
+    webhook_semaphore = asyncio.Semaphore(WEBHOOK_MAX_IN_FLIGHT)
+
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=min(WEBHOOK_MAX_IN_FLIGHT, 100),
+        allowed_updates=dp.resolve_used_update_types(),
+        drop_pending_updates=False
+    )
+
+    runner = web.AppRunner(create_webhook_app())
+    await runner.setup()
+    site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT)
+    await site.start()
+    print(f"Webhook сервер слушает {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+
+
+# ЗАПУСК И ОСТАНОВКА
+COLD_START_TARGET = float(os.environ.get("COLD_START_TARGET", "3.0"))  # Цель: от начала импорта до готовности, секунды
+
+
+def startup() -> float:
+    """Готовит базу данных и создает бота. Возвращает время холодного старта"""
+    global bot
+    import_time = time.perf_counter() - IMPORT_STARTED
+    schema_updated = setup_database()
+    load_blocked_users()
+    if bot is None:
+        bot = Bot(token=str(BOT_TOKEN))
+
+    cold_start = time.perf_counter() - IMPORT_STARTED
+    print(
+        f"Холодный старт: {cold_start * 1000:.0f} мс (импорт {import_time * 1000:.0f} мс"
+        + (", схема БД обновлена)" if schema_updated else ")")
+    )
+    if cold_start > COLD_START_TARGET:
+        print(f"⚠️ Холодный старт дольше цели {COLD_START_TARGET * 1000:.0f} мс")
+    return cold_start
+
+
+async def shutdown():
+    """Дает доработать начатым обработчикам, сохраняет активные игры, сбрасывает буферы и освобождает ресурсы"""
+    drained, interrupted = await drain_inflight_handlers(SHUTDOWN_DEADLINE)
+    for task in list(background_tasks):
+        task.cancel()
+
+    saved_games = await persist_active_games()
+    for task in move_timeout_tasks.values():
+        task.cancel()
+    move_timeout_tasks.clear()
+
+    flushed_moves = flush_move_log()
+    shutdown_bot_search_pool()
+    await bot.session.close()
+    print(
+        f"Бот остановлен: обработчиков завершено {drained}, прервано {interrupted}, "
+        f"игр сохранено {saved_games}, ходов записано {flushed_moves}"
+    )
+
+
+def handle_stop_signals():
+    """SIGTERM/SIGINT отменяют текущую задачу, чтобы в finally выполнилась остановка
+    (в режиме long polling сигналы обрабатывает сам aiogram)"""
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, task.cancel)
+        except NotImplementedError:
+            pass  # Windows
+
+
 async def main():
-    print("Бот запущен!")
+    startup()
+    await refresh_bot_info()
+    print(f"Бот @{bot_info.username} запущен!")
 
     # Запускаем периодическую рассылку неактивным пользователям (каждые 24 часа)
     async def periodic_reminder():
@@ -2774,10 +5230,45 @@ async def main():
             await send_inactive_users_reminder()
 
     # Запускаем периодическую задачу в фоне
-    asyncio.create_task(periodic_reminder())
-
-    await dp.start_polling(bot)
+    start_background_task(periodic_reminder())
+    start_background_task(periodic_move_log_flush())
+    start_background_task(periodic_maintenance())
+    start_background_task(periodic_bot_info_refresh())
+    start_background_task(periodic_blocked_users_refresh())
+    start_background_task(periodic_throttle_log())
+
+    if SHARD_COUNT == 1 and BOT_SEARCH_WORKERS > 0:
+        pool_started = time.perf_counter()
+        try:
+            await warm_bot_search_pool()
+            print(f"Пул поиска хода запущен за {(time.perf_counter() - pool_started) * 1000:.0f} мс")
+        except Exception as e:
+            print(f"Не удалось запустить пул поиска хода: {e!r}")
+    if SHARD_COUNT == 1:
+        restored = await restore_active_games()
+        if restored:
+            print(f"Восстановлено игр после перезапуска: {restored}")
+    if SHARD_COUNT > 1 or WEBHOOK_URL:
+        handle_stop_signals()
+    try:
+        if SHARD_COUNT > 1:
+            await run_sharded()
+        elif WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await dp.start_polling(bot)
+    except asyncio.CancelledError:
+        print("Получен сигнал остановки")
+    finally:
+        await shutdown()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "rerate":
+        # python main.py rerate [часов в периоде] [--dry-run]
+        period = int(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2].isdigit() else RATING_PERIOD_HOURS
+        setup_database()
+        result = rerate_all(period, dry_run="--dry-run" in sys.argv)
+        print(f"Пересчитано игр: {result['games']}, игроков: {result['players']} за {result['seconds']:.2f} с")
+    else:
+        asyncio.run(main())
\ No newline at end of file
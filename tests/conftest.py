@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Чистая база данных во временном каталоге"""
+    monkeypatch.setattr(main, "DB_PATH", str(tmp_path / "tictactoe.db"))
+    main.setup_database()
+    return main.DB_PATH
+
+
+@pytest.fixture
+def add_user(db):
+    """Добавляет пользователя в базу"""
+    def add(user_id, username, rating=0):
+        main.save_user_data({
+            'user_id': user_id, 'username': username, 'rating': rating,
+            'games_played': 0, 'wins': 0, 'losses': 0, 'draws': 0,
+            'registered_at': '2024-01-01T00:00:00'
+        })
+    return add
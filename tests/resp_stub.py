@@ -0,0 +1,82 @@
+"""Небольшой RESP2 сервер для тестов: команды выполняет движок fakeredis (Lua - через lupa).
+
+Сетевой сервер fakeredis закрывает соединение после любого ответа-ошибки, а настоящий Redis - нет,
+поэтому для проверки клиента (в том числе повторной загрузки скрипта после NOSCRIPT) используем свой.
+"""
+import socketserver
+import threading
+
+import fakeredis
+from redis.exceptions import NoScriptError, ResponseError
+
+
+def encode(value) -> bytes:
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, float):
+        value = b'%.17g' % value
+    if isinstance(value, dict):
+        # redis-py собирает ответ HGETALL в словарь, в RESP2 это плоский массив
+        value = [item for pair in value.items() for item in pair]
+    if isinstance(value, str):
+        value = value.encode()
+    if isinstance(value, bytes):
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+    if isinstance(value, (list, tuple)):
+        return b'*%d\r\n' % len(value) + b''.join(encode(item) for item in value)
+    raise TypeError(f"Неподдерживаемый ответ: {value!r}")
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        assert line[:1] == b'*', line
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self):
+        client = fakeredis.FakeStrictRedis(server=self.server.fake_server)
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            try:
+                reply = encode(client.execute_command(*args))
+            except NoScriptError as e:
+                reply = b'-NOSCRIPT %s\r\n' % str(e).encode()
+            except ResponseError as e:
+                reply = b'-ERR %s\r\n' % str(e).encode()
+            self.wfile.write(reply)
+            self.wfile.flush()
+
+
+class RespStubServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), RespHandler)
+        self.fake_server = fakeredis.FakeServer()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address
+        return f"redis://{host}:{port}/0"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,64 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+class SlowState:
+    """FSMContext с переключением задач на каждом обращении, как у внешнего хранилища"""
+
+    def __init__(self, data=None):
+        self.data = dict(data or {})
+
+    async def get_data(self):
+        await asyncio.sleep(0)
+        return dict(self.data)
+
+    async def update_data(self, **kwargs):
+        await asyncio.sleep(0)
+        self.data.update(kwargs)
+
+    async def clear(self):
+        self.data = {}
+
+
+def fake_message(user_id, answers):
+    async def answer(text, **kwargs):
+        answers.append(text)
+    return SimpleNamespace(from_user=SimpleNamespace(id=user_id), chat=SimpleNamespace(id=user_id), answer=answer)
+
+
+def test_album_items_are_not_lost(monkeypatch):
+    monkeypatch.setattr(main, "broadcast_media_locks", {})
+    state, answers = SlowState(), []
+    message = fake_message(1, answers)
+
+    async def scenario():
+        await asyncio.gather(*(
+            main.add_broadcast_media(message, state, 'photos', f"photo{i}", "skip_photo") for i in range(12)
+        ))
+    asyncio.run(scenario())
+
+    assert state.data['photos'] == [f"photo{i}" for i in range(main.MEDIA_GROUP_LIMIT)]
+    assert sum(text.startswith("❌") for text in answers) == 2
+
+
+@pytest.mark.parametrize("recipients, expected", [([2, 3], 2), ([1, 2, 3], 3)])
+def test_broadcast_counts_admin_only_as_recipient(monkeypatch, recipients, expected):
+    sent, stats = [], []
+
+    async def send_broadcast_payload(chat_id, data, keyboard):
+        sent.append(chat_id)
+        return []
+
+    monkeypatch.setattr(main, "send_broadcast_payload", send_broadcast_payload)
+    monkeypatch.setattr(main, "get_all_users", lambda: recipients)
+    monkeypatch.setattr(main, "save_broadcast_stats", lambda success, fail: stats.append((success, fail)))
+    answers = []
+
+    asyncio.run(main.send_broadcast_message(fake_message(1, answers), SlowState({'text': "привет"})))
+
+    assert sent == [1, 2, 3]
+    assert stats == [(expected, 0)]
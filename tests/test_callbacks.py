@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("data, maxsplit, parsed", [
+    ("find_game", -1, ("find_game", [])),
+    ("m:abc:1:2", -1, ("m", ["abc", "1", "2"])),
+    ("move_1_2", -1, ("m", ["1", "2"])),
+    ("copy_ref_42", -1, ("copy_ref", ["42"])),
+    ("copy_invite_42_1234", -1, ("copy", ["invite_42_1234"])),
+    ("set_status_3", -1, ("set_status", ["3"])),
+    ("stats_168", -1, ("stats", ["168"])),
+    ("replay_game_1", -1, ("replay_game_1", [])),
+    ("copy:a:b:c", 1, ("copy", ["a", "b:c"])),
+    ("unknown:1", -1, ("unknown", ["1"])),
+])
+def test_parse_callback_data(data, maxsplit, parsed):
+    assert main.parse_callback_data(data, maxsplit) == parsed
+
+
+class Callback:
+    def __init__(self, data):
+        self.data = data
+        self.answers = []
+
+    async def answer(self, text=None, **kwargs):
+        self.answers.append(text)
+
+
+def test_dispatch_passes_state_only_to_handlers_that_want_it(monkeypatch):
+    calls = []
+
+    async def plain(callback):
+        calls.append(("plain", callback.data))
+
+    async def with_state(callback, state):
+        calls.append(("state", state))
+
+    monkeypatch.setattr(main, "callback_routes", {})
+    main.callback_route("plain")(plain)
+    main.callback_route("form", "form2")(with_state)
+
+    async def scenario():
+        await main.dispatch_callback(Callback("plain:1"), "ctx")
+        await main.dispatch_callback(Callback("form2"), "ctx")
+        missing = Callback("gone")
+        await main.dispatch_callback(missing, "ctx")
+        return missing.answers
+
+    assert asyncio.run(scenario()) == [None]
+    assert calls == [("plain", "plain:1"), ("state", "ctx")]
@@ -0,0 +1,139 @@
+import asyncio
+import time
+
+import pytest
+
+import main
+
+
+def play(moves, size=3, win_length=3, vs_bot=False):
+    game = main.TicTacToeGame(1, -1 if vs_bot else 2, is_vs_bot=vs_bot, is_rated=False,
+                              size=size, win_length=win_length)
+    for row, col in moves:
+        assert game.make_move(row, col, game.current_player)
+    return game
+
+
+@pytest.mark.parametrize("moves", [
+    [(0, 0), (1, 0), (0, 1), (1, 1), (0, 2)],  # строка
+    [(0, 0), (0, 1), (1, 0), (1, 1), (2, 0)],  # столбец
+    [(0, 0), (0, 1), (1, 1), (0, 2), (2, 2)],  # диагональ
+    [(0, 2), (0, 1), (1, 1), (0, 0), (2, 0)],  # обратная диагональ
+])
+def test_win_detection_3x3(moves):
+    game = play(moves)
+    assert game.winner == 1
+    # После победы ходить нельзя
+    assert not game.make_move(2, 1, game.current_player)
+
+
+def test_draw():
+    game = play([(0, 0), (0, 1), (0, 2), (1, 1), (1, 0), (1, 2), (2, 1), (2, 0), (2, 2)])
+    assert game.winner == 'draw'
+
+
+def test_k_in_a_row_on_bigger_board():
+    # 5 в ряд по диагонали на поле 7x7, не касаясь края
+    game = play([(1, 1), (0, 6), (2, 2), (1, 6), (3, 3), (2, 6), (4, 4), (4, 6)], size=7, win_length=5)
+    assert game.winner is None
+    game.make_move(5, 5, 1)
+    assert game.winner == 1
+    # Полная проверка поля (без последнего хода) находит ту же победу
+    game.winner = None
+    game.check_winner()
+    assert game.winner == 1
+
+
+def test_four_in_a_row_is_not_enough_for_five():
+    game = play([(0, 0), (6, 6), (0, 1), (6, 5), (0, 2), (6, 4), (0, 3)], size=7, win_length=5)
+    assert game.winner is None
+
+
+def test_make_move_rejects_invalid_moves():
+    game = play([(1, 1)])
+    assert not game.make_move(1, 1, 2)  # занято
+    assert not game.make_move(0, 0, 1)  # не его ход
+    assert not game.make_move(3, 0, 2)  # вне поля
+
+
+def test_compact_roundtrip():
+    game = play([(1, 1), (0, 0), (2, 2)], size=5, win_length=4)
+    game.message_ids = {1: 10, 2: 20}
+    restored = main.TicTacToeGame.from_compact(game.to_compact())
+    assert restored.board == game.board
+    assert (restored.current_player, restored.moves, restored.size, restored.win_length) == (2, 3, 5, 4)
+    assert restored.message_ids == game.message_ids
+
+
+def test_win_windows_count():
+    assert len(main.get_win_windows(3, 3)) == 8
+    # 5x5, 4 в ряд: по 2 окна в каждой строке и столбце и 8 диагональных
+    assert len(main.get_win_windows(5, 4)) == 5 * 2 * 2 + 8
+
+
+def test_zobrist_hash_is_incremental():
+    game = play([(1, 1), (0, 0)], vs_bot=True)
+    search = main.AlphaBetaSearch(game, 1.0)
+    start = search.hash
+    search.place(2, 1)
+    search.place(5, 2)
+    moved = search.hash
+    search.unplace(5, 2)
+    search.unplace(2, 1)
+    assert search.hash == start
+
+    # Тот же хеш, если позиция получена в другом порядке ходов
+    search.place(5, 2)
+    search.place(2, 1)
+    assert search.hash == moved
+
+
+def test_search_takes_win_and_blocks_loss():
+    # Бот (⭕) может выиграть в (0, 2)
+    game = play([(1, 1), (0, 0), (2, 2), (0, 1), (2, 0)], vs_bot=True)
+    assert main.find_search_move(game, 1.0) == (0, 2)
+
+    # Игрок грозит выиграть в (0, 2), бот должен закрыть
+    game = play([(0, 0), (1, 1), (0, 1)], vs_bot=True)
+    assert main.find_search_move(game, 1.0) == (0, 2)
+
+
+def test_search_self_play_3x3_is_draw():
+    game = main.TicTacToeGame(1, -1, is_vs_bot=True, is_rated=False)
+    while not game.winner:
+        row, col = main.find_search_move(game, 1.0)
+        game.make_move(row, col, game.current_player)
+    assert game.winner == 'draw'
+
+
+def test_search_uses_transposition_table():
+    game = main.TicTacToeGame(1, -1, is_vs_bot=True, is_rated=False)
+    search = main.AlphaBetaSearch(game, 1.0)
+    search.run()
+    assert search.table
+    assert search.nodes > 0
+
+
+def test_search_without_process_pool_does_not_block_loop(monkeypatch):
+    monkeypatch.setattr(main, "BOT_SEARCH_WORKERS", 0)
+    game = play([(3, 3)], size=7, win_length=5, vs_bot=True)
+
+    async def scenario():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        started = time.monotonic()
+        move = await main.compute_search_move(game)
+        task.cancel()
+        return move, ticks, time.monotonic() - started
+
+    move, ticks, elapsed = asyncio.run(scenario())
+    assert move is not None and game.board[move[0]][move[1]] == ' '
+    # Цикл событий продолжал работать, пока шел поиск
+    assert ticks >= elapsed / 0.01 / 4
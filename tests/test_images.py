@@ -0,0 +1,44 @@
+from collections import OrderedDict
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def font(monkeypatch):
+    main.find_image_font.cache_clear()
+    yield monkeypatch
+    main.find_image_font.cache_clear()
+
+
+def test_file_id_cache_evicts_least_recently_used(db, monkeypatch):
+    monkeypatch.setattr(main, "IMAGE_CACHE_SIZE", 2)
+    monkeypatch.setattr(main, "image_file_ids", OrderedDict())
+
+    main.save_image_file_id("a", "file_a")
+    main.save_image_file_id("b", "file_b")
+    assert main.get_image_file_id("a") == "file_a"
+    main.save_image_file_id("c", "file_c")
+
+    assert list(main.image_file_ids) == ["a", "c"]
+    # Вытесненный из памяти file_id по-прежнему берется из базы
+    assert main.get_image_file_id("b") == "file_b"
+    assert list(main.image_file_ids) == ["c", "b"]
+
+
+def test_font_falls_back_to_system_font(font, tmp_path):
+    font.setattr(main, "IMAGE_FONT", str(tmp_path / "missing.ttf"))
+    font.setattr(main, "IMAGE_FONT_FALLBACKS", [str(tmp_path / "missing2.ttf"), main.IMAGE_FONT_FALLBACKS[0]])
+    if main.find_image_font() is None:
+        pytest.skip("DejaVuSans не установлен")
+    assert main.find_image_font() == main.IMAGE_FONT_FALLBACKS[1]
+
+
+def test_font_falls_back_to_pillow_default_with_warning(font, tmp_path, capsys):
+    font.setattr(main, "IMAGE_FONT", str(tmp_path / "missing.ttf"))
+    font.setattr(main, "IMAGE_FONT_FALLBACKS", [])
+
+    assert main.find_image_font() is None
+    assert "без кириллицы" in capsys.readouterr().out
+    assert main.render_top_image([(1, "Игрок", 100)]).startswith(b"\x89PNG")
@@ -0,0 +1,86 @@
+import asyncio
+import gzip
+import json
+from datetime import datetime, timedelta
+
+import main
+
+
+def add_session(game_id, last_move_time, finished_at=None):
+    conn = main.get_db_connection()
+    conn.execute('''
+        INSERT INTO game_sessions (game_id, player1, player2, is_vs_bot, is_rated, board_state,
+                                   current_player, created_at, last_move_time, finished_at)
+        VALUES (?, 1, 2, FALSE, FALSE, '   |   |   ', 1, ?, ?, ?)
+    ''', (game_id, last_move_time, last_move_time, finished_at))
+    conn.commit()
+    conn.close()
+
+
+def session_ids():
+    conn = main.get_db_connection()
+    ids = {row[0] for row in conn.execute('SELECT game_id FROM game_sessions')}
+    conn.close()
+    return ids
+
+
+def test_stale_sessions_are_closed_and_archived(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    monkeypatch.setattr(main, "RETENTION_DAYS", 1)
+    now = datetime.now()
+    add_session("abandoned", (now - timedelta(days=3)).isoformat())
+    add_session("active", (now - timedelta(minutes=5)).isoformat())
+    add_session("finished", (now - timedelta(days=2)).isoformat(), (now - timedelta(days=2)).isoformat())
+
+    report = asyncio.run(main.run_maintenance())
+
+    assert report['stale_closed'] == 1
+    assert report['archived_games'] == 2
+    assert session_ids() == {"active"}
+    with gzip.open(report['archive_path'], 'rt', encoding='utf-8') as archive:
+        records = {record['game_id']: record for record in map(json.loads, archive)}
+    assert set(records) == {"abandoned", "finished"}
+    assert records["abandoned"]['winner'] is None
+
+
+def test_setup_switches_to_incremental_vacuum_and_maintenance_frees_pages(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    monkeypatch.setattr(main, "RETENTION_DAYS", 0)
+    conn = main.get_db_connection()
+    assert conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+    old = (datetime.now() - timedelta(days=1)).isoformat()
+    conn.executemany('INSERT INTO game_moves (game_id, first_ply, records) VALUES (?, 1, ?)',
+                     [(f"g{i}", bytes(4000)) for i in range(200)])
+    conn.commit()
+    conn.close()
+    for i in range(200):
+        add_session(f"g{i}", old, old)
+
+    report = asyncio.run(main.run_maintenance())
+
+    assert report['archived_games'] == 200
+    assert report['bytes_reclaimed'] > 0
+    conn = main.get_db_connection()
+    assert conn.execute('PRAGMA freelist_count').fetchone()[0] == 0
+    conn.close()
+
+
+def test_saving_a_game_keeps_finish_and_creation_time(db):
+    game = main.TicTacToeGame(1, 2, is_rated=False)
+    game.save_to_db("g")
+    conn = main.get_db_connection()
+    created_at = conn.execute('SELECT created_at FROM game_sessions WHERE game_id = ?', ("g",)).fetchone()[0]
+    conn.close()
+    main.mark_game_finished("g", 1)
+
+    game.make_move(0, 0, 1)
+    game.last_move_time = datetime.now()
+    game.save_to_db("g")
+
+    conn = main.get_db_connection()
+    row = conn.execute('SELECT created_at, finished_at, winner, board_state FROM game_sessions WHERE game_id = ?',
+                       ("g",)).fetchone()
+    conn.close()
+    assert row[0] == created_at
+    assert row[1] is not None and row[2] == 1
+    assert row[3].startswith('❌')
@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def move_log(db, monkeypatch):
+    monkeypatch.setattr(main, "move_log_buffer", {})
+    monkeypatch.setattr(main, "move_log_clock", {})
+    monkeypatch.setattr(main, "move_log_pending", 0)
+
+
+def stored_moves(game_id):
+    conn = main.get_db_connection()
+    count = conn.execute('SELECT COUNT(*) FROM game_moves WHERE game_id = ?', (game_id,)).fetchone()[0]
+    conn.close()
+    return count
+
+
+def play_logged(game_id, moves, size=3, win_length=3):
+    game = main.TicTacToeGame(1, 2, is_rated=False, size=size, win_length=win_length)
+    main.log_game_start(game_id)
+    for row, col in moves:
+        game.make_move(row, col, game.current_player)
+        main.log_move(game_id, game, row, col)
+    return game
+
+
+def test_record_pack_unpack_roundtrip():
+    record = main.MOVE_RECORD.pack(65535, 48, 1234)
+    assert len(record) == 5
+    assert main.MOVE_RECORD.unpack(record) == (65535, 48, 1234)
+
+
+def test_moves_are_read_from_buffer_and_database(move_log):
+    game = play_logged("g1", [(1, 1), (0, 0)], size=7, win_length=5)
+    assert [move[:2] for move in main.load_game_moves("g1")] == [(1, 8), (2, 0)]
+
+    assert main.flush_move_log() == 2
+    assert main.move_log_buffer == {}
+    game.make_move(6, 6, game.current_player)
+    main.log_move("g1", game, 6, 6)
+    assert [move[:2] for move in main.load_game_moves("g1")] == [(1, 8), (2, 0), (3, 48)]
+
+
+def test_game_end_writes_only_its_own_moves(move_log):
+    game = play_logged("g2", [(0, 0), (1, 0), (0, 1), (1, 1), (0, 2)])
+    play_logged("other", [(1, 1), (0, 0)])
+    asyncio.run(main.remove_game_session("g2", game, game.winner))
+    assert stored_moves("g2") == 1
+    assert stored_moves("other") == 0
+    assert list(main.move_log_buffer) == ["other"]
+    assert main.move_log_pending == 2
+    assert main.flush_move_log() == 2
+
+
+def test_flush_on_batch_size(move_log, monkeypatch):
+    monkeypatch.setattr(main, "MOVE_LOG_BATCH", 3)
+    play_logged("g3", [(0, 0), (1, 1)])
+    assert stored_moves("g3") == 0
+    play_logged("g4", [(2, 2)])
+    assert main.move_log_pending == 0
+    assert stored_moves("g3") == 1 and stored_moves("g4") == 1
+
+
+def test_replay_access():
+    finished = (1, 2, 3, "2026-01-01T00:00:00")
+    assert main.replay_access_error(finished, 1) is None
+    assert main.replay_access_error(finished, main.ADMIN_ID) is None
+    assert main.replay_access_error(finished, 3) == "❌ Игра не найдена!"
+    assert main.replay_access_error(None, 1) == "❌ Игра не найдена!"
+    assert "еще идет" in main.replay_access_error((1, 2, 3, None), 1)
+
+
+def test_replay_rejects_malformed_callback(db):
+    answers = []
+
+    class Callback:
+        data = "replay:abc:g1"
+        from_user = type("User", (), {"id": 1})
+
+        async def answer(self, text=None, **kwargs):
+            answers.append(text)
+
+    asyncio.run(main.replay_handler(Callback()))
+    Callback.data = "replay:1"
+    asyncio.run(main.replay_handler(Callback()))
+    assert answers == ["❌ Некорректная кнопка!"] * 2
+
+
+def test_last_game_skips_the_running_one(db):
+    finished = main.TicTacToeGame(1, 2, is_rated=False)
+    finished.save_to_db("done")
+    main.mark_game_finished("done", 'draw')
+    running = main.TicTacToeGame(1, 3, is_rated=False)
+    running.save_to_db("running")
+
+    assert main.get_last_game_id(1) == "done"
+    assert main.get_last_game_id(3) is None
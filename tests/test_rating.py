@@ -0,0 +1,78 @@
+import asyncio
+import random
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+def scalar_rerate(games):
+    """Эталон: последовательное обновление Эло по одной игре"""
+    ratings = {}
+    for _, p1, p2, winner in games:
+        r1 = ratings.setdefault(p1, float(main.NEW_USER_RATING))
+        r2 = ratings.setdefault(p2, float(main.NEW_USER_RATING))
+        score = 1.0 if winner == p1 else 0.5 if winner == 0 else 0.0
+        delta = main.ELO_K * (score - main.elo_expected_score(r1, r2))
+        ratings[p1], ratings[p2] = r1 + delta, r2 - delta
+    return ratings
+
+
+def test_batch_rerate_matches_scalar_when_periods_hold_one_game():
+    rng = random.Random(7)
+    start = datetime(2024, 1, 1)
+    games = []
+    for i in range(200):
+        p1, p2 = rng.sample(range(1, 11), 2)
+        winner = rng.choice([p1, p2, 0])
+        games.append(((start + timedelta(hours=i)).isoformat(), p1, p2, winner))
+
+    player_ids, ratings = main.rerate_games(games, period_hours=1)
+
+    expected = scalar_rerate(games)
+    assert sorted(expected) == player_ids.tolist()
+    assert ratings.tolist() == [round(expected[p]) for p in player_ids.tolist()]
+
+
+def test_batch_rerate_uses_period_start_ratings():
+    games = [
+        ("2024-01-01T00:10:00", 1, 2, 1),
+        ("2024-01-01T00:20:00", 1, 3, 1),
+    ]
+    _, ratings = main.rerate_games(games, period_hours=24)
+
+    # Обе игры считаются от стартовых рейтингов: победитель получает по K/2 за каждую
+    assert ratings.tolist() == [main.NEW_USER_RATING + main.ELO_K,
+                                main.NEW_USER_RATING - main.ELO_K // 2,
+                                main.NEW_USER_RATING - main.ELO_K // 2]
+
+
+def test_elo_rating_change(monkeypatch):
+    monkeypatch.setattr(main, "RATING_MODEL", "elo")
+    assert main.calculate_rating_change(1000, 1000) == (main.ELO_K // 2, main.ELO_K // 2)
+    assert main.calculate_rating_change(1000, 1000, is_draw=True) == (0, 0)
+    gain, loss = main.calculate_rating_change(1400, 1000)
+    assert gain == loss and 0 < gain < main.ELO_K // 2
+    assert main.elo_expected_score(1200, 1000) + main.elo_expected_score(1000, 1200) == pytest.approx(1.0)
+
+
+def test_new_users_and_rerate_start_from_the_same_rating(db, monkeypatch):
+    answers = []
+
+    async def answer(text, **kwargs):
+        answers.append(text)
+
+    message = SimpleNamespace(
+        from_user=SimpleNamespace(id=1, username="alice", first_name="Alice"),
+        chat=SimpleNamespace(id=1, type="private"),
+        text="/start",
+        answer=answer,
+    )
+    asyncio.run(main.cmd_start(message))
+    registered = main.get_user_data(1)['rating']
+
+    # Ничья равных соперников рейтинг не меняет: пересчет оставляет игроков на стартовом рейтинге
+    _, ratings = main.rerate_games([("2024-01-01T00:00:00", 1, 2, 0)])
+    assert ratings.tolist() == [registered, registered]
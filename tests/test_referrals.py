@@ -0,0 +1,35 @@
+import main
+
+
+def complete(referrer_id, referred_id):
+    conn = main.get_db_connection()
+    conn.execute('UPDATE referrals SET is_completed = TRUE, games_played = ? WHERE referrer_id = ? AND referred_id = ?',
+                 (main.REF_REQUIRED_GAMES, referrer_id, referred_id))
+    conn.commit()
+    conn.close()
+
+
+def referral_row(referrer_id, referred_id):
+    conn = main.get_db_connection()
+    row = conn.execute('SELECT games_played, is_completed, created_at FROM referrals WHERE referrer_id = ? AND referred_id = ?',
+                       (referrer_id, referred_id)).fetchone()
+    conn.close()
+    return row
+
+
+def test_recreating_completed_referral_keeps_counts(db, monkeypatch):
+    monkeypatch.setattr(main, "REF_FOR_ROULETTE", 2)
+    for referred_id in (2, 3, 4):
+        main.create_referral(1, referred_id)
+    complete(1, 2)
+    complete(1, 3)
+    before = referral_row(1, 2)
+    assert main.get_referral_counts(1) == (2, 1)
+    assert main.get_available_spins(1) == 1
+
+    main.create_referral(1, 2)
+    main.create_referral(1, 4)
+
+    assert referral_row(1, 2) == before
+    assert main.get_referral_counts(1) == (2, 1)
+    assert main.get_available_spins(1) == 1
@@ -0,0 +1,46 @@
+import asyncio
+import json
+from datetime import datetime
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def restore(db, monkeypatch):
+    monkeypatch.setattr(main, "state_store", main.InMemoryStateStore())
+    monkeypatch.setattr(main, "move_timeout_tasks", {})
+    bot_moves = []
+
+    async def make_bot_move(game, game_id):
+        bot_moves.append(game_id)
+
+    monkeypatch.setattr(main, "make_bot_move", make_bot_move)
+
+    def save(game_id, game):
+        conn = main.get_db_connection()
+        conn.execute('INSERT INTO active_games (game_id, state, time_left, saved_at) VALUES (?, ?, ?, ?)',
+                     (game_id, json.dumps(game.to_compact()), 30.0, datetime.now().isoformat()))
+        conn.commit()
+        conn.close()
+
+    async def run():
+        restored = await main.restore_active_games()
+        await asyncio.sleep(0)
+        for task in main.move_timeout_tasks.values():
+            task.cancel()
+        return restored
+
+    return save, run, bot_moves
+
+
+def test_bot_moves_after_restore_on_its_turn(restore):
+    save, run, bot_moves = restore
+    bot_turn = main.TicTacToeGame(1, -1, is_vs_bot=True)
+    bot_turn.make_move(0, 0, 1)
+    save("bot_turn", bot_turn)
+    save("player_turn", main.TicTacToeGame(2, -1, is_vs_bot=True))
+
+    assert asyncio.run(run()) == 2
+    assert bot_moves == ["bot_turn"]
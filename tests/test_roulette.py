@@ -0,0 +1,92 @@
+import random
+from collections import Counter
+
+import pytest
+
+import main
+
+
+def alias_distribution(prob, alias):
+    """Точные вероятности исходов, которые задает таблица псевдонимов"""
+    n = len(prob)
+    result = [0.0] * n
+    for i in range(n):
+        result[i] += prob[i] / n
+        result[alias[i]] += (1 - prob[i]) / n
+    return result
+
+
+@pytest.mark.parametrize("weights", [
+    [1, 1, 1],
+    [5, 1],
+    [0.5, 10, 3, 0.1, 7],
+    [weight for _, _, weight in main.ROULETTE_PRIZES],
+])
+def test_alias_table_matches_weights(weights):
+    total = sum(weights)
+    assert alias_distribution(*main.build_alias_table(weights)) == pytest.approx([w / total for w in weights])
+
+
+def test_spin_roulette_frequencies(monkeypatch):
+    monkeypatch.setattr(main, "random", random.Random(1))
+    spins = 200000
+    counts = Counter(main.spin_roulette()['type'] for _ in range(spins))
+
+    total = sum(weight for _, _, weight in main.ROULETTE_PRIZES)
+    expected = Counter()
+    for prize_type, _, weight in main.ROULETTE_PRIZES:
+        expected[prize_type] += weight / total
+    for prize_type, share in expected.items():
+        assert counts[prize_type] / spins == pytest.approx(share, abs=0.01)
+
+
+@pytest.fixture
+def spins(db, monkeypatch):
+    """Пользователь 1 с тремя заработанными прокрутками"""
+    monkeypatch.setattr(main, "REF_FOR_ROULETTE", 1)
+    conn = main.get_db_connection()
+    conn.executemany('INSERT INTO referrals (referrer_id, referred_id, games_played, is_completed, created_at) '
+                     'VALUES (1, ?, 3, TRUE, ?)', [(referred_id, '2024-01-01') for referred_id in (2, 3, 4)])
+    conn.commit()
+    conn.close()
+
+
+def table_rows(table):
+    conn = main.get_db_connection()
+    rows = conn.execute(f'SELECT * FROM {table}').fetchall()
+    conn.close()
+    return rows
+
+
+def test_partial_spend(spins):
+    assert main.get_available_spins(1) == 3
+    assert len(main.spend_spins(1, 2)) == 2
+    assert main.get_available_spins(1) == 1
+
+
+def test_insufficient_spins_write_nothing(spins):
+    assert main.spend_spins(1, 4) is None
+    assert main.get_available_spins(1) == 3
+    assert table_rows('roulette_spins') == []
+    assert table_rows('inventory') == []
+
+
+def test_bulk_spend_is_one_write(spins, monkeypatch):
+    statements = []
+    connect = main.get_db_connection
+
+    def traced_connection():
+        conn = connect()
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    monkeypatch.setattr(main, "get_db_connection", traced_connection)
+    prizes = main.spend_spins(1, 3)
+
+    granted = {(prize['type'], prize['name']) for prize in prizes if prize['type'] != 'nothing'}
+    assert sum('UPDATE roulette_spins' in statement for statement in statements) == 1
+    assert sum('INSERT INTO inventory' in statement for statement in statements) == len(granted)
+    assert statements.count('COMMIT') == 1
+    monkeypatch.setattr(main, "get_db_connection", connect)
+    assert main.get_available_spins(1) == 0
+    assert sum(row[3] for row in table_rows('inventory')) == len(prizes) - sum(p['type'] == 'nothing' for p in prizes)
@@ -0,0 +1,35 @@
+import main
+
+
+def user_version():
+    conn = main.get_db_connection()
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    conn.close()
+    return version
+
+
+def test_fresh_database_is_created(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "DB_PATH", str(tmp_path / "fresh.db"))
+    assert main.setup_database() is True
+    assert user_version() == main.SCHEMA_VERSION
+
+
+def test_current_schema_is_skipped(db, monkeypatch):
+    calls = []
+    monkeypatch.setattr(main, "init_db", lambda: calls.append("init"))
+    monkeypatch.setattr(main, "upgrade_db", lambda: calls.append("upgrade"))
+
+    assert main.setup_database() is False
+    assert calls == []
+
+
+def test_version_change_reruns_upgrade_and_keeps_data(add_user):
+    add_user(42, "alice")
+    conn = main.get_db_connection()
+    conn.execute(f'PRAGMA user_version = {main.SCHEMA_VERSION - 1}')
+    conn.commit()
+    conn.close()
+
+    assert main.setup_database() is True
+    assert user_version() == main.SCHEMA_VERSION
+    assert main.get_user_data(42)['username'] == "alice"
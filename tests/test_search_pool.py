@@ -0,0 +1,22 @@
+import asyncio
+
+import main
+
+
+def test_first_search_after_start_uses_pool_not_fallback(monkeypatch):
+    """Запуск процессов пула не съедает срок на ход: первый же поиск не уходит в запасной ход"""
+    monkeypatch.setattr(main, "BOT_SEARCH_WORKERS", 1)
+    monkeypatch.setattr(main, "bot_search_stats", dict(main.bot_search_stats, searches=0, fallbacks=0))
+    main.shutdown_bot_search_pool()
+    game = main.TicTacToeGame(1, -1, is_vs_bot=True, is_rated=False)
+    game.make_move(0, 0, 1)
+
+    try:
+        move = asyncio.run(main.compute_search_move(game))
+    finally:
+        main.shutdown_bot_search_pool()
+
+    assert move == (1, 1)  # единственный не проигрывающий ответ на ход в угол
+    assert main.bot_search_stats['searches'] == 1
+    assert main.bot_search_stats['fallbacks'] == 0
+    assert main.bot_search_stats['max_time'] < main.BOT_SEARCH_DEADLINE
@@ -0,0 +1,45 @@
+import main
+
+
+def make_coordinator(shards=4):
+    return main.ShardCoordinator([None] * shards)
+
+
+def test_jump_consistent_hash_is_stable_and_in_range():
+    for user_id in range(1000):
+        shard = main.jump_consistent_hash(user_id, 8)
+        assert 0 <= shard < 8
+        assert shard == main.jump_consistent_hash(user_id, 8)
+
+
+def test_pinned_user_is_routed_to_game_shard():
+    coordinator = make_coordinator()
+    coordinator.handle_control(('pin', 3, [10, 20], 'g1'))
+    assert coordinator.shard_for_user(10) == 3
+    assert coordinator.shard_for_user(20) == 3
+
+    coordinator.handle_control(('unpin', 3, [10, 20], 'g1'))
+    assert coordinator.shard_for_user(10) == main.jump_consistent_hash(10, 4)
+
+
+def test_late_unpin_of_old_game_keeps_new_pin():
+    coordinator = make_coordinator()
+    coordinator.handle_control(('pin', 1, [10], 'old'))
+    coordinator.handle_control(('unpin', 1, [10], 'old'))
+    coordinator.handle_control(('pin', 1, [10], 'new'))
+    coordinator.handle_control(('unpin', 1, [10], 'old'))  # запоздавшее сообщение
+    assert coordinator.pinned[10] == (1, 'new')
+
+
+def test_second_game_does_not_steal_pinned_player():
+    coordinator = make_coordinator()
+    coordinator.handle_control(('pin', 1, [10], 'g1'))
+    coordinator.handle_control(('pin', 2, [10], 'g2'))
+    assert coordinator.pinned[10] == (1, 'g1')
+
+
+def test_pending_pin_is_confirmed_by_shard():
+    coordinator = make_coordinator()
+    coordinator.pin(10, 2, None)
+    coordinator.handle_control(('pin', 2, [10, -1], 'g1'))
+    assert coordinator.pinned == {10: (2, 'g1')}
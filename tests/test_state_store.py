@@ -0,0 +1,186 @@
+"""Хранилище состояния игр: в памяти и в Redis (RESP-заглушка поверх fakeredis, Lua через lupa)"""
+import asyncio
+
+import pytest
+
+import main
+
+pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+from resp_stub import RespStubServer  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def redis_url():
+    with RespStubServer() as server:
+        yield server.url
+
+
+@pytest.fixture(params=["memory", "redis"])
+def store(request, monkeypatch):
+    monkeypatch.setattr(main, "game_sessions", {})
+    if request.param == "memory":
+        return main.InMemoryStateStore()
+    return main.RedisStateStore(request.getfixturevalue("redis_url"))
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def new_game(size=3, win_length=3):
+    return main.TicTacToeGame(1, 2, is_rated=False, size=size, win_length=win_length)
+
+
+async def play(store, game_id, moves):
+    result = None
+    for player, row, col in moves:
+        result = await store.apply_move(game_id, player, row, col)
+    return result
+
+
+def test_create_and_load(store):
+    async def scenario():
+        game = new_game()
+        game.message_ids = {1: 100, 2: 200}
+        await store.create_game("g1", game)
+        loaded = await store.load_game("g1")
+        assert (loaded.player1, loaded.player2, loaded.current_player) == (1, 2, 1)
+        assert loaded.message_ids == {1: 100, 2: 200}
+        assert await store.find_player_game(2) == "g1"
+        await store.delete_game("g1", loaded)
+    run(scenario())
+
+
+def test_move_checks(store):
+    async def scenario():
+        await store.create_game("g2", new_game())
+        assert (await store.apply_move("missing", 1, 0, 0))[0] == main.MOVE_NO_GAME
+        assert (await store.apply_move("g2", 3, 0, 0))[0] == main.MOVE_NO_GAME
+        assert (await store.apply_move("g2", 2, 0, 0))[0] == main.MOVE_NOT_TURN
+        assert (await store.apply_move("g2", 1, 5, 0))[0] == main.MOVE_INVALID
+
+        status, game = await store.apply_move("g2", 1, 1, 1)
+        assert status == main.MOVE_OK
+        assert game.board[1][1] == '❌' and game.current_player == 2 and game.moves == 1
+        assert (await store.apply_move("g2", 2, 1, 1))[0] == main.MOVE_INVALID
+        await store.delete_game("g2", game)
+    run(scenario())
+
+
+def test_finished_game_rejects_moves(store):
+    async def scenario():
+        await store.create_game("g3", new_game())
+        status, game = await play(store, "g3", [(1, 0, 0), (2, 1, 0), (1, 0, 1), (2, 1, 1), (1, 0, 2)])
+        assert status == main.MOVE_OK and game.winner == 1
+        assert (await store.apply_move("g3", 2, 2, 2))[0] == main.MOVE_FINISHED
+        await store.delete_game("g3", game)
+        assert await store.load_game("g3") is None
+        assert await store.find_player_game(1) is None
+    run(scenario())
+
+
+def test_draw_finishes_game(store):
+    async def scenario():
+        await store.create_game("g4", new_game())
+        moves = [(1, 0, 0), (2, 0, 1), (1, 0, 2), (2, 1, 1), (1, 1, 0),
+                 (2, 1, 2), (1, 2, 1), (2, 2, 0), (1, 2, 2)]
+        status, game = await play(store, "g4", moves)
+        assert status == main.MOVE_OK and game.winner == 'draw'
+        await store.delete_game("g4", game)
+    run(scenario())
+
+
+def test_big_board_win_detection_matches_engine(store):
+    async def scenario():
+        await store.create_game("g5", new_game(size=7, win_length=5))
+        moves = [(1, 0, 6), (2, 6, 6), (1, 1, 5), (2, 6, 5), (1, 2, 4), (2, 6, 4), (1, 3, 3), (2, 6, 3)]
+        status, game = await play(store, "g5", moves)
+        assert status == main.MOVE_OK and not game.winner
+        status, game = await store.apply_move("g5", 1, 4, 2)
+        assert game.winner == 1
+        await store.delete_game("g5", game)
+    run(scenario())
+
+
+def test_move_script_is_reloaded_after_noscript(redis_url):
+    async def scenario():
+        store = main.RedisStateStore(redis_url)
+        await store.create_game("g6", new_game())
+        assert (await store.apply_move("g6", 1, 0, 0))[0] == main.MOVE_OK
+        assert store.script_shas
+
+        # Сервер перезапущен или кэш скриптов сброшен: известный sha ему больше не знаком
+        store.script_shas[main.REDIS_MOVE_SCRIPT] = '0' * 40
+        assert (await store.apply_move("g6", 2, 1, 1))[0] == main.MOVE_OK
+        assert store.script_shas[main.REDIS_MOVE_SCRIPT] != '0' * 40
+        assert (await store.apply_move("g6", 1, 2, 2))[0] == main.MOVE_OK
+        await store.delete_game("g6", await store.load_game("g6"))
+    run(scenario())
+
+
+def test_queue_pair(store, monkeypatch):
+    monkeypatch.setattr(main, "matchmaking_queue", [])
+    monkeypatch.setattr(main, "get_user_data", lambda user_id: {'rating': {10: 100, 20: 150, 30: 900}[user_id]})
+
+    async def scenario():
+        for user_id, rating in [(10, 100), (20, 150), (30, 900)]:
+            await store.queue_join(user_id, rating)
+        assert await store.queue_pair(10, 100, 200) == (True, 20)
+        assert await store.queue_pair(30, 900, 200) == (True, None)
+        assert await store.queue_pair(10, 100, 200) == (False, None)
+    run(scenario())
+
+
+def test_process_move_is_one_store_call(redis_url, monkeypatch):
+    """Ход по кнопке с id игры - один обмен с Redis: чтение и проверки выполняет скрипт"""
+    store = main.RedisStateStore(redis_url)
+    monkeypatch.setattr(main, "state_store", store)
+    monkeypatch.setattr(main, "log_move", lambda *args: None)
+    monkeypatch.setattr(main.TicTacToeGame, "save_to_db", lambda self, game_id: None)
+    monkeypatch.setattr(main, "check_move_timeout", lambda game_id: asyncio.sleep(0))
+    answers = []
+
+    async def update_game_messages(*args):
+        pass
+
+    monkeypatch.setattr(main, "update_game_messages", update_game_messages)
+
+    class Callback:
+        def __init__(self, data, user_id):
+            self.data = data
+            self.from_user = type("User", (), {"id": user_id})
+
+        async def answer(self, text=None, **kwargs):
+            answers.append(text)
+
+    async def scenario():
+        await store.create_game("g7", new_game())
+        await store.apply_move("g7", 1, 1, 1)  # скрипт уже загружен
+
+        roundtrips = []
+        pipeline = store.redis.pipeline
+
+        async def counting_pipeline(*commands):
+            roundtrips.append(commands)
+            return await pipeline(*commands)
+
+        monkeypatch.setattr(store.redis, "pipeline", counting_pipeline)
+        await main.process_move(Callback("m:0:0:g7", 2))
+        assert len(roundtrips) == 1
+        await main.process_move(Callback("m:0:1:g7", 2))
+        assert answers[-1] == "⏳ Сейчас не ваш ход!"
+        main.move_timeout_tasks.pop("g7").cancel()
+        await store.delete_game("g7", await store.load_game("g7"))
+    run(scenario())
+
+
+def test_redis_pairs_closest_rating(redis_url):
+    async def scenario():
+        store = main.RedisStateStore(redis_url)
+        for user_id, rating in [(1, 100), (2, 0), (3, 190), (4, 240)]:
+            await store.queue_join(user_id, rating)
+        assert await store.queue_pair(1, 100, 200) == (True, 3)
+        assert await store.queue_pair(4, 240, 300) == (True, 2)
+    run(scenario())
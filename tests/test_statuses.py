@@ -0,0 +1,21 @@
+import main
+
+
+def grant_status(user_id, status_name):
+    conn = main.get_db_connection()
+    conn.execute('INSERT INTO user_statuses (user_id, status_name, is_active, obtained_at) VALUES (?, ?, FALSE, ?)',
+                 (user_id, status_name, status_name))
+    conn.commit()
+    conn.close()
+
+
+def test_statuses_are_flagged_with_real_booleans(add_user):
+    add_user(1, "alice")
+    grant_status(1, "Рост")
+    grant_status(1, "Цель")
+    assert main.get_user_statuses(1) == [("Рост", False), ("Цель", False)]
+
+    main.set_active_status(1, "Цель")
+    statuses = main.get_user_statuses(1)
+    assert statuses == [("Рост", False), ("Цель", True)]
+    assert all(type(is_active) is bool for _, is_active in statuses)
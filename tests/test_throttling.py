@@ -0,0 +1,69 @@
+import asyncio
+
+import main
+
+
+class Callback:
+    def __init__(self, data, user_id=1):
+        self.data = data
+        self.from_user = type("User", (), {"id": user_id})
+        self.answers = []
+
+    async def answer(self, text=None, **kwargs):
+        self.answers.append(text)
+
+
+async def handler(event, data):
+    return "handled"
+
+
+def press(middleware, data, times, user_id=1):
+    async def scenario():
+        return [await middleware(handler, Callback(data, user_id), {}) for _ in range(times)]
+    return asyncio.run(scenario())
+
+
+def test_prefix_bucket_limits_burst_and_counts(monkeypatch):
+    middleware = main.ThrottlingMiddleware()
+    monkeypatch.setattr(main, "throttling_middleware", middleware)
+    capacity = main.THROTTLE_ACTION_LIMITS["surrender"][0]
+
+    results = press(middleware, "surrender", capacity + 2)
+    assert results.count("handled") == capacity
+    assert middleware.throttled == {"surrender": 2}
+    assert main.format_throttle_stats() == "2 (surrender: 2)"
+
+
+def test_buckets_are_per_user(monkeypatch):
+    middleware = main.ThrottlingMiddleware()
+    capacity = main.THROTTLE_ACTION_LIMITS["surrender"][0]
+    press(middleware, "surrender", capacity + 1, user_id=1)
+    assert press(middleware, "surrender", 1, user_id=2) == ["handled"]
+
+
+def test_empty_stats(monkeypatch):
+    monkeypatch.setattr(main, "throttling_middleware", main.ThrottlingMiddleware())
+    assert main.format_throttle_stats() == "0"
+
+
+def test_legacy_move_buttons_share_the_move_bucket():
+    middleware = main.ThrottlingMiddleware()
+    capacity = main.THROTTLE_ACTION_LIMITS["m"][0]
+
+    async def scenario():
+        results = []
+        for i in range(capacity + 2):
+            data = f"move_{i}_0" if i % 2 else f"m:game:{i}:0"
+            results.append(await middleware(handler, Callback(data), {}))
+        return results
+
+    assert asyncio.run(scenario()).count("handled") == capacity
+    assert middleware.throttled == {"m": 2}
+
+
+def test_actions_are_matched_exactly():
+    middleware = main.ThrottlingMiddleware()
+    capacity = main.THROTTLE_ACTION_LIMITS["spin_roulette"][0]
+    assert press(middleware, "my_inventory", capacity + 2) == ["handled"] * (capacity + 2)
+    assert press(middleware, "spin_roulette_all", capacity + 1).count("handled") == capacity
+    assert press(middleware, "spin_roulette", 1) == [None]
@@ -0,0 +1,62 @@
+import sqlite3
+
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("text, refs", [
+    ("alice", ["alice"]),
+    ("@alice\n@bob", ["alice", "bob"]),
+    ("Иван Петров, bob ;  @carol ", ["Иван Петров", "bob", "carol"]),
+    ("alice\n\nALICE\nalice", ["alice", "ALICE"]),
+    ("id:42\n#7", ["id:42", "#7"]),
+    (" , \n", []),
+])
+def test_parse_user_refs(text, refs):
+    assert main.parse_user_refs(text) == refs
+
+
+@pytest.fixture
+def users(add_user, monkeypatch):
+    monkeypatch.setattr(main, "blocked_users", set())
+    add_user(1, "Иван Петров")
+    add_user(2, "Alice")
+    add_user(3, "12345")
+    add_user(12345, "someone")
+    add_user(5, "ÉMILIE")
+
+
+def test_names_with_spaces_and_cyrillic_case(users):
+    found, not_found = main.set_users_blocked(main.parse_user_refs("иван петров\nalice\némilie"), True)
+    assert sorted(found) == [(1, "Иван Петров"), (2, "Alice"), (5, "ÉMILIE")]
+    assert not_found == []
+    assert main.blocked_users == {1, 2, 5}
+
+
+def test_digit_only_name_beats_id_without_marker(users):
+    assert main.set_users_blocked(["12345"], True)[0] == [(3, "12345")]
+    assert main.set_users_blocked(["id:12345"], True)[0] == [(12345, "someone")]
+    assert main.set_users_blocked(["#2"], True)[0] == [(2, "Alice")]
+
+
+def test_unknown_name_falls_back_to_id(users):
+    assert main.set_users_blocked(["5"], True) == ([(5, "ÉMILIE")], [])
+    assert main.set_users_blocked(["404", "id:404", "nobody"], True) == ([], ["404", "id:404", "nobody"])
+
+
+def test_username_change_updates_key(users):
+    main.update_username(2, "Борис")
+    assert main.set_users_blocked(["БОРИС"], True)[0] == [(2, "Борис")]
+    assert main.set_users_blocked(["alice"], True)[1] == ["alice"]
+
+
+def test_upgrade_backfills_username_key(db):
+    conn = sqlite3.connect(db)
+    conn.execute("INSERT INTO users (user_id, username) VALUES (1, 'Ёжик')")
+    conn.execute(f'PRAGMA user_version = {main.SCHEMA_VERSION - 1}')
+    conn.commit()
+    conn.close()
+
+    assert main.setup_database() is True
+    assert main.set_users_blocked(["ёЖИК"], True)[0] == [(1, "Ёжик")]